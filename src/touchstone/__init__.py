@@ -1,11 +1,31 @@
 # -*- coding: utf-8 -*-
-from pkg_resources import get_distribution, DistributionNotFound
+try:
+    # importlib.metadata is much faster to import than pkg_resources
+    from importlib.metadata import version, PackageNotFoundError
+except ImportError:
+    from pkg_resources import (
+        get_distribution,
+        DistributionNotFound as PackageNotFoundError,
+    )
+
+    def version(dist_name):
+        return get_distribution(dist_name).version
+
 
 try:
     # Change here if project is renamed and does not equal the package name
     dist_name = __name__
-    __version__ = get_distribution(dist_name).version
-except DistributionNotFound:
+    __version__ = version(dist_name)
+except PackageNotFoundError:
     __version__ = "unknown"
 finally:
-    del get_distribution, DistributionNotFound
+    del version, PackageNotFoundError
+
+
+def __getattr__(name):
+    # The session pulls in the databases, only imported once it is used
+    if name == "ComparisonSession":
+        from .session import ComparisonSession
+
+        return ComparisonSession
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
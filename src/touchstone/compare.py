@@ -1,16 +1,22 @@
 # -*- coding: utf-8 -*-
 import argparse
+import io
 import sys
 import logging
 import json
-import yaml
-import csv
-from tabulate import tabulate
 
 from touchstone import __version__
-from . import benchmarks
-from . import databases
-from .utils.lib import mergedicts, flatten_and_discard
+from .databases.resilience import load_connection_config
+from .utils.cache import (
+    MemoryCache,
+    ResultCache,
+    DEFAULT_CACHE_DIR,
+    DEFAULT_CACHE_SIZE,
+    DEFAULT_CACHE_TTL,
+)
+from .session import ComparisonSession, fetch_compute_results
+from .utils.baseline import DEFAULT_BASELINE_PERCENTILES, DEFAULT_BASELINE_TIME_FIELD
+from .utils.timings import enable_timings, get_timings, span
 
 __author__ = "red-hat-perfscale"
 __copyright__ = "red-hat-perfscale"
@@ -40,13 +46,15 @@ def parse_args(args):
         type=str,
         choices=["uperf", "ycsb", "pgbench", "vegeta", "mb", "kubeburner", "scaledata"],
         metavar="benchmark",
+        nargs="?",
     )
     parser.add_argument(
         dest="database",
         help="the type of database data is stored in",
         type=str,
-        choices=["elasticsearch"],
+        choices=["elasticsearch", "snapshot", "sqlite"],
         metavar="database",
+        nargs="?",
     )
     parser.add_argument(
         dest="harness",
@@ -54,6 +62,7 @@ def parse_args(args):
         type=str,
         choices=["ripsaw"],
         metavar="harness",
+        nargs="?",
     )
     parser.add_argument(
         "--id",
@@ -76,9 +85,10 @@ def parse_args(args):
         "-o",
         "--output",
         dest="output",
-        help="How should touchstone output the result",
+        help="How should touchstone output the result, ndjson writes one json record"
+        " per value as soon as it is fetched",
         type=str,
-        choices=["json", "yaml", "csv"],
+        choices=["json", "yaml", "csv", "ndjson"],
     )
     parser.add_argument(
         "--metadata-config",
@@ -92,10 +102,16 @@ def parse_args(args):
         help="Touchstone configuration file",
         type=argparse.FileType("r", encoding="utf-8"),
     )
+    parser.add_argument(
+        "--manifest",
+        dest="manifest",
+        help="yaml or json file of comparison jobs to run in a single process",
+        type=argparse.FileType("r", encoding="utf-8"),
+    )
     parser.add_argument(
         "--output-file",
         dest="output_file",
-        help="Redirect output of json/csv/yaml to file",
+        help="Redirect output of json/csv/yaml/ndjson to file",
         type=argparse.FileType("w"),
     )
     parser.add_argument(
@@ -106,6 +122,206 @@ def parse_args(args):
         type=str,
         nargs="+",
     )
+    parser.add_argument(
+        "--connection-config",
+        dest="connection_config",
+        help="json file of per connection url request timeouts, retries and hedging",
+        type=argparse.FileType("r", encoding="utf-8"),
+    )
+    parser.add_argument(
+        "--pool-size",
+        dest="pool_size",
+        help="maximum number of kept-alive connections per database (default: 10)",
+        type=int,
+        default=10,
+    )
+    parser.add_argument(
+        "--timeout",
+        dest="timeout",
+        help="database request timeout in seconds (default: 10)",
+        type=int,
+        default=10,
+    )
+    parser.add_argument(
+        "--http-compress",
+        dest="http_compress",
+        help="enable gzip compression of database requests and responses",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--lean-queries",
+        dest="lean_queries",
+        help="only fetch aggregations for compute maps, no documents (elasticsearch 7+)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--composite-size",
+        dest="composite_size",
+        help="page compute map buckets through a composite aggregation with pages of"
+        " this size instead of nested terms buckets, 0 disables paging (default: 0)",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        dest="jobs",
+        help="number of database queries to run concurrently (default: 1)",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--async-limit",
+        dest="async_limit",
+        help="send elasticsearch queries from a single thread with asyncio, keeping"
+        " up to this many in flight, 0 disables it (default: 0)",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--adaptive-limit",
+        dest="adaptive_limit",
+        help="adapt the number of elasticsearch queries in flight per connection url"
+        " to its latency and rejections, up to this ceiling, 0 disables it"
+        " (default: 0)",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--adaptive-latency",
+        dest="adaptive_latency",
+        help="seconds over which a reply counts as slow for --adaptive-limit"
+        " (default: twice the moving average of the reply latencies)",
+        type=float,
+    )
+    parser.add_argument(
+        "--batch-size",
+        dest="batch_size",
+        help="send compute queries in batches of this size per request, 0 disables"
+        " batching (default: 0)",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--prefetch",
+        dest="prefetch",
+        help="fetch results in the background while rendering, keeping up to this"
+        " many results ahead of the output, 0 disables prefetching (default: 0)",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--query-plan",
+        dest="query_plan",
+        help="how compute queries are planned: one query per uuid, one query per"
+        " compute map bucketed on the identifier for all uuids sharing a connection"
+        " url, or one query per index fusing its compute maps as filter buckets"
+        " (default: uuid)",
+        type=str,
+        choices=["uuid", "identifier", "fused"],
+        default="uuid",
+    )
+    parser.add_argument(
+        "--baseline-uuids",
+        dest="baseline_uuids",
+        help="compare every uuid to the baseline of these runs",
+        type=str,
+        nargs="+",
+    )
+    parser.add_argument(
+        "--baseline-last",
+        dest="baseline_last",
+        help="compare every uuid to the baseline of the last N runs",
+        type=int,
+    )
+    parser.add_argument(
+        "--baseline-since",
+        dest="baseline_since",
+        help="only select baseline runs from this time on, e.g. now-7d",
+        type=str,
+    )
+    parser.add_argument(
+        "--baseline-until",
+        dest="baseline_until",
+        help="only select baseline runs up to this time, e.g. now-1d/d",
+        type=str,
+    )
+    parser.add_argument(
+        "--baseline-match",
+        dest="baseline_match",
+        help="only select baseline runs with these field values, as field=value",
+        type=str,
+        nargs="+",
+    )
+    parser.add_argument(
+        "--baseline-time-field",
+        dest="baseline_time_field",
+        help="time field of the documents selecting baseline runs (default: {})".format(
+            DEFAULT_BASELINE_TIME_FIELD
+        ),
+        type=str,
+        default=DEFAULT_BASELINE_TIME_FIELD,
+    )
+    parser.add_argument(
+        "--baseline-percentiles",
+        dest="baseline_percentiles",
+        help="percentiles of every metric over the baseline runs (default: {})".format(
+            " ".join(str(percent) for percent in DEFAULT_BASELINE_PERCENTILES)
+        ),
+        type=float,
+        nargs="+",
+        default=DEFAULT_BASELINE_PERCENTILES,
+    )
+    parser.add_argument(
+        "--cache-dir",
+        dest="cache_dir",
+        help="directory of the compute result cache (default: {})".format(
+            DEFAULT_CACHE_DIR
+        ),
+        type=str,
+        default=DEFAULT_CACHE_DIR,
+    )
+    parser.add_argument(
+        "--cache-size",
+        dest="cache_size",
+        help="maximum size of the compute result cache in MiB, 0 disables the limit"
+        " (default: {})".format(DEFAULT_CACHE_SIZE // (1024 * 1024)),
+        type=int,
+        default=DEFAULT_CACHE_SIZE // (1024 * 1024),
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        dest="cache_ttl",
+        help="seconds a cached compute result stays valid, 0 never expires"
+        " (default: {})".format(DEFAULT_CACHE_TTL),
+        type=int,
+        default=DEFAULT_CACHE_TTL,
+    )
+    parser.add_argument(
+        "--no-cache",
+        dest="no_cache",
+        help="do not read or store results in the compute result cache",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--refresh",
+        dest="refresh",
+        help="query every result again and refresh the compute result cache, for"
+        " runs still being indexed",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--timings",
+        dest="timings",
+        help="print a summary of the time spent in every stage to stderr",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--timings-file",
+        dest="timings_file",
+        help="write the timed spans of every stage and query as json lines to file",
+        type=argparse.FileType("w"),
+    )
     parser.add_argument(
         "-v",
         "--verbose",
@@ -122,7 +338,17 @@ def parse_args(args):
         action="store_const",
         const=logging.DEBUG,
     )
-    return parser.parse_args(args)
+    parsed = parser.parse_args(args)
+    if not parsed.manifest and None in [
+        parsed.benchmark,
+        parsed.database,
+        parsed.harness,
+    ]:
+        parser.error("the benchmark, database and harness are required")
+    for match in parsed.baseline_match or []:
+        if "=" not in match:
+            parser.error("baseline matches are given as field=value")
+    return parsed
 
 
 def setup_logging(loglevel):
@@ -137,14 +363,162 @@ def setup_logging(loglevel):
     )
 
 
-def update(dict1, dict2):
-    copy = dict1.copy()
-    for key in dict2:
-        if key in dict1:
-            copy[key].update(dict2[key])
-        else:
-            copy[key] = dict2[key]
-    return copy
+def report_limiters():
+    """Prints the concurrency reached by the adaptive limiter of every
+    connection url to stderr
+    """
+    from .databases.limiter import limiter_reports
+
+    for conn_url, report in limiter_reports().items():
+        print(
+            "Adaptive limit of {}: reached {} queries in flight (limit {}, now {})"
+            " over {} queries, {} rejected, {} slow".format(
+                conn_url,
+                report["peak_in_flight"],
+                report["peak_limit"],
+                report["limit"],
+                report["requests"],
+                report["rejections"],
+                report["slow"],
+            ),
+            file=sys.stderr,
+        )
+
+
+def report_timings(args):
+    """Prints the summary of the timed spans to stderr and writes them to
+    the timings file
+
+    Args:
+      args (:obj:`argparse.Namespace`): command line parameters namespace
+    """
+    timings = get_timings()
+    if args.timings_file:
+        timings.write_json_lines(args.timings_file)
+    if args.timings:
+        from tabulate import tabulate
+
+        print(
+            tabulate(timings.summary(), headers="keys", tablefmt="pretty"),
+            file=sys.stderr,
+        )
+
+
+def baseline_options(args):
+    """Returns the baseline selector of the command line, None without one
+
+    Args:
+      args (:obj:`argparse.Namespace`): command line parameters namespace
+    """
+    selector = {
+        "uuids": args.baseline_uuids,
+        "last": args.baseline_last,
+        "since": args.baseline_since,
+        "until": args.baseline_until,
+        "match": dict(match.split("=", 1) for match in args.baseline_match or []),
+    }
+    if not any(selector.values()):
+        return None
+    selector["time_field"] = args.baseline_time_field
+    selector["percents"] = args.baseline_percentiles
+    return selector
+
+
+def load_manifest(manifest_file):
+    """Returns the comparison jobs of a manifest, a yaml or json list of jobs
+
+    Every job holds the uuids and conn_url of a comparison, a single url or
+    one per uuid, and optionally its benchmark, database, harness,
+    identifier, config and metadata_config files, output format,
+    output_file and baseline, the baseline_selector keyword arguments,
+    defaulting to the ones of the command line.
+
+    Args:
+      manifest_file (file): manifest file
+    """
+    import yaml
+
+    jobs = yaml.safe_load(manifest_file)
+    if not isinstance(jobs, list):
+        raise ValueError("The manifest must hold a list of comparison jobs")
+    for position, job in enumerate(jobs):
+        for field in ["uuids", "conn_url"]:
+            if field not in job:
+                raise ValueError(
+                    "Comparison job {} of the manifest has no {}".format(
+                        position, field
+                    )
+                )
+    return jobs
+
+
+def run_manifest(args, jobs, cache, session_options):
+    """Runs the comparison jobs of a manifest and writes their outputs
+
+    The compute queries of every job are sent first, on a shared pool and
+    once for all the jobs needing them, then every job is written from the
+    cache. Jobs with the same benchmark and configuration share a session.
+
+    Args:
+      args (:obj:`argparse.Namespace`): command line parameters namespace
+      jobs ([dict]): comparison jobs of the manifest
+      cache: result cache shared by the jobs, keeping every result
+      session_options (dict): ComparisonSession options of the command line
+    """
+    # Files of the command line are the defaults of every job
+    default_config = args.config.read() if args.config else None
+    default_metadata_map = None
+    if args.metadata_config:
+        default_metadata_map = json.load(args.metadata_config)["metadata"]
+    sessions = {}
+    comparisons = []
+    try:
+        for job in jobs:
+            settings = {
+                "benchmark": job.get("benchmark", args.benchmark),
+                "database": job.get("database", args.database or "elasticsearch"),
+                "harness": job.get("harness", args.harness or "ripsaw"),
+                "identifier": job.get("identifier", args.identifier),
+                "config": job.get("config"),
+                "metadata_config": job.get("metadata_config"),
+            }
+            key = json.dumps(settings, sort_keys=True)
+            if key not in sessions:
+                config = default_config
+                if settings["config"]:
+                    with open(settings["config"], encoding="utf-8") as config_file:
+                        config = config_file.read()
+                metadata_map = default_metadata_map
+                if settings["metadata_config"]:
+                    with open(
+                        settings["metadata_config"], encoding="utf-8"
+                    ) as metadata_file:
+                        metadata_map = json.load(metadata_file)["metadata"]
+                sessions[key] = ComparisonSession(
+                    settings["benchmark"],
+                    database=settings["database"],
+                    harness=settings["harness"],
+                    # Benchmarks load their configuration from a file
+                    config=io.StringIO(config) if config else None,
+                    identifier=settings["identifier"],
+                    metadata_map=metadata_map,
+                    cache=cache,
+                    **session_options
+                )
+            comparisons.append((sessions[key], job["uuids"], job["conn_url"]))
+        with span("fetch shared results"):
+            fetch_compute_results(comparisons)
+        for job, (session, uuids, conn_urls) in zip(jobs, comparisons):
+            output = job.get("output", args.output)
+            baseline = job.get("baseline", baseline_options(args))
+            if job.get("output_file"):
+                with open(job["output_file"], "w") as output_file:
+                    session.render(uuids, conn_urls, output, output_file, baseline)
+            else:
+                session.render(uuids, conn_urls, output, args.output_file, baseline)
+    finally:
+        for session in sessions.values():
+            session.close()
 
 
 def main(args):
@@ -155,120 +529,64 @@ def main(args):
     """
     args = parse_args(args)
     setup_logging(args.loglevel)
-    metadata_json = {}
-    main_json = {}
-    compare_uuid_dict_metadata = {}
-    logger.debug("Instantiating the benchmark instance")
-    benchmark_instance = benchmarks.grab(
-        args.benchmark,
-        source_type=args.database,
-        harness_type=args.harness,
-        config=args.config,
-    )
-    if len(args.conn_url) < len(args.uuid):
-        args.conn_url = [args.conn_url[0]] * len(args.uuid)
-    if args.metadata_config:
-        config_file_metadata = json.load(args.metadata_config)
-    output_file = args.output_file if args.output_file else sys.stdout
-    # Indices from metadata map
-    for uuid_index, uuid in enumerate(args.uuid):
-        super_header = "\n{} UUID: {} {}".format(("=" * 67), uuid, ("=" * 67))
-        compare_uuid_dict_metadata[uuid] = {}
-        # Create database connection instance
-        database_instance = databases.grab(
-            args.database, conn_url=args.conn_url[uuid_index]
+    if args.timings or args.timings_file:
+        enable_timings()
+    policies = None
+    if args.connection_config:
+        policies = load_connection_config(args.connection_config)
+    cache = None
+    if not args.no_cache:
+        cache = ResultCache(
+            cache_dir=args.cache_dir,
+            max_size=args.cache_size * 1024 * 1024,
+            ttl=args.cache_ttl,
+            refresh=args.refresh,
         )
+    session_options = {
+        "policies": policies,
+        "pool_size": args.pool_size,
+        "timeout": args.timeout,
+        "http_compress": args.http_compress,
+        "lean_queries": args.lean_queries,
+        "composite_size": args.composite_size,
+        "jobs": args.jobs,
+        "async_limit": args.async_limit,
+        "adaptive_limit": args.adaptive_limit,
+        "adaptive_latency": args.adaptive_latency,
+        "batch_size": args.batch_size,
+        "query_plan": args.query_plan,
+        "prefetch": args.prefetch,
+    }
+    if args.manifest:
+        # Every result is kept in memory until all the jobs are written
+        cache = MemoryCache(max_entries=0, ttl=0, backing=cache)
+        run_manifest(args, load_manifest(args.manifest), cache, session_options)
+    else:
         # Set metadata search map based on existence of config file
+        metadata_map = None
         if args.metadata_config:
-            metadata_search_map = config_file_metadata["metadata"]
-        else:
-            metadata_search_map = benchmark_instance.emit_metadata_search_map()
-        index_dict = {}
-        for index in metadata_search_map.keys():
-            tmp_dict = {}
-            # Adding emit_compare_metadata_dict to elasticsearch class
-            database_instance.emit_compare_metadata_dict(
-                uuid, metadata_search_map[index], index, tmp_dict
+            metadata_map = json.load(args.metadata_config)["metadata"]
+        with ComparisonSession(
+            args.benchmark,
+            database=args.database,
+            harness=args.harness,
+            config=args.config,
+            identifier=args.identifier,
+            metadata_map=metadata_map,
+            cache=cache,
+            **session_options
+        ) as session:
+            session.render(
+                args.uuid,
+                args.conn_url,
+                output=args.output,
+                output_file=args.output_file,
+                baseline=baseline_options(args),
             )
-            compare_uuid_dict_metadata[uuid] = tmp_dict
-            index_dict = update(tmp_dict, index_dict)
-        stockpile_metadata = {}
-        stockpile_metadata["where"] = []
-        for where in index_dict.keys():
-            # Skip if there is no associated metadata
-            if not index_dict[where].items():
-                continue
-            stockpile_metadata["where"].append(where)
-            for k, v in index_dict[where].items():
-                if k not in stockpile_metadata:
-                    stockpile_metadata[k] = []
-                stockpile_metadata[k].append(v)
-        # Check that metadata exists to be printed
-        if stockpile_metadata["where"]:
-            if args.output in ["csv"]:
-                # Print to output file if argument present
-                row_list = [["uuid", "where", "field", "value"]]
-                flatten_and_discard(compare_uuid_dict_metadata, [], row_list)
-                writer = csv.writer(output_file, delimiter=",")
-                list(map(writer.writerow, row_list))
-            elif args.output in ["json", "yaml"]:
-                mergedicts(compare_uuid_dict_metadata, metadata_json)
-            else:
-                print(super_header, file=output_file)
-                print(
-                    tabulate(stockpile_metadata, headers="keys", tablefmt="pretty"),
-                    file=output_file,
-                )
-
-    # Indices from entered harness (ex: ripsaw)
-    for index in benchmark_instance.emit_indices():
-        for compute in benchmark_instance.emit_compute_map()[index]:
-            # index_json is used for csv and standard output. Since the heeader may be different in each index
-            # we need to print csv or stdout for each index
-            index_json = {}
-            # Iterate through UUIDs
-            for uuid_index, uuid in enumerate(args.uuid):
-                # Create database connection instance
-                database_instance = databases.grab(
-                    args.database, conn_url=args.conn_url[uuid_index]
-                )
-                # Add method emit_compute_dict to the elasticsearch class
-                result = database_instance.emit_compute_dict(
-                    uuid=uuid,
-                    compute_map=compute,
-                    index=index,
-                    identifier=args.identifier,
-                )
-                mergedicts(result, main_json)
-                mergedicts(result, index_json)
-                compute_header = []
-                for key in compute["filter"]:
-                    compute_header.append(key.split(".keyword")[0])
-                for bucket in compute["buckets"]:
-                    compute_header.append(bucket.split(".keyword")[0])
-                for extra_h in ["key", "uuid", "value"]:
-                    compute_header.append(extra_h)
-            if index_json:
-                row_list = []
-                if args.output == "csv":
-                    row_list.append(compute_header)
-                    flatten_and_discard(index_json, compute_header, row_list)
-                    writer = csv.writer(output_file, delimiter=",")
-                    list(map(writer.writerow, row_list))
-                elif args.output not in ["json", "yaml"]:
-                    flatten_and_discard(index_json, compute_header, row_list)
-                    print(
-                        tabulate(row_list, headers=compute_header, tablefmt="pretty"),
-                        file=output_file,
-                    )
-    if args.output == "json":
-        if metadata_json:
-            output_file.write(json.dumps(metadata_json, indent=4))
-        output_file.write(json.dumps(main_json, indent=4))
-    elif args.output == "yaml":
-        if metadata_json:
-            output_file.write(yaml.dump(metadata_json, allow_unicode=True))
-        output_file.write(yaml.dump(main_json, allow_unicode=True))
+    if args.adaptive_limit:
+        report_limiters()
+    if get_timings():
+        report_timings(args)
     logger.info("Script ends here")
 
 
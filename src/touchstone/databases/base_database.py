@@ -1,18 +1,258 @@
 from abc import ABCMeta, abstractmethod
 import logging
 
+from ..utils.baseline import baseline_stats
+from ..utils.lib import ResultStore
+
 
 _logger = logging.getLogger("touchstone")
 
 
 class DatabaseBaseClass(metaclass=ABCMeta):  # noqa
-    def __init__(self, conn_url=None):
+    def __init__(self, conn_url=None, cache=None, cache_scope=None):
         _logger.debug("Initializing DatabaseBaseClass instance")
-        if conn_url:
-            self._conn_url = conn_url
+        self._conn_url = conn_url
+        self._cache = cache
+        # Settings shaping the compute results, part of their cache keys
+        self._cache_scope = cache_scope or {}
         self._dict = None
         _logger.debug("Finished initializing DatabaseBaseClass instance")
 
     @abstractmethod
     def emit_compute_dict(self):
         pass
+
+    def emit_compute_dicts(self, queries):
+        """
+        Returns the normalized data of every query in queries, a list of
+        emit_compute_dict keyword arguments. Databases able to send several
+        queries in one request should override this.
+        """
+        return [self.emit_compute_dict(**query) for query in queries]
+
+    def emit_compute_dicts_by_identifier(self, uuids, compute_map, index, identifier):
+        """
+        Returns the normalized data of the compute map for every identifier
+        value in uuids. Databases able to compute all of them in one query
+        should override this.
+        """
+        return [
+            self.emit_compute_dict(
+                uuid=uuid, compute_map=compute_map, index=index, identifier=identifier
+            )
+            for uuid in uuids
+        ]
+
+    def emit_compute_dicts_fused(self, queries):
+        """
+        Returns the normalized data of every query in queries, a list of
+        emit_compute_dict keyword arguments sharing their index and identifier.
+        Databases able to compute several compute maps in one query should
+        override this.
+        """
+        return self.emit_compute_dicts(queries)
+
+    def emit_baseline_runs(
+        self,
+        index,
+        identifier,
+        time_field,
+        last=None,
+        since=None,
+        until=None,
+        match=None,
+        exclude=None,
+    ):
+        """
+        Returns the identifier values of the runs in index, latest first, at
+        most the last ones, with a time_field between since and until and the
+        field values of match, leaving out the ones of exclude. Databases able
+        to select runs should override this, the runs of a baseline being
+        listed otherwise.
+        """
+        raise NotImplementedError(
+            "{} can not select runs, list the uuids of the baseline instead".format(
+                type(self).__name__
+            )
+        )
+
+    def selects_baseline_runs(self):
+        """
+        Returns whether the database selects the runs of a baseline, listed
+        runs being the only ones it takes otherwise
+        """
+        return type(self).emit_baseline_runs is not DatabaseBaseClass.emit_baseline_runs
+
+    def emit_baseline_dict(self, runs, compute_map, index, identifier, percents):
+        """
+        Returns the statistics of every metric of the compute map over the
+        identifier values in runs, nested like the normalized data of a
+        compute query. The results of every run are fetched and reduced here,
+        databases able to compute the statistics in a query should override
+        this.
+        """
+        store = ResultStore()
+        for result in self.emit_compute_dicts_by_identifier(
+            runs, compute_map, index, identifier
+        ):
+            store.merge(result)
+        output_dict = store.to_dict()
+        stack = [output_dict]
+        while stack:
+            node = stack.pop()
+            for key, child in list(node.items()):
+                if not isinstance(child, dict):
+                    continue
+                if not any(isinstance(value, dict) for value in child.values()):
+                    # Values of a metric, keyed by run
+                    values = [value for value in child.values() if value is not None]
+                    if values:
+                        node[key] = baseline_stats(values, percents)
+                    else:
+                        del node[key]
+                    continue
+                stack.append(child)
+        return output_dict
+
+    def emit_compare_metadata_dicts(self, uuids, compare_map, index):
+        """
+        Returns the metadata of every uuid in uuids from index. Databases able
+        to fetch all of them in one query should override this.
+        """
+        return [
+            self.emit_compare_metadata_dict(
+                uuid=uuid, compare_map=compare_map, index=index, input_dict={}
+            )
+            for uuid in uuids
+        ]
+
+    def _cache_source(self):
+        """
+        Returns what identifies the data behind the results in cache keys,
+        the connection url. File backed databases add the version of their
+        file, so results of a file written again are not read back.
+        """
+        return self._conn_url
+
+    def _compute_cache_key(self, uuid, compute_map, index, identifier):
+        return [
+            self._cache_source(),
+            index,
+            compute_map,
+            identifier,
+            uuid,
+            self._cache_scope,
+        ]
+
+    def get_cached_compute_dict(self, uuid, compute_map, index, identifier):
+        """
+        Returns the cached normalized data of a compute query, None if the
+        database has no result cache or the result is not cached
+        """
+        if self._cache is None:
+            return None
+        return self._cache.get(
+            self._compute_cache_key(uuid, compute_map, index, identifier)
+        )
+
+    def cache_compute_dict(self, output_dict, uuid, compute_map, index, identifier):
+        """
+        Stores the normalized data of a compute query in the result cache.
+        Empty results are not stored, as the run may not be indexed yet.
+        """
+        if self._cache is None or not output_dict:
+            return
+        self._cache.put(
+            self._compute_cache_key(uuid, compute_map, index, identifier), output_dict
+        )
+
+    def remember_compute_dict(self, output_dict, uuid, compute_map, index, identifier):
+        """
+        Keeps the normalized data of a compute query in the in-memory result
+        cache only, for results such as empty ones that are not worth storing
+        but stay the same for the rest of a run
+        """
+        if self._cache is None:
+            return
+        self._cache.remember(
+            self._compute_cache_key(uuid, compute_map, index, identifier), output_dict
+        )
+
+    def claim_compute_dict(self, uuid, compute_map, index, identifier):
+        """
+        Claims a compute query missing from the result cache, so concurrent
+        lookups of the same query wait for its result instead of sending it
+        too. Returns None once claimed, the claimer then has to cache or
+        release the result, or the event set when another claimer is done.
+        """
+        if self._cache is None:
+            return None
+        return self._cache.claim(
+            self._compute_cache_key(uuid, compute_map, index, identifier)
+        )
+
+    def release_compute_dict(self, uuid, compute_map, index, identifier):
+        """
+        Releases a claimed compute query whose result is not cached
+        """
+        if self._cache is None:
+            return
+        self._cache.release(
+            self._compute_cache_key(uuid, compute_map, index, identifier)
+        )
+
+    def _baseline_cache_key(self, selector, compute_map, index, identifier):
+        return [
+            "baseline",
+            self._cache_source(),
+            index,
+            compute_map,
+            identifier,
+            selector,
+        ]
+
+    def get_cached_baseline_dict(self, selector, compute_map, index, identifier):
+        """
+        Returns the cached statistics of the compute map over the runs chosen
+        by selector, None if the database has no result cache or they are
+        not cached
+        """
+        if self._cache is None:
+            return None
+        return self._cache.get(
+            self._baseline_cache_key(selector, compute_map, index, identifier)
+        )
+
+    def cache_baseline_dict(
+        self, output_dict, selector, compute_map, index, identifier
+    ):
+        """
+        Stores the statistics of the compute map over the runs chosen by
+        selector in the result cache, unless empty
+        """
+        if self._cache is None or not output_dict:
+            return
+        self._cache.put(
+            self._baseline_cache_key(selector, compute_map, index, identifier),
+            output_dict,
+        )
+
+    def _metadata_cache_key(self, uuid, compare_map, index):
+        return ["metadata", self._cache_source(), index, compare_map, uuid]
+
+    def get_cached_metadata_dict(self, uuid, compare_map, index):
+        """
+        Returns the cached metadata of a uuid, None if the database has no
+        result cache or the metadata is not cached
+        """
+        if self._cache is None:
+            return None
+        return self._cache.get(self._metadata_cache_key(uuid, compare_map, index))
+
+    def cache_metadata_dict(self, output_dict, uuid, compare_map, index):
+        """
+        Stores the metadata of a uuid in the result cache, unless empty
+        """
+        if self._cache is None or not output_dict:
+            return
+        self._cache.put(self._metadata_cache_key(uuid, compare_map, index), output_dict)
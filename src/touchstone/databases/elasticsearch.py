@@ -1,158 +1,1289 @@
+import functools
 import logging
+import threading
+import time
 import elasticsearch
+import elasticsearch.helpers
 import json
-from elasticsearch_dsl import Search, A
+from elasticsearch_dsl import Search, A, Q
 
 from . import DatabaseBaseClass
-
+from .limiter import get_limiter, limited
+from .resilience import RequestPolicy, call_with_policy, reserve_hedge_workers
+from ..utils.baseline import baseline_values
+from ..utils.timings import compute_label, count_buckets, get_timings
 
 logger = logging.getLogger("touchstone")
 
+DEFAULT_POOL_SIZE = 10
+DEFAULT_TIMEOUT = 10
+
+# Response parts kept by lean queries, everything else is dropped server side
+LEAN_FILTER_PATH = "took,timed_out,hits.total,aggregations"
+LEAN_MSEARCH_FILTER_PATH = ",".join(
+    "responses." + path for path in ["error", "status"] + LEAN_FILTER_PATH.split(",")
+)
+
+# Hits per page of the metadata queries, and how long the point in time or
+# scroll context they page through is kept between pages
+METADATA_PAGE_SIZE = 1000
+PAGING_KEEP_ALIVE = "1m"
+# Most runs a baseline selects, the largest terms aggregation size
+BASELINE_MAX_RUNS = 10000
+# Aggregations with several values, of which the baseline only reduces the
+# ones keyed by percent or value
+MULTI_VALUE_AGGS = ["stats", "extended_stats", "percentiles", "percentile_ranks"]
+# Parameter listing the values of the aggregations the baseline reduces
+KEYED_VALUES_PARAMS = {"percentiles": "percents", "percentile_ranks": "values"}
+
+
+def rejected(reply):
+    """
+    Returns whether a request raising or replying reply was rejected by an
+    overloaded cluster
+    """
+    if isinstance(reply, elasticsearch.TransportError):
+        return reply.status_code == 429
+    if isinstance(reply, dict) and "responses" in reply:
+        return any(response.get("status") == 429 for response in reply["responses"])
+    return False
+
+
+def paging_unsupported(err):
+    """
+    Returns whether a point in time request failing with err was refused
+    by a client or cluster older than 7.10, which have no point in time
+    """
+    if isinstance(err, AttributeError):
+        return True
+    return isinstance(err, elasticsearch.TransportError) and err.status_code in (
+        400,
+        404,
+        405,
+    )
+
+
+class SearchRequest:
+    """
+    Search yielded by query steps: the search object, the index it runs on
+    and the parameters of the request. Lean requests only get back the parts
+    of the response that the compute path reads.
+    """
+
+    def __init__(self, s, index, lean=False, **params):
+        self.search = s
+        self.index = index
+        self.params = params
+        if lean:
+            self.params["filter_path"] = LEAN_FILTER_PATH
+
+
+class ApiRequest:
+    """
+    Request of any client api, yielded by query steps that need more than
+    searches. It refers to server side state, so it is never hedged.
+    """
+
+    def __init__(self, method, **params):
+        self.method = method
+        self.params = params
+
+
+# Shared clients, keyed by connection url and retries
+_connections = {}
+_connections_lock = threading.Lock()
+
+
+def get_connection(
+    conn_url,
+    pool_size=DEFAULT_POOL_SIZE,
+    timeout=DEFAULT_TIMEOUT,
+    http_compress=False,
+    max_retries=3,
+):
+    """
+    Returns the shared client for conn_url, creating it on first use.
+    The client keeps its HTTP connections alive, so every query sent to the
+    same cluster during a run reuses the same connection pool. Request
+    policies with and without retries get clients of their own, the other
+    options are only applied when the client is created.
+    """
+    key = (conn_url, max_retries)
+    with _connections_lock:
+        if key not in _connections:
+            logger.debug("Creating connection object for {}".format(conn_url))
+            _connections[key] = elasticsearch.Elasticsearch(
+                [conn_url],
+                send_get_body_as="POST",
+                maxsize=pool_size,
+                timeout=timeout,
+                http_compress=http_compress,
+                max_retries=max_retries,
+            )
+        return _connections[key]
+
+
+def close_connections():
+    """
+    Closes and forgets every shared client
+    """
+    with _connections_lock:
+        for conn_object in _connections.values():
+            conn_object.transport.close()
+        _connections.clear()
+
 
 class Elasticsearch(DatabaseBaseClass):
-    def _create_conn_object(self):
-        logger.debug("Creating connection object")
-        es = elasticsearch.Elasticsearch([self._conn_url], send_get_body_as="POST")
-        return es
+    def _create_conn_object(self, conn_url=None):
+        logger.debug("Grabbing connection object")
+        return get_connection(
+            conn_url or self._conn_url,
+            pool_size=self._pool_size,
+            timeout=self._timeout,
+            http_compress=self._http_compress,
+            # Retries are left to the request policy when it has some
+            max_retries=0 if self._policy.retries else 3,
+        )
 
-    def __init__(self, conn_url=None):
+    def __init__(
+        self,
+        conn_url=None,
+        pool_size=DEFAULT_POOL_SIZE,
+        timeout=DEFAULT_TIMEOUT,
+        http_compress=False,
+        lean_queries=False,
+        composite_size=0,
+        cache=None,
+        policy=None,
+        adaptive_limit=0,
+        adaptive_latency=None,
+        jobs=1,
+        cache_scope=None,
+    ):
         logger.debug("Initializing Elasticsearch object")
-        DatabaseBaseClass.__init__(self, conn_url=conn_url)
+        DatabaseBaseClass.__init__(
+            self, conn_url=conn_url, cache=cache, cache_scope=cache_scope
+        )
+        self._pool_size = pool_size
+        self._timeout = timeout
+        self._http_compress = http_compress
+        self._lean_queries = lean_queries
+        self._composite_size = composite_size
+        self._policy = policy or RequestPolicy()
         self._conn_object = self._create_conn_object()
-        self._aggs_list = []
+        self._hedge_conn_objects = [
+            self._create_conn_object(url) for url in self._policy.hedge_urls
+        ]
+        if self._policy.hedged():
+            # Every query sent at the same time, and its duplicates, get a thread
+            reserve_hedge_workers(jobs * (1 + len(self._policy.hedge_urls)))
+        # Limiters of the connection url and of every hedge url
+        self._limiters = []
+        if adaptive_limit:
+            self._limiters = [
+                get_limiter(url, adaptive_limit, latency_threshold=adaptive_latency)
+                for url in [self._conn_url] + self._policy.hedge_urls
+            ]
         logger.debug("Finished Initializing Elasticsearch object")
 
-    def gen_result_dict(self, reponse, buckets, aggs, uuid):
+    def _build_result_dict(self, input_dict, buckets, aggs, uuid, add_values=None):
+        """
+        Returns the normalized data from the aggregations in input_dict,
+        walking the bucket levels with an explicit stack instead of recursion.
+        The values of every level are added by add_values when given, instead
+        of the values of aggs for uuid.
+        """
         output_dict = {}
-        input_dict = reponse.aggs.__dict__
         # Remove .keyword from bucket names
         buckets = [e.split(".keyword")[0] for e in buckets]
-
-        def build_dict(input_dict, output_dict):
-            # Iterate through buckets and check if that bucket exists in input_dict
+        stack = [(input_dict, output_dict)]
+        while stack:
+            input_level, output_level = stack.pop()
+            # Iterate through buckets and check if that bucket exists in this level
             for b in buckets:
-                # If the bucket exists, add it
-                if b in input_dict:
-                    output_dict[b] = {}
-                    # Iterate through bucket values and recurse with each nested bucket
-                    for bucket in input_dict[b]["buckets"]:
-                        output_dict[b][bucket["key"]] = {}
-                        build_dict(bucket, output_dict[b][bucket["key"]])
-            # This is supposed to run in the last level
-            for agg in aggs:
-                # If the aggregation name is in this level and a value is found for that aggregation,
-                # we add it to the output dict
-                if agg in input_dict and "values" in input_dict[agg]:
-                    for name, value in input_dict[agg]["values"].items():
-                        agg_name = "{}{}".format(name, agg)
-                        output_dict[agg_name] = {}
-                        output_dict[agg_name][uuid] = value
-                elif agg in input_dict:
-                    output_dict[agg] = {}
-                    output_dict[agg][uuid] = input_dict[agg]["value"]
-
-        build_dict(input_dict["_d_"], output_dict)
+                if b in input_level:
+                    bucket_dict = output_level[b] = {}
+                    for bucket in input_level[b]["buckets"]:
+                        child_dict = bucket_dict[bucket["key"]] = {}
+                        stack.append((bucket, child_dict))
+            # Only the last level carries aggregation values
+            if add_values is None:
+                self._add_agg_values(input_level, output_level, aggs, uuid)
+            else:
+                add_values(input_level, output_level)
         return output_dict
 
-    def emit_compute_dict(self, uuid, compute_map, index, identifier):
+    def _add_agg_values(self, input_dict, output_dict, aggs, uuid):
         """
-        Returns the normalized data from the ES query
+        Adds the values of the aggregations found in input_dict to output_dict
         """
-        output_dict = {}
-        buckets = compute_map["buckets"]
-        aggregations = compute_map["aggregations"]
-        filters = compute_map["filter"]
+        for agg in aggs:
+            # If the aggregation name is in this level and a value is found for that aggregation,
+            # we add it to the output dict
+            if agg in input_dict and "values" in input_dict[agg]:
+                for name, value in input_dict[agg]["values"].items():
+                    agg_name = "{}{}".format(name, agg)
+                    output_dict[agg_name] = {}
+                    output_dict[agg_name][uuid] = value
+            elif agg in input_dict:
+                output_dict[agg] = {}
+                output_dict[agg][uuid] = input_dict[agg]["value"]
 
-        logger.debug("Initializing search object")
-        kw_identifier = identifier + ".keyword"  # append .keyword
-        s = Search(using=self._conn_object, index=str(index)).query(
-            "match", **{kw_identifier: uuid}
+    def _add_composite_bucket(self, output_dict, bucket, bucket_names, aggs, uuid):
+        """
+        Adds a composite aggregation bucket to output_dict, nesting its key
+        the same way as the nested terms buckets
+        """
+        for name in bucket_names:
+            output_dict = output_dict.setdefault(name, {})
+            output_dict = output_dict.setdefault(bucket["key"][name], {})
+        self._add_agg_values(bucket, output_dict, aggs, uuid)
+
+    def _search(self, request):
+        """
+        Returns the raw decoded response of a SearchRequest, skipping the
+        response wrappers of elasticsearch_dsl
+        """
+        body = request.search.to_dict()
+        return self._call(
+            lambda conn_object, **params: conn_object.search(
+                index=request.index, body=body, **request.params, **params
+            ),
+            hedge=self._hedgeable(request, body),
+        )
+
+    def _hedgeable(self, request, body):
+        # Pages of a point in time or a scroll only exist on the connection url
+        return "pit" not in body and "scroll" not in request.params
+
+    def _api(self, request):
+        """
+        Returns the reply of an ApiRequest
+        """
+        return self._call(
+            lambda conn_object, **params: getattr(conn_object, request.method)(
+                **request.params, **params
+            ),
+            hedge=False,
         )
 
+    def _msearch_request(self, searches):
+        """
+        Returns the body and parameters of the _msearch request of the
+        SearchRequests
+        """
+        body = []
+        for request in searches:
+            body.append({"index": request.index})
+            body.append(request.search.to_dict())
+        params = {}
+        if self._lean_queries:
+            params["filter_path"] = LEAN_MSEARCH_FILTER_PATH
+        return body, params
+
+    def _msearch(self, searches):
+        """
+        Returns the raw decoded responses of the SearchRequests, sent as a
+        single _msearch request, raising the first error found in them
+        """
+        body, msearch_params = self._msearch_request(searches)
+
+        def send(conn_object, **params):
+            # Errors of the responses are raised within the request, so the
+            # request policy retries them
+            return self._msearch_responses(
+                conn_object.msearch(body=body, **msearch_params, **params)
+            )
+
+        return self._call(send)
+
+    def _call(self, request, hedge=True):
+        """
+        Returns the reply of request, a function sending a request with the
+        client and keyword arguments it is given, applying the request policy
+        of the connection url. Without hedge, the request is only ever sent
+        to the connection url.
+        """
+        params = self._policy.request_params()
+        conn_objects = [self._conn_object]
+        if hedge:
+            conn_objects += self._hedge_conn_objects
+        sends = [
+            functools.partial(request, conn_object, **params)
+            for conn_object in conn_objects
+        ]
+        if self._limiters:
+            sends = [
+                limited(limiter, send, rejected)
+                for limiter, send in zip(self._limiters, sends)
+            ]
+        return call_with_policy(self._policy, sends)
+
+    def _msearch_responses(self, responses):
+        """
+        Returns the responses of an _msearch request, raising the first error
+        found in them
+        """
+        for response in responses["responses"]:
+            if "error" in response:
+                error = response["error"]
+                raise elasticsearch.TransportError(
+                    response.get("status", "N/A"),
+                    error.get("type") if isinstance(error, dict) else error,
+                    error,
+                )
+        return responses["responses"]
+
+    def _run(self, steps):
+        """
+        Runs the query steps of a database call and returns its result. Query
+        steps are generators yielding a SearchRequest, a list of them to send
+        as one _msearch request, or an ApiRequest, and receiving the raw
+        responses back. The error of a failed request is raised in the steps.
+        """
+        try:
+            request = next(steps)
+            while True:
+                try:
+                    reply = self._send(request)
+                except Exception as err:
+                    request = steps.throw(err)
+                else:
+                    request = steps.send(reply)
+        except StopIteration as stop:
+            return stop.value
+
+    def _send(self, request):
+        """
+        Returns the raw reply of a request yielded by query steps
+        """
+        if isinstance(request, list):
+            return self._msearch(request)
+        if isinstance(request, ApiRequest):
+            return self._api(request)
+        return self._search(request)
+
+    def _timed(self, stage, queries, steps):
+        """
+        Query steps running steps in a span of stage when timings are
+        enabled, labelled with the index, uuid and compute map of every query
+        in queries. The span records the time spent building queries and
+        results, and the elasticsearch took time, size and bucket count of
+        every response
+        """
+        timings = get_timings()
+        if timings is None:
+            return (yield from steps)
+        labels = []
+        for query in queries:
+            label = {"index": query["index"], "uuid": query["uuid"]}
+            if "compute_map" in query:
+                label["compute_map"] = compute_label(query["compute_map"])
+            labels.append(label)
+        with timings.span(stage, queries=labels) as record:
+            record.update(build=0.0, took=0, requests=0, bytes=0, buckets=0)
+            start = time.perf_counter()
+            try:
+                request = next(steps)
+                while True:
+                    record["build"] += time.perf_counter() - start
+                    try:
+                        reply = yield request
+                    except Exception as err:
+                        start = time.perf_counter()
+                        request = steps.throw(err)
+                        continue
+                    start = time.perf_counter()
+                    for response in reply if isinstance(reply, list) else [reply]:
+                        record["requests"] += 1
+                        record["took"] += response.get("took", 0)
+                        # Size of the decoded response, encoded back to json
+                        record["bytes"] += len(json.dumps(response))
+                        record["buckets"] += count_buckets(
+                            response.get("aggregations", {})
+                        )
+                    request = steps.send(reply)
+            except StopIteration as stop:
+                record["build"] += time.perf_counter() - start
+                return stop.value
+
+    def _debug_json(self, message, value):
+        # Serializing large queries and results is only worth it when logged
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(message.format(json.dumps(value, indent=4)))
+
+    def _total_hits(self, response):
+        """
+        Returns the total hit count of a raw response
+        """
+        total = response["hits"]["total"]
+        # Elasticsearch 7 and later return an object with the count as value
+        if isinstance(total, dict):
+            total = total["value"]
+        return total
+
+    def _apply_compute_filters(self, s, compute_map):
+        """
+        Returns the search object restricted by the filters and excludes
+        of the compute map
+        """
         # Apply filters
-        for key, value in filters.items():
+        for key, value in compute_map["filter"].items():
             s = s.filter("term", **{key: value})
 
         # Apply excludes
         if "exclude" in compute_map:
             for exclude in compute_map["exclude"]:
                 s = s.exclude("match", **exclude)
+        return s
+
+    def _add_compute_aggs(self, parent, compute_map):
+        """
+        Nests the buckets and aggregations of the compute map under parent,
+        either the aggs of a search object or another bucket, and returns the
+        list of aggregation names added
+        """
+        a = self._add_compute_buckets(parent, compute_map)
+        aggs_list = self._add_compute_metrics(a, compute_map)
+        return aggs_list
+
+    def _add_compute_buckets(self, parent, compute_map):
+        """
+        Nests the buckets of the compute map under parent and returns the
+        innermost bucket
+        """
+        buckets = compute_map["buckets"]
 
         logger.debug("Building buckets")
         a = A("terms", field=buckets[0], size=10000)
-        x = s.aggs.bucket(buckets[0].split(".keyword")[0], a)
+        x = parent.bucket(buckets[0].split(".keyword")[0], a)
         for bucket in buckets[1:]:
             a = A("terms", field=bucket, size=10000)
             # Create bucket with and trimming characters after .
             x = x.bucket(bucket.split(".keyword")[0], a)
         logger.debug("Finished adding buckets to query")
-        logger.debug("Adding aggregations to query")
+        return a
+
+    def _compute_metrics(self, compute_map):
+        """
+        Yields the name, type and parameters of every aggregation of the
+        compute map
+        """
+        aggregations = compute_map["aggregations"]
         for key, agg_list in aggregations.items():
             for aggs in agg_list:
                 if isinstance(aggs, str):
-                    _temp_agg_str = "{}({})".format(aggs, key)
                     # Create aggregation based on the key
-                    a.metric(_temp_agg_str, aggs, field=key)
-                    self._aggs_list.append(_temp_agg_str)
+                    yield "{}({})".format(aggs, key), aggs, {"field": key}
                 # If there's a dictionary of aggregations. i.e different percentiles
                 # we have to iterate through keys and values
                 elif isinstance(aggs, dict):
                     for dict_key, dict_value in aggs.items():
-                        _temp_agg_str = "{}({})".format(dict_key, key)
                         # Add nested dict as aggregation
-                        a.metric(_temp_agg_str, dict_key, field=key, **dict_value)
-                        self._aggs_list.append(_temp_agg_str)
+                        yield "{}({})".format(dict_key, key), dict_key, dict(
+                            {"field": key}, **dict_value
+                        )
                 else:
                     logger.warn("Ignoring aggregation {}".format(aggs))
+
+    def _add_compute_metrics(self, a, compute_map):
+        """
+        Adds the aggregations of the compute map to the bucket a, and
+        returns the list of aggregation names added
+        """
+        aggs_list = []
+        logger.debug("Adding aggregations to query")
+        for name, agg_type, params in self._compute_metrics(compute_map):
+            a.metric(name, agg_type, **params)
+            aggs_list.append(name)
         logger.debug("Finished adding aggregations to query")
-        logger.debug(
-            "Built the following query: {}".format(json.dumps(s.to_dict(), indent=4))
+        return aggs_list
+
+    def _lean_search(self, s, track_total_hits=1):
+        """
+        Returns the search object requesting no hits, to send in a lean
+        SearchRequest. By default the total hit count stops at the first
+        match, which is enough to tell whether there is data
+        """
+        return s.extra(size=0, track_total_hits=track_total_hits)
+
+    def _build_compute_search(self, uuid, compute_map, index, identifier):
+        """
+        Returns the SearchRequest for the compute map along with the list
+        of aggregation names added to it
+        """
+        logger.debug("Initializing search object")
+        kw_identifier = identifier + ".keyword"  # append .keyword
+        s = Search(using=self._conn_object).query("match", **{kw_identifier: uuid})
+        s = self._apply_compute_filters(s, compute_map)
+        if self._lean_queries:
+            s = self._lean_search(s)
+        aggs_list = self._add_compute_aggs(s.aggs, compute_map)
+        self._debug_json("Built the following query: {}", s.to_dict())
+        return SearchRequest(s, str(index), lean=self._lean_queries), aggs_list
+
+    def _wrap_filters(self, output_dict, compute_map):
+        """
+        Returns output_dict nested under the k,v pairs of the compute map filters
+        """
+        filter_list = []
+        for key, value in compute_map["filter"].items():
+            filter_list.append(key)
+            filter_list.append(value)
+        # Include all k,v from filters as keys in the output dictionary
+        for key in reversed(filter_list):
+            output_dict = {key.split(".keyword")[0]: output_dict}
+        self._debug_json("output compute dictionary with summaries is: {}", output_dict)
+        return output_dict
+
+    def _emit_output_dict(self, response, compute_map, aggs_list, uuid):
+        """
+        Returns the normalized data from the raw ES response of a compute map
+        """
+        if self._lean_queries:
+            # Lean responses carry no hits, only the total hit count
+            if self._total_hits(response) == 0:
+                return {}
+        elif len(response["hits"]["hits"]) == 0:
+            return {}
+        output_dict = self._build_result_dict(
+            response.get("aggregations", {}), compute_map["buckets"], aggs_list, uuid
         )
-        response = s.execute()
-        logger.debug("Succesfully executed the search query")
+        return self._wrap_filters(output_dict, compute_map)
+
+    def _composite_pages(self, s, index, compute_map, sources, add_page):
+        """
+        Query steps requesting every page of a composite aggregation over
+        sources, a list of (name, field) pairs, carrying the aggregations of
+        the compute map, from index. The raw response of every page is passed to add_page
+        along with the list of aggregation names. Pages are requested with the
+        after_key of the previous one until one comes back short, so the
+        memory used per request is bounded by the page size
+        """
+        after = None
+        while True:
+            # extra returns a copy, so every page starts from the same search
+            page = s.extra(size=0)
+            params = {
+                "sources": [
+                    {name: {"terms": {"field": field}}} for name, field in sources
+                ],
+                "size": self._composite_size,
+            }
+            if after:
+                params["after"] = after
+            composite = page.aggs.bucket("_composite", "composite", **params)
+            aggs_list = self._add_compute_metrics(composite, compute_map)
+            self._debug_json("Built the following composite query: {}", page.to_dict())
+            response = yield SearchRequest(page, index, lean=self._lean_queries)
+            add_page(response, aggs_list)
+            composite_response = response["aggregations"]["_composite"]
+            after = composite_response.get("after_key")
+            # A page short of buckets is the last one
+            if len(composite_response["buckets"]) < self._composite_size or not after:
+                break
 
-        if len(response.hits.hits) == 0:
+    def _composite_compute_dict_steps(self, uuid, compute_map, index, identifier):
+        """
+        Query steps of the normalized data from the ES query, with the buckets
+        of the compute map paged through a composite aggregation
+        """
+        logger.debug("Initializing composite search object")
+        kw_identifier = identifier + ".keyword"  # append .keyword
+        s = Search(using=self._conn_object).query("match", **{kw_identifier: uuid})
+        s = self._apply_compute_filters(s, compute_map)
+        if self._lean_queries:
+            s = self._lean_search(s)
+        buckets = compute_map["buckets"]
+        bucket_names = [bucket.split(".keyword")[0] for bucket in buckets]
+        output_dict = {}
+        totals = []
+
+        def add_page(response, aggs_list):
+            totals.append(self._total_hits(response))
+            for bucket in response["aggregations"]["_composite"]["buckets"]:
+                self._add_composite_bucket(
+                    output_dict, bucket, bucket_names, aggs_list, uuid
+                )
+
+        yield from self._composite_pages(
+            s, str(index), compute_map, list(zip(bucket_names, buckets)), add_page
+        )
+        if totals[0] == 0:
             return {}
-        _output_dict = self.gen_result_dict(response, buckets, self._aggs_list, uuid)
-        if filters:
-            output_dict = _output_dict
-            filter_list = []
-            for key, value in filters.items():
-                filter_list.append(key)
-                filter_list.append(value)
-            # Include all k,v from filters as keys in the output dictionary
-            for key in reversed(filter_list):
-                output_dict = {key.split(".keyword")[0]: output_dict}
-        else:
-            output_dict = _output_dict
+        if not output_dict:
+            # Matching documents without bucket values, as the terms buckets report them
+            output_dict[bucket_names[0]] = {}
+        return self._wrap_filters(output_dict, compute_map)
+
+    def _compute_dict_steps(self, uuid, compute_map, index, identifier):
+        """
+        Query steps of emit_compute_dict
+        """
+        if self._composite_size:
+            return (
+                yield from self._composite_compute_dict_steps(
+                    uuid, compute_map, index, identifier
+                )
+            )
+        request, aggs_list = self._build_compute_search(
+            uuid, compute_map, index, identifier
+        )
+        response = yield request
+        logger.debug("Succesfully executed the search query")
+        return self._emit_output_dict(response, compute_map, aggs_list, uuid)
+
+    def emit_compute_dict(self, uuid, compute_map, index, identifier):
+        """
+        Returns the normalized data from the ES query
+        """
+        return self._run(
+            self._timed(
+                "emit_compute_dict",
+                [{"index": index, "compute_map": compute_map, "uuid": uuid}],
+                self._compute_dict_steps(uuid, compute_map, index, identifier),
+            )
+        )
+
+    def _compute_dicts_steps(self, queries):
+        """
+        Query steps of emit_compute_dicts
+        """
+        if self._composite_size:
+            # Every composite query pages on its own
+            results = []
+            for query in queries:
+                results.append((yield from self._compute_dict_steps(**query)))
+            return results
+        searches = []
+        aggs_lists = []
+        for query in queries:
+            request, aggs_list = self._build_compute_search(**query)
+            searches.append(request)
+            aggs_lists.append(aggs_list)
+        logger.debug("Sending {} searches in one _msearch request".format(len(queries)))
+        responses = yield searches
+        logger.debug("Succesfully executed the multi search query")
+        return [
+            self._emit_output_dict(
+                response, query["compute_map"], aggs_list, query["uuid"]
+            )
+            for response, query, aggs_list in zip(responses, queries, aggs_lists)
+        ]
+
+    def emit_compute_dicts(self, queries):
+        """
+        Returns the normalized data of every query in queries, a list of
+        emit_compute_dict keyword arguments, sent as a single _msearch request
+        """
+        return self._run(
+            self._timed(
+                "emit_compute_dicts", queries, self._compute_dicts_steps(queries),
+            )
+        )
+
+    def _compute_dicts_by_identifier_steps(self, uuids, compute_map, index, identifier):
+        """
+        Query steps of emit_compute_dicts_by_identifier
+        """
+        logger.debug("Initializing identifier bucketed search object")
+        kw_identifier = identifier + ".keyword"  # append .keyword
+        s = Search(using=self._conn_object).filter(
+            "terms", **{kw_identifier: list(uuids)}
+        )
+        s = self._apply_compute_filters(s, compute_map)
+        if self._lean_queries:
+            # Identifiers without data are told apart by their missing bucket
+            s = self._lean_search(s, track_total_hits=False)
+        if self._composite_size:
+            return (
+                yield from self._composite_compute_dicts_by_identifier_steps(
+                    s, uuids, compute_map, str(index), kw_identifier
+                )
+            )
+        identifier_bucket = s.aggs.bucket(
+            "_identifier", "terms", field=kw_identifier, size=len(uuids)
+        )
+        aggs_list = self._add_compute_aggs(identifier_bucket, compute_map)
+        self._debug_json("Built the following query: {}", s.to_dict())
+        response = yield SearchRequest(s, str(index), lean=self._lean_queries)
+        logger.debug("Succesfully executed the identifier bucketed search query")
+        identifier_buckets = {}
+        for bucket in response["aggregations"]["_identifier"]["buckets"]:
+            identifier_buckets[bucket["key"]] = bucket
+        results = []
+        for uuid in uuids:
+            # An identifier without bucket has no matching documents
+            if uuid not in identifier_buckets:
+                results.append({})
+                continue
+            output_dict = self._build_result_dict(
+                identifier_buckets[uuid], compute_map["buckets"], aggs_list, uuid
+            )
+            results.append(self._wrap_filters(output_dict, compute_map))
+        return results
+
+    def emit_compute_dicts_by_identifier(self, uuids, compute_map, index, identifier):
+        """
+        Returns the normalized data of the compute map for every identifier
+        value in uuids, computed by a single query with a terms filter over all
+        of them and a top-level bucket on the identifier, so the index is only
+        scanned once
+        """
+        return self._run(
+            self._timed(
+                "emit_compute_dicts_by_identifier",
+                [
+                    {"index": index, "compute_map": compute_map, "uuid": uuid}
+                    for uuid in uuids
+                ],
+                self._compute_dicts_by_identifier_steps(
+                    uuids, compute_map, index, identifier
+                ),
+            )
+        )
+
+    def _composite_compute_dicts_by_identifier_steps(
+        self, s, uuids, compute_map, index, kw_identifier
+    ):
+        """
+        Query steps of the normalized data of the compute map for every
+        identifier value in uuids, paging through a composite aggregation with
+        the identifier as its first source
+        """
+        buckets = compute_map["buckets"]
+        bucket_names = [bucket.split(".keyword")[0] for bucket in buckets]
+        sources = [("_identifier", kw_identifier)] + list(zip(bucket_names, buckets))
+        output_dicts = {}
+
+        def add_page(response, aggs_list):
+            for bucket in response["aggregations"]["_composite"]["buckets"]:
+                uuid = bucket["key"]["_identifier"]
+                self._add_composite_bucket(
+                    output_dicts.setdefault(uuid, {}),
+                    bucket,
+                    bucket_names,
+                    aggs_list,
+                    uuid,
+                )
+
+        yield from self._composite_pages(s, index, compute_map, sources, add_page)
+        results = []
+        for uuid in uuids:
+            # An identifier without buckets has no matching documents
+            if uuid not in output_dicts:
+                results.append({})
+                continue
+            results.append(self._wrap_filters(output_dicts[uuid], compute_map))
+        return results
+
+    def _fusion_groups(self, compute_maps):
+        """
+        Returns the compute maps grouped so that the maps of a group share
+        their buckets and never define the same aggregation name differently,
+        as a list of lists of positions in compute_maps
+        """
+        groups = []
+        for position, compute_map in enumerate(compute_maps):
+            metrics = {}
+            for key, agg_list in compute_map["aggregations"].items():
+                for aggs in agg_list:
+                    if isinstance(aggs, str):
+                        metrics["{}({})".format(aggs, key)] = aggs
+                    elif isinstance(aggs, dict):
+                        for dict_key, dict_value in aggs.items():
+                            metrics["{}({})".format(dict_key, key)] = json.dumps(
+                                dict_value, sort_keys=True
+                            )
+            for group in groups:
+                if group["buckets"] != compute_map["buckets"]:
+                    continue
+                if any(
+                    group["metrics"].get(name, metric) != metric
+                    for name, metric in metrics.items()
+                ):
+                    continue
+                group["metrics"].update(metrics)
+                group["positions"].append(position)
+                break
+            else:
+                groups.append(
+                    {
+                        "buckets": compute_map["buckets"],
+                        "metrics": metrics,
+                        "positions": [position],
+                    }
+                )
+        return [group["positions"] for group in groups]
+
+    def _filter_query(self, compute_map):
+        """
+        Returns the query matching the documents selected by the filters and
+        excludes of the compute map
+        """
+        must = [
+            Q("term", **{key: value}) for key, value in compute_map["filter"].items()
+        ]
+        must_not = [Q("match", **exclude) for exclude in compute_map.get("exclude", [])]
+        if not must and not must_not:
+            return Q("match_all")
+        return Q("bool", filter=must, must_not=must_not)
+
+    def _build_fused_search(self, uuids, compute_maps, index, identifier):
+        """
+        Returns the SearchRequest computing every compute map for every
+        identifier value in uuids, with a named filter per compute map as the
+        outer bucket, along with the aggregation names of every compute map.
+        The compute maps must share their buckets.
+        """
+        logger.debug("Initializing fused search object")
+        kw_identifier = identifier + ".keyword"  # append .keyword
+        s = Search(using=self._conn_object).filter(
+            "terms", **{kw_identifier: list(uuids)}
+        )
+        if self._lean_queries:
+            # Maps and identifiers without data have an empty bucket
+            s = self._lean_search(s, track_total_hits=False)
+        fused_bucket = s.aggs.bucket(
+            "_fused",
+            "filters",
+            filters={
+                str(position): self._filter_query(compute_map)
+                for position, compute_map in enumerate(compute_maps)
+            },
+        )
+        identifier_bucket = fused_bucket.bucket(
+            "_identifier", "terms", field=kw_identifier, size=len(uuids)
+        )
+        a = self._add_compute_buckets(identifier_bucket, compute_maps[0])
+        aggs_lists = [
+            self._add_compute_metrics(a, compute_map) for compute_map in compute_maps
+        ]
+        self._debug_json("Built the following query: {}", s.to_dict())
+        return SearchRequest(s, str(index), lean=self._lean_queries), aggs_lists
+
+    def _compute_dicts_fused_steps(self, queries):
+        """
+        Query steps of emit_compute_dicts_fused
+        """
+        if self._composite_size:
+            # Every composite query pages on its own
+            return (yield from self._compute_dicts_steps(queries))
+        index = queries[0]["index"]
+        identifier = queries[0]["identifier"]
+        # Distinct compute maps and uuids, in order of appearance
+        compute_maps = []
+        map_positions = {}
+        uuids = []
+        for query in queries:
+            if id(query["compute_map"]) not in map_positions:
+                map_positions[id(query["compute_map"])] = len(compute_maps)
+                compute_maps.append(query["compute_map"])
+            if query["uuid"] not in uuids:
+                uuids.append(query["uuid"])
+        groups = self._fusion_groups(compute_maps)
+        searches = []
+        map_aggs = {}
+        for group in groups:
+            request, aggs_lists = self._build_fused_search(
+                uuids, [compute_maps[position] for position in group], index, identifier
+            )
+            searches.append(request)
+            for group_position, position in enumerate(group):
+                map_aggs[position] = aggs_lists[group_position]
         logger.debug(
-            "output compute dictionary with summaries is: {}".format(
-                json.dumps(output_dict, indent=4)
+            "Sending {} fused searches for {} compute maps".format(
+                len(groups), len(compute_maps)
             )
         )
-        return output_dict
+        responses = yield searches
+        logger.debug("Succesfully executed the fused search query")
+        # Identifier buckets of every compute map, keyed by identifier value
+        map_buckets = {}
+        for group, response in zip(groups, responses):
+            filter_buckets = response["aggregations"]["_fused"]["buckets"]
+            for group_position, position in enumerate(group):
+                filter_bucket = filter_buckets[str(group_position)]
+                map_buckets[position] = {
+                    bucket["key"]: bucket
+                    for bucket in filter_bucket["_identifier"]["buckets"]
+                }
+        results = []
+        for query in queries:
+            position = map_positions[id(query["compute_map"])]
+            identifier_buckets = map_buckets[position]
+            # A filter without documents for the identifier has no bucket for it
+            if query["uuid"] not in identifier_buckets:
+                results.append({})
+                continue
+            output_dict = self._build_result_dict(
+                identifier_buckets[query["uuid"]],
+                query["compute_map"]["buckets"],
+                map_aggs[position],
+                query["uuid"],
+            )
+            results.append(self._wrap_filters(output_dict, query["compute_map"]))
+        return results
+
+    def emit_compute_dicts_fused(self, queries):
+        """
+        Returns the normalized data of every query in queries, a list of
+        emit_compute_dict keyword arguments sharing their index and identifier.
+        Compute maps with the same buckets are computed together by a single
+        query for all of their identifier values, and the queries of every
+        group are sent as one _msearch request
+        """
+        return self._run(
+            self._timed(
+                "emit_compute_dicts_fused",
+                queries,
+                self._compute_dicts_fused_steps(queries),
+            )
+        )
+
+    def _baseline_runs_steps(
+        self, index, identifier, time_field, last, since, until, match, exclude
+    ):
+        """
+        Query steps of emit_baseline_runs
+        """
+        kw_identifier = identifier + ".keyword"  # append .keyword
+        s = Search(using=self._conn_object)
+        if exclude:
+            # Candidates are never part of their own baseline
+            s = s.exclude("terms", **{kw_identifier: list(exclude)})
+        for key, value in (match or {}).items():
+            s = s.filter("term", **{key: value})
+        if since or until:
+            time_range = {}
+            if since:
+                time_range["gte"] = since
+            if until:
+                time_range["lte"] = until
+            s = s.filter("range", **{time_field: time_range})
+        s = self._lean_search(s, track_total_hits=False)
+        # Runs ordered by their latest document
+        s.aggs.bucket(
+            "_runs",
+            "terms",
+            field=kw_identifier,
+            size=last or BASELINE_MAX_RUNS,
+            order={"_latest": "desc"},
+        ).metric("_latest", "max", field=time_field)
+        self._debug_json("Built the following run selection query: {}", s.to_dict())
+        response = yield SearchRequest(s, str(index), lean=True)
+        return [
+            bucket["key"] for bucket in response["aggregations"]["_runs"]["buckets"]
+        ]
+
+    def emit_baseline_runs(
+        self,
+        index,
+        identifier,
+        time_field,
+        last=None,
+        since=None,
+        until=None,
+        match=None,
+        exclude=None,
+    ):
+        """
+        Returns the identifier values of the runs in index, latest first, at
+        most the last ones, with a time_field between since and until, which
+        may use date math such as now-7d, and the term values of match,
+        leaving out the identifier values of exclude
+        """
+        return self._run(
+            self._timed(
+                "emit_baseline_runs",
+                [{"index": index, "uuid": None}],
+                self._baseline_runs_steps(
+                    index, identifier, time_field, last, since, until, match, exclude
+                ),
+            )
+        )
+
+    def _baseline_dict_steps(self, runs, compute_map, index, identifier, percents):
+        """
+        Query steps of emit_baseline_dict
+        """
+        logger.debug("Initializing baseline search object")
+        kw_identifier = identifier + ".keyword"  # append .keyword
+        s = Search(using=self._conn_object).filter(
+            "terms", **{kw_identifier: list(runs)}
+        )
+        s = self._apply_compute_filters(s, compute_map)
+        s = self._lean_search(s)
+        innermost = self._add_compute_buckets(s.aggs, compute_map)
+        run_bucket = innermost.bucket(
+            "_runs", "terms", field=kw_identifier, size=len(runs)
+        )
+        # Metrics are renamed, as buckets paths can not hold their names
+        stats = []
+        for position, (name, agg_type, params) in enumerate(
+            self._compute_metrics(compute_map)
+        ):
+            metric = "_m{}".format(position)
+            if agg_type in KEYED_VALUES_PARAMS:
+                # Every percentile or rank of the runs is reduced on its own
+                paths = [
+                    (
+                        "{}{}".format(float(value), name),
+                        "{}[{}]".format(metric, float(value)),
+                    )
+                    for value in params.get(KEYED_VALUES_PARAMS[agg_type], [])
+                ]
+            elif agg_type in MULTI_VALUE_AGGS:
+                # Compute results have no value for them either
+                logger.warning(
+                    "Ignoring aggregation {} in the baseline, {} has no single value".format(
+                        name, agg_type
+                    )
+                )
+                continue
+            else:
+                paths = [(name, metric)]
+            run_bucket.metric(metric, agg_type, **params)
+            for output_name, path in paths:
+                stat = "_s{}".format(len(stats))
+                innermost.pipeline(
+                    stat, "extended_stats_bucket", buckets_path="_runs>" + path
+                )
+                innermost.pipeline(
+                    stat + "_percentiles",
+                    "percentiles_bucket",
+                    buckets_path="_runs>" + path,
+                    percents=percents,
+                )
+                stats.append((output_name, stat))
+        self._debug_json("Built the following baseline query: {}", s.to_dict())
+        response = yield SearchRequest(s, str(index), lean=True)
+        logger.debug("Succesfully executed the baseline search query")
+        if self._total_hits(response) == 0:
+            return {}
+
+        def add_values(input_level, output_level):
+            for output_name, stat in stats:
+                # Buckets without any value in every run have no statistics
+                if stat not in input_level or not input_level[stat]["count"]:
+                    continue
+                stat_values = input_level[stat]
+                percentiles = input_level[stat + "_percentiles"]["values"]
+                output_level[output_name] = baseline_values(
+                    stat_values["count"],
+                    stat_values["avg"],
+                    stat_values["std_deviation"],
+                    stat_values["min"],
+                    stat_values["max"],
+                    {
+                        percent: percentiles.get(str(float(percent)))
+                        for percent in percents
+                    },
+                )
+
+        output_dict = self._build_result_dict(
+            response.get("aggregations", {}),
+            compute_map["buckets"],
+            None,
+            None,
+            add_values=add_values,
+        )
+        return self._wrap_filters(output_dict, compute_map)
+
+    def emit_baseline_dict(self, runs, compute_map, index, identifier, percents):
+        """
+        Returns the statistics of every metric of the compute map over the
+        identifier values in runs, computed by a single query with the runs
+        as the innermost bucket and sibling pipeline aggregations reducing
+        them, so the values of every run never leave elasticsearch
+        """
+        return self._run(
+            self._timed(
+                "emit_baseline_dict",
+                [
+                    {"index": index, "compute_map": compute_map, "uuid": run}
+                    for run in runs
+                ],
+                self._baseline_dict_steps(
+                    runs, compute_map, index, identifier, percents
+                ),
+            )
+        )
+
+    def _all_hits_steps(self, s, index, add_hits):
+        """
+        Query steps passing every hit of the search object on index to
+        add_hits, a page at a time. Pages are read from a point in time with
+        search_after, or from a scroll on clusters without point in time
+        """
+        try:
+            reply = yield ApiRequest(
+                "open_point_in_time", index=index, keep_alive=PAGING_KEEP_ALIVE
+            )
+        except Exception as err:
+            if not paging_unsupported(err):
+                raise
+            logger.debug("Point in time unsupported, scrolling: {}".format(err))
+            return (yield from self._scroll_hits_steps(s, index, add_hits))
+        pit_id = reply["id"]
+        search_after = None
+        scroll = False
+        try:
+            while True:
+                page = s.extra(
+                    size=METADATA_PAGE_SIZE,
+                    pit={"id": pit_id, "keep_alive": PAGING_KEEP_ALIVE},
+                    sort=["_shard_doc"],
+                )
+                if search_after:
+                    page = page.extra(search_after=search_after)
+                try:
+                    # The point in time carries the index
+                    response = yield SearchRequest(page, None)
+                except Exception as err:
+                    # Clusters before 7.12 have point in time but no _shard_doc
+                    if search_after or not paging_unsupported(err):
+                        raise
+                    logger.debug(
+                        "Point in time paging unsupported, scrolling: {}".format(err)
+                    )
+                    scroll = True
+                    break
+                pit_id = response.get("pit_id", pit_id)
+                hits = response["hits"]["hits"]
+                add_hits(hits)
+                if len(hits) < METADATA_PAGE_SIZE:
+                    break
+                search_after = hits[-1]["sort"]
+        except GeneratorExit:
+            # Steps closed before their end can't send requests, the point
+            # in time expires after its keep alive
+            pit_id = None
+            raise
+        finally:
+            if pit_id:
+                yield from self._release_steps(
+                    ApiRequest("close_point_in_time", body={"id": pit_id})
+                )
+        if scroll:
+            return (yield from self._scroll_hits_steps(s, index, add_hits))
+
+    def _scroll_hits_steps(self, s, index, add_hits):
+        """
+        Query steps passing every hit of the search object on index to
+        add_hits, a page at a time, scrolling through them
+        """
+        response = yield SearchRequest(
+            s.extra(size=METADATA_PAGE_SIZE, sort=["_doc"]),
+            index,
+            scroll=PAGING_KEEP_ALIVE,
+        )
+        scroll_id = response.get("_scroll_id")
+        try:
+            while response["hits"]["hits"]:
+                add_hits(response["hits"]["hits"])
+                response = yield ApiRequest(
+                    "scroll", scroll_id=scroll_id, scroll=PAGING_KEEP_ALIVE
+                )
+                scroll_id = response.get("_scroll_id", scroll_id)
+        except GeneratorExit:
+            scroll_id = None
+            raise
+        finally:
+            if scroll_id:
+                yield from self._release_steps(
+                    ApiRequest("clear_scroll", scroll_id=scroll_id)
+                )
+
+    def _release_steps(self, request):
+        """
+        Query steps sending request, freeing a point in time or scroll. The
+        cluster frees it anyway after its keep alive, so a failure is only
+        logged and doesn't hide the error of the paging.
+        """
+        try:
+            yield request
+        except Exception as err:
+            logger.warning("Request {} failed: {}".format(request.method, err))
+
+    def _compare_metadata_dicts_steps(self, uuids, compare_map, index, input_dicts):
+        """
+        Query steps of emit_compare_metadata_dicts, adding the metadata of
+        every uuid to its dictionary of input_dicts
+        """
+        logger.debug("Initializing metadata search object")
+        output_dicts = {}
+        for uuid, input_dict in zip(uuids, input_dicts):
+            output_dicts.setdefault(uuid, input_dict)
+        # Only the fields of the compare map are fetched
+        fields = ["uuid", compare_map["element"]] + list(compare_map["compare"])
+        s = (
+            Search(using=self._conn_object)
+            .filter("terms", **{"uuid.keyword": list(output_dicts)})
+            .source(fields)
+        )
+
+        def add_hits(hits):
+            for hit in hits:
+                input_dict = output_dicts.get(hit["_source"].get("uuid"))
+                if input_dict is None:
+                    continue
+                compare_by = self.access_nested_field(
+                    hit["_source"], compare_map["element"]
+                )
+                if compare_by not in input_dict:
+                    input_dict[compare_by] = {}
+                for compare in compare_map["compare"]:
+                    value = self.access_nested_field(hit["_source"], compare)
+                    if value:
+                        input_dict[compare_by][compare] = value
+
+        yield from self._all_hits_steps(s, index, add_hits)
+        return [output_dicts[uuid] for uuid in uuids]
 
     def emit_compare_metadata_dict(
         self, uuid=None, compare_map=None, index=None, input_dict=None
     ):
-        logger.debug("Initializing metadata search object")
-        s = Search(using=self._conn_object, index=index).query(
-            "match", **{"uuid.keyword": uuid}
-        )
-        response = s.execute()
-        for hit in response.hits.hits:
-            compare_by = self.access_nested_field(
-                hit["_source"], compare_map["element"]
-            )
-            if compare_by not in input_dict:
-                input_dict[compare_by] = {}
-            for compare in compare_map["compare"]:
-                value = self.access_nested_field(hit["_source"], compare)
-                if value:
-                    input_dict[compare_by][compare] = hit["_source"]["value"][
-                        compare
-                    ] = value
-        return input_dict
+        if input_dict is None:
+            input_dict = {}
+        return self._run(
+            self._timed(
+                "emit_compare_metadata_dict",
+                [{"index": index, "uuid": uuid}],
+                self._compare_metadata_dicts_steps(
+                    [uuid], compare_map, index, [input_dict]
+                ),
+            )
+        )[0]
+
+    def emit_compare_metadata_dicts(self, uuids, compare_map, index):
+        """
+        Returns the metadata of every uuid in uuids, read from every matching
+        document of index, paging through the documents of all of them at once
+        """
+        return self._run(
+            self._timed(
+                "emit_compare_metadata_dicts",
+                [{"index": index, "uuid": uuid} for uuid in uuids],
+                self._compare_metadata_dicts_steps(
+                    uuids, compare_map, index, [{} for _ in uuids]
+                ),
+            )
+        )
+
+    def emit_documents(self, index, field, value, scroll_size=1000):
+        """
+        Yields the source of every document of the index whose field matches
+        value, scrolling through all of them
+        """
+        logger.debug(
+            "Scrolling documents of {} where {}={}".format(index, field, value)
+        )
+        query = {"query": {"match": {field: value}}}
+        for hit in elasticsearch.helpers.scan(
+            self._conn_object, query=query, index=index, size=scroll_size
+        ):
+            yield hit["_source"]
 
     def access_nested_field(self, d, fields):
         tmp_dict = d
@@ -0,0 +1,255 @@
+import functools
+import logging
+import threading
+
+try:
+    from elasticsearch import AsyncElasticsearch
+except ImportError:  # pragma: no cover
+    AsyncElasticsearch = None
+
+from .elasticsearch import (
+    ApiRequest,
+    Elasticsearch,
+    DEFAULT_POOL_SIZE,
+    DEFAULT_TIMEOUT,
+    rejected,
+)
+from .limiter import limited_async
+from .resilience import call_with_policy_async
+from ..utils.lib import run_coroutine
+
+logger = logging.getLogger("touchstone")
+
+# Shared asynchronous clients, keyed by connection url and retries
+_connections = {}
+_connections_lock = threading.Lock()
+
+
+def get_connection(
+    conn_url,
+    pool_size=DEFAULT_POOL_SIZE,
+    timeout=DEFAULT_TIMEOUT,
+    http_compress=False,
+    max_retries=3,
+):
+    """
+    Returns the shared asynchronous client for conn_url, creating it on
+    first use. Its requests run on the background event loop of
+    touchstone.utils.lib, so a single thread keeps every query in flight.
+    """
+    if AsyncElasticsearch is None:
+        raise ImportError(
+            "AsyncElasticsearch requires aiohttp, install touchstone[async]"
+        )
+    key = (conn_url, max_retries)
+    with _connections_lock:
+        if key not in _connections:
+            logger.debug("Creating async connection object for {}".format(conn_url))
+            _connections[key] = AsyncElasticsearch(
+                [conn_url],
+                send_get_body_as="POST",
+                maxsize=pool_size,
+                timeout=timeout,
+                http_compress=http_compress,
+                max_retries=max_retries,
+            )
+        return _connections[key]
+
+
+async def _close(conn_objects):
+    for conn_object in conn_objects:
+        await conn_object.close()
+
+
+def close_connections():
+    """
+    Closes and forgets every shared asynchronous client
+    """
+    with _connections_lock:
+        conn_objects = list(_connections.values())
+        _connections.clear()
+    if conn_objects:
+        run_coroutine(_close(conn_objects))
+
+
+class ElasticsearchAsync(Elasticsearch):
+    """
+    Elasticsearch database sending its queries with AsyncElasticsearch.
+    Every emit_*_async coroutine awaits its requests instead of blocking a
+    thread, so many queries can be in flight from a single thread, while
+    the synchronous methods run them on the background event loop and wait,
+    so the database can be used anywhere Elasticsearch is.
+    """
+
+    def __init__(self, *args, **kwargs):
+        Elasticsearch.__init__(self, *args, **kwargs)
+        self._async_conn_objects = [
+            get_connection(
+                url,
+                pool_size=self._pool_size,
+                timeout=self._timeout,
+                http_compress=self._http_compress,
+                max_retries=0 if self._policy.retries else 3,
+            )
+            for url in [self._conn_url] + self._policy.hedge_urls
+        ]
+
+    async def _call_async(self, request, hedge=True):
+        """
+        Returns the reply of request, a coroutine function sending a request
+        with the client and keyword arguments it is given, applying the
+        request policy of the connection url. Without hedge, the request is
+        only ever sent to the connection url.
+        """
+        params = self._policy.request_params()
+        conn_objects = self._async_conn_objects
+        if not hedge:
+            conn_objects = conn_objects[:1]
+        sends = [
+            functools.partial(request, conn_object, **params)
+            for conn_object in conn_objects
+        ]
+        if self._limiters:
+            sends = [
+                limited_async(limiter, send, rejected)
+                for limiter, send in zip(self._limiters, sends)
+            ]
+        return await call_with_policy_async(self._policy, sends)
+
+    async def _run_async(self, steps):
+        """
+        Runs the query steps of a database call, awaiting every request,
+        and returns its result
+        """
+        try:
+            request = next(steps)
+            while True:
+                try:
+                    reply = await self._send_async(request)
+                except Exception as err:
+                    request = steps.throw(err)
+                else:
+                    request = steps.send(reply)
+        except StopIteration as stop:
+            return stop.value
+
+    async def _send_async(self, request):
+        if isinstance(request, list):
+            return await self._msearch_async(request)
+        if isinstance(request, ApiRequest):
+            return await self._api_async(request)
+        return await self._search_async(request)
+
+    async def _search_async(self, request):
+        body = request.search.to_dict()
+        return await self._call_async(
+            lambda conn_object, **params: conn_object.search(
+                index=request.index, body=body, **request.params, **params
+            ),
+            hedge=self._hedgeable(request, body),
+        )
+
+    async def _api_async(self, request):
+        return await self._call_async(
+            lambda conn_object, **params: getattr(conn_object, request.method)(
+                **request.params, **params
+            ),
+            hedge=False,
+        )
+
+    async def _msearch_async(self, searches):
+        body, msearch_params = self._msearch_request(searches)
+
+        async def send(conn_object, **params):
+            return self._msearch_responses(
+                await conn_object.msearch(body=body, **msearch_params, **params)
+            )
+
+        return await self._call_async(send)
+
+    def _run(self, steps):
+        return run_coroutine(self._run_async(steps))
+
+    async def emit_compute_dict_async(self, uuid, compute_map, index, identifier):
+        return await self._run_async(
+            self._timed(
+                "emit_compute_dict",
+                [{"index": index, "compute_map": compute_map, "uuid": uuid}],
+                self._compute_dict_steps(uuid, compute_map, index, identifier),
+            )
+        )
+
+    async def emit_compute_dicts_async(self, queries):
+        return await self._run_async(
+            self._timed(
+                "emit_compute_dicts", queries, self._compute_dicts_steps(queries)
+            )
+        )
+
+    async def emit_compute_dicts_by_identifier_async(
+        self, uuids, compute_map, index, identifier
+    ):
+        return await self._run_async(
+            self._timed(
+                "emit_compute_dicts_by_identifier",
+                [
+                    {"index": index, "compute_map": compute_map, "uuid": uuid}
+                    for uuid in uuids
+                ],
+                self._compute_dicts_by_identifier_steps(
+                    uuids, compute_map, index, identifier
+                ),
+            )
+        )
+
+    async def emit_compute_dicts_fused_async(self, queries):
+        return await self._run_async(
+            self._timed(
+                "emit_compute_dicts_fused",
+                queries,
+                self._compute_dicts_fused_steps(queries),
+            )
+        )
+
+    async def emit_baseline_dict_async(
+        self, runs, compute_map, index, identifier, percents
+    ):
+        return await self._run_async(
+            self._timed(
+                "emit_baseline_dict",
+                [
+                    {"index": index, "compute_map": compute_map, "uuid": run}
+                    for run in runs
+                ],
+                self._baseline_dict_steps(
+                    runs, compute_map, index, identifier, percents
+                ),
+            )
+        )
+
+    async def emit_compare_metadata_dict_async(
+        self, uuid=None, compare_map=None, index=None, input_dict=None
+    ):
+        if input_dict is None:
+            input_dict = {}
+        results = await self._run_async(
+            self._timed(
+                "emit_compare_metadata_dict",
+                [{"index": index, "uuid": uuid}],
+                self._compare_metadata_dicts_steps(
+                    [uuid], compare_map, index, [input_dict]
+                ),
+            )
+        )
+        return results[0]
+
+    async def emit_compare_metadata_dicts_async(self, uuids, compare_map, index):
+        return await self._run_async(
+            self._timed(
+                "emit_compare_metadata_dicts",
+                [{"index": index, "uuid": uuid} for uuid in uuids],
+                self._compare_metadata_dicts_steps(
+                    uuids, compare_map, index, [{} for _ in uuids]
+                ),
+            )
+        )
@@ -0,0 +1,208 @@
+import collections
+import threading
+import time
+
+
+# Latencies under this many seconds never count as congestion
+MIN_LATENCY_THRESHOLD = 0.05
+# Weight of every reply in the smoothed latency, and how many times slower
+# than it a reply counts as slow
+LATENCY_SMOOTHING = 0.1
+SLOW_LATENCY_RATIO = 2
+
+# Shared limiters, keyed by connection url
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+class AdaptiveLimiter:
+    """
+    Additive increase, multiplicative decrease limit of the requests in
+    flight to a connection url. Every successful reply raises the limit, by
+    one while starting and then by one per limit replies, up to ceiling. A
+    rejected request, or a reply slower than latency_threshold seconds,
+    multiplies the limit by decrease instead. Without latency_threshold, a
+    reply is slow when it takes over twice the moving average of the
+    latencies of the replies before it, so queries of different costs don't
+    count as congestion.
+    Threads wait in acquire and coroutines in acquire_async for a free slot.
+    """
+
+    def __init__(self, ceiling, latency_threshold=None, decrease=0.5):
+        self._ceiling = ceiling
+        self._latency_threshold = latency_threshold
+        self._decrease = decrease
+        self._limit = 1.0
+        self._slow_start = True
+        self._smoothed_latency = None
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+        self._async_waiters = collections.deque()
+        # Figures of the report
+        self._peak_limit = 1
+        self._peak_in_flight = 0
+        self._requests = 0
+        self._rejections = 0
+        self._slow = 0
+
+    def _slots(self):
+        return max(1, int(self._limit))
+
+    def _take_slot(self):
+        self._in_flight += 1
+        self._peak_in_flight = max(self._peak_in_flight, self._in_flight)
+
+    def acquire(self):
+        """
+        Waits for a free slot and takes it
+        """
+        with self._condition:
+            while self._in_flight >= self._slots():
+                self._condition.wait()
+            self._take_slot()
+
+    async def acquire_async(self):
+        """
+        Coroutine waiting for a free slot and taking it
+        """
+        import asyncio
+
+        with self._lock:
+            if self._in_flight < self._slots() and not self._async_waiters:
+                self._take_slot()
+                return
+            waiter = asyncio.get_running_loop().create_future()
+            self._async_waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            with self._lock:
+                if waiter in self._async_waiters:
+                    self._async_waiters.remove(waiter)
+                    raise
+            # The slot was handed over while being cancelled
+            self._release_slot()
+            raise
+
+    def _wake(self, waiter):
+        if not waiter.cancelled():
+            waiter.set_result(None)
+
+    def _release_slot(self):
+        with self._condition:
+            self._in_flight -= 1
+            # Waiting coroutines get the free slots first, then threads
+            while self._async_waiters and self._in_flight < self._slots():
+                waiter = self._async_waiters.popleft()
+                self._take_slot()
+                waiter.get_loop().call_soon_threadsafe(self._wake, waiter)
+            self._condition.notify_all()
+
+    def release(self, latency, rejected=False):
+        """
+        Frees a slot taken for a request that took latency seconds and
+        adjusts the limit, decreasing it if the request was rejected
+        """
+        with self._lock:
+            self._requests += 1
+            threshold = self._latency_threshold
+            if threshold is None:
+                if self._smoothed_latency is None:
+                    self._smoothed_latency = latency
+                threshold = max(
+                    SLOW_LATENCY_RATIO * self._smoothed_latency, MIN_LATENCY_THRESHOLD
+                )
+                if not rejected:
+                    self._smoothed_latency += LATENCY_SMOOTHING * (
+                        latency - self._smoothed_latency
+                    )
+            if rejected or latency > threshold:
+                if rejected:
+                    self._rejections += 1
+                else:
+                    self._slow += 1
+                self._slow_start = False
+                self._limit = max(1.0, self._limit * self._decrease)
+            elif self._slow_start:
+                self._limit = min(self._ceiling, self._limit + 1)
+            else:
+                self._limit = min(self._ceiling, self._limit + 1 / self._limit)
+            self._peak_limit = max(self._peak_limit, self._slots())
+        self._release_slot()
+
+    def report(self):
+        """
+        Returns the figures of the limiter: the current and highest limits,
+        the most requests in flight at once, and the count of requests, of
+        rejections and of slow replies
+        """
+        with self._lock:
+            return {
+                "limit": self._slots(),
+                "peak_limit": self._peak_limit,
+                "peak_in_flight": self._peak_in_flight,
+                "requests": self._requests,
+                "rejections": self._rejections,
+                "slow": self._slow,
+            }
+
+
+def get_limiter(conn_url, ceiling, latency_threshold=None):
+    """
+    Returns the shared limiter of conn_url, creating it on first use
+    """
+    with _limiters_lock:
+        if conn_url not in _limiters:
+            _limiters[conn_url] = AdaptiveLimiter(
+                ceiling, latency_threshold=latency_threshold
+            )
+        return _limiters[conn_url]
+
+
+def limiter_reports():
+    """
+    Returns the report of every shared limiter, keyed by connection url
+    """
+    with _limiters_lock:
+        limiters = dict(_limiters)
+    return {conn_url: limiter.report() for conn_url, limiter in limiters.items()}
+
+
+def limited(limiter, send, rejected):
+    """
+    Returns a function calling send within a slot of limiter, rejected
+    telling from the error raised or the reply whether it was rejected
+    """
+
+    def call():
+        limiter.acquire()
+        start = time.monotonic()
+        try:
+            reply = send()
+        except Exception as err:
+            limiter.release(time.monotonic() - start, rejected=rejected(err))
+            raise
+        limiter.release(time.monotonic() - start, rejected=rejected(reply))
+        return reply
+
+    return call
+
+
+def limited_async(limiter, send, rejected):
+    """
+    Coroutine function version of limited, send being a coroutine function
+    """
+
+    async def call():
+        await limiter.acquire_async()
+        start = time.monotonic()
+        try:
+            reply = await send()
+        except BaseException as err:
+            limiter.release(time.monotonic() - start, rejected=rejected(err))
+            raise
+        limiter.release(time.monotonic() - start, rejected=rejected(reply))
+        return reply
+
+    return call
@@ -0,0 +1,249 @@
+import json
+import logging
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+logger = logging.getLogger("touchstone")
+
+# Statuses of overloaded or unavailable clusters, worth sending again
+RETRY_STATUSES = (429, 502, 503, 504)
+POLICY_KEYS = (
+    "timeout",
+    "retries",
+    "backoff",
+    "max_backoff",
+    "hedge_after",
+    "hedge_urls",
+)
+
+# Threads sending the requests of hedged queries, at least as many as
+# reserved by the databases hedging them
+DEFAULT_HEDGE_WORKERS = 32
+_hedge_executor = None
+_hedge_executor_workers = 0
+_hedge_workers = DEFAULT_HEDGE_WORKERS
+_hedge_executor_lock = threading.Lock()
+
+
+def reserve_hedge_workers(count):
+    """
+    Makes sure hedged queries are sent by at least count threads, enough
+    for every query sent at the same time and its duplicates
+    """
+    global _hedge_workers
+    with _hedge_executor_lock:
+        _hedge_workers = max(_hedge_workers, count)
+
+
+def _executor():
+    global _hedge_executor, _hedge_executor_workers
+    with _hedge_executor_lock:
+        if _hedge_executor_workers < _hedge_workers:
+            if _hedge_executor is not None:
+                # Requests already submitted still get their reply
+                _hedge_executor.shutdown(wait=False)
+            _hedge_executor = ThreadPoolExecutor(
+                max_workers=_hedge_workers, thread_name_prefix="touchstone-hedge"
+            )
+            _hedge_executor_workers = _hedge_workers
+        return _hedge_executor
+
+
+class RequestPolicy:
+    """
+    How the queries of a connection url are sent. Every request waits at
+    most timeout seconds, failed requests are sent again up to retries
+    times after an exponential backoff with full jitter, and when hedge_after
+    is set a request still running after that many seconds is duplicated to
+    the hedge_urls, the first reply winning.
+    """
+
+    def __init__(
+        self,
+        timeout=None,
+        retries=0,
+        backoff=0.1,
+        max_backoff=10,
+        hedge_after=None,
+        hedge_urls=(),
+    ):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedge_after = hedge_after
+        self.hedge_urls = list(hedge_urls)
+
+    def request_params(self):
+        """
+        Returns the keyword arguments applying the policy to a client call
+        """
+        if self.timeout is None:
+            return {}
+        return {"request_timeout": self.timeout}
+
+    def retryable(self, err):
+        """
+        Returns whether the request failing with err is worth sending again
+        """
+        # Imported here, loading policies doesn't need the client
+        import elasticsearch
+
+        # ConnectionTimeout is a ConnectionError
+        if isinstance(err, elasticsearch.ConnectionError):
+            return True
+        if not isinstance(err, elasticsearch.TransportError):
+            return False
+        return err.status_code in RETRY_STATUSES
+
+    def delay(self, attempt):
+        """
+        Returns the seconds to wait before sending again a request that
+        failed attempt times
+        """
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def hedged(self):
+        return self.hedge_after is not None and bool(self.hedge_urls)
+
+
+def load_connection_config(config_file):
+    """
+    Returns the request policy of every connection url from a json file
+    mapping connection urls to policy settings. The settings under "default"
+    apply to every url, and the ones of a url override them.
+    """
+    config = json.load(config_file)
+    defaults = config.get("default", {})
+    policies = {}
+    for conn_url, settings in config.items():
+        for key in list(defaults) + list(settings):
+            if key not in POLICY_KEYS:
+                raise ValueError(
+                    "Unknown connection setting {} for {}".format(key, conn_url)
+                )
+        policies[conn_url] = RequestPolicy(**dict(defaults, **settings))
+    if "default" not in policies:
+        policies["default"] = RequestPolicy()
+    return policies
+
+
+def policy_for(policies, conn_url):
+    """
+    Returns the request policy of conn_url, the default one if it has none
+    """
+    if not policies:
+        return RequestPolicy()
+    return policies.get(conn_url, policies["default"])
+
+
+def _hedge(policy, sends):
+    started = threading.Event()
+
+    def send_primary():
+        started.set()
+        return sends[0]()
+
+    primary = _executor().submit(send_primary)
+    # Time spent queued for a thread doesn't count, the request isn't sent yet
+    started.wait()
+    done, _ = wait([primary], timeout=policy.hedge_after)
+    if done:
+        return primary.result()
+    logger.debug(
+        "Request slower than {}s, hedging it to {}".format(
+            policy.hedge_after, ", ".join(policy.hedge_urls)
+        )
+    )
+    pending = {primary} | {_executor().submit(send) for send in sends[1:]}
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                # Losing requests can't be interrupted, their replies are dropped
+                return future.result()
+            error = future.exception()
+    raise error
+
+
+def call_with_policy(policy, sends):
+    """
+    Returns the reply of the first send, a list of functions sending the
+    same request to the connection url and then to every hedge url, applying
+    the retries and hedging of the policy
+    """
+    attempt = 0
+    while True:
+        try:
+            if policy.hedged() and len(sends) > 1:
+                return _hedge(policy, sends)
+            return sends[0]()
+        except Exception as err:
+            if attempt >= policy.retries or not policy.retryable(err):
+                raise
+            delay = policy.delay(attempt)
+            attempt += 1
+            logger.debug(
+                "Request failed with {}, retry {} in {:.2f}s".format(
+                    err, attempt, delay
+                )
+            )
+            time.sleep(delay)
+
+
+async def _hedge_async(policy, sends):
+    import asyncio
+
+    primary = asyncio.ensure_future(sends[0]())
+    done, _ = await asyncio.wait([primary], timeout=policy.hedge_after)
+    if done:
+        return primary.result()
+    logger.debug(
+        "Request slower than {}s, hedging it to {}".format(
+            policy.hedge_after, ", ".join(policy.hedge_urls)
+        )
+    )
+    pending = {primary} | {asyncio.ensure_future(send()) for send in sends[1:]}
+    error = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def call_with_policy_async(policy, sends):
+    """
+    Coroutine of call_with_policy, sends being coroutine functions
+    """
+    import asyncio
+
+    attempt = 0
+    while True:
+        try:
+            if policy.hedged() and len(sends) > 1:
+                return await _hedge_async(policy, sends)
+            return await sends[0]()
+        except Exception as err:
+            if attempt >= policy.retries or not policy.retryable(err):
+                raise
+            delay = policy.delay(attempt)
+            attempt += 1
+            logger.debug(
+                "Request failed with {}, retry {} in {:.2f}s".format(
+                    err, attempt, delay
+                )
+            )
+            await asyncio.sleep(delay)
@@ -0,0 +1,87 @@
+import logging
+import os
+import threading
+
+import numpy as np
+
+from . import DatabaseBaseClass
+from ..utils.aggregate import Table, compute_dict
+from ..utils.columnar import read_snapshot
+
+
+logger = logging.getLogger("touchstone")
+
+# Loaded snapshots and the modification time they were read at, keyed by
+# file path
+_snapshots = {}
+_snapshots_lock = threading.Lock()
+
+
+def load_snapshot(path):
+    """
+    Returns the indices of the snapshot file as tables keyed by index,
+    along with the modification time of the file, reading it on first use
+    and again once the file is written again
+    """
+    mtime = os.stat(path).st_mtime_ns
+    with _snapshots_lock:
+        if path not in _snapshots or _snapshots[path][1] != mtime:
+            logger.debug("Loading snapshot {}".format(path))
+            tables = {
+                index: Table(snapshot_index["columns"], snapshot_index["count"])
+                for index, snapshot_index in read_snapshot(path).items()
+            }
+            _snapshots[path] = (tables, mtime)
+        return _snapshots[path]
+
+
+class Snapshot(DatabaseBaseClass):
+    """
+    File backed database answering queries from a snapshot written by
+    touchstone_snapshot, conn_url being the path of the snapshot file
+    """
+
+    def __init__(self, conn_url=None, cache=None, cache_scope=None):
+        logger.debug("Initializing Snapshot object")
+        DatabaseBaseClass.__init__(
+            self, conn_url=conn_url, cache=cache, cache_scope=cache_scope
+        )
+        self._indices, self._mtime = load_snapshot(conn_url)
+        logger.debug("Finished Initializing Snapshot object")
+
+    def _cache_source(self):
+        # Results only change with the snapshot, as loaded
+        return [self._conn_url, self._mtime]
+
+    def _table(self, index):
+        return self._indices.get(index, Table({}, 0))
+
+    def emit_compute_dict(self, uuid, compute_map, index, identifier):
+        """
+        Returns the normalized data of the compute map from the snapshot
+        """
+        return compute_dict(self._table(index), compute_map, identifier, uuid)
+
+    def emit_compare_metadata_dict(
+        self, uuid=None, compare_map=None, index=None, input_dict=None
+    ):
+        table = self._table(index)
+        rows = np.flatnonzero(table.equals("uuid", uuid))
+        compare_by_column = table.column(compare_map["element"])
+        compare_columns = [
+            (compare, table.column(compare)) for compare in compare_map["compare"]
+        ]
+        for row in rows:
+            compare_by = None
+            if compare_by_column is not None and compare_by_column[1][row]:
+                compare_by = compare_by_column[0][row].item()
+            if compare_by not in input_dict:
+                input_dict[compare_by] = {}
+            for compare, column in compare_columns:
+                if column is None or not column[1][row]:
+                    continue
+                value = column[0][row]
+                value = value.item() if isinstance(value, np.generic) else value
+                if value:
+                    input_dict[compare_by][compare] = value
+        return input_dict
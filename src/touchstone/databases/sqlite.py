@@ -0,0 +1,327 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+from . import DatabaseBaseClass
+from ..utils.aggregate import (
+    BUCKET_SIZE,
+    DEFAULT_PERCENTS,
+    metric_specs,
+    strip_keyword,
+    wrap_filters,
+)
+from ..utils.columnar import to_columns
+
+
+logger = logging.getLogger("touchstone")
+
+# Aggregations computed by sqlite itself, percentiles are computed from sorted values
+SQL_AGGREGATIONS = {
+    "max": "MAX({})",
+    "min": "MIN({})",
+    "avg": "AVG({})",
+    "sum": "TOTAL({})",
+    "value_count": "COUNT({})",
+}
+
+
+def quote(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def _sql_value(value):
+    # sqlite only binds scalars, lists and objects are stored as json text
+    if isinstance(value, (list, dict)):
+        return json.dumps(value)
+    return value
+
+
+def write_tables(path, indices):
+    """
+    Writes the documents of every index, given as {index: [flat documents]},
+    to a table named after the index with one column per field. List values
+    are written as json text.
+    """
+    conn = sqlite3.connect(path)
+    with conn:
+        for index, documents in indices.items():
+            columns = to_columns(documents)
+            names = list(columns)
+            conn.execute("DROP TABLE IF EXISTS {}".format(quote(index)))
+            conn.execute(
+                "CREATE TABLE {} ({})".format(
+                    quote(index), ", ".join(quote(name) for name in names)
+                )
+            )
+            if not names:
+                continue
+            conn.executemany(
+                "INSERT INTO {} VALUES ({})".format(
+                    quote(index), ", ".join("?" for _ in names)
+                ),
+                (
+                    [_sql_value(value) for value in row]
+                    for row in zip(*(columns[name] for name in names))
+                ),
+            )
+    conn.close()
+    logger.info("Wrote sqlite database {}".format(path))
+
+
+def _percentile(values, percent):
+    # Linear interpolation between the closest ranks of sorted values
+    rank = (len(values) - 1) * percent / 100.0
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return float(values[low] + (values[high] - values[low]) * (rank - low))
+
+
+class Sqlite(DatabaseBaseClass):
+    """
+    Database reading results from a sqlite file, conn_url being its path.
+    Every index is a table with one column per document field, named by its
+    dotted path, as written by touchstone_snapshot --format sqlite
+    """
+
+    def __init__(self, conn_url=None, cache=None, cache_scope=None):
+        logger.debug("Initializing Sqlite object")
+        DatabaseBaseClass.__init__(
+            self, conn_url=conn_url, cache=cache, cache_scope=cache_scope
+        )
+        # sqlite connections can't be shared between threads
+        self._local = threading.local()
+        self._indexed = set()
+        self._indexed_lock = threading.Lock()
+        logger.debug("Finished Initializing Sqlite object")
+
+    def _conn(self):
+        if not hasattr(self._local, "conn"):
+            # file: urls allow opening the database read-only with ?mode=ro
+            self._local.conn = sqlite3.connect(
+                self._conn_url, uri=self._conn_url.startswith("file:")
+            )
+        return self._local.conn
+
+    def _path(self):
+        path = self._conn_url
+        if path.startswith("file:"):
+            # Path of a file: url, without its query string
+            path = path.split(":", 1)[1].split("?", 1)[0]
+        return path
+
+    def _cache_source(self):
+        try:
+            mtime = os.stat(self._path()).st_mtime_ns
+        except OSError:
+            mtime = None
+        return [self._conn_url, mtime]
+
+    def _columns(self, table):
+        """
+        Returns the column names of table, an empty list if it doesn't exist
+        """
+        return [
+            row[1]
+            for row in self._conn().execute(
+                "PRAGMA table_info({})".format(quote(table))
+            )
+        ]
+
+    def _create_index(self, table, columns):
+        """
+        Creates an index over columns of table unless done already. Read-only
+        databases are queried without it
+        """
+        name = "touchstone_{}".format(
+            hashlib.sha1("\0".join([table] + columns).encode("utf-8")).hexdigest()[:16]
+        )
+        with self._indexed_lock:
+            if name in self._indexed:
+                return
+            self._indexed.add(name)
+        try:
+            stat = os.stat(self._path())
+        except OSError:
+            stat = None
+        try:
+            with self._conn() as conn:
+                conn.execute(
+                    "CREATE INDEX IF NOT EXISTS {} ON {} ({})".format(
+                        quote(name),
+                        quote(table),
+                        ", ".join(quote(column) for column in columns),
+                    )
+                )
+        except sqlite3.DatabaseError as err:
+            logger.debug("Could not create index {}: {}".format(name, err))
+            return
+        if stat is not None:
+            # An index leaves the data as it was, so the results cached under
+            # the modification time of the file, or being fetched, stay valid
+            try:
+                os.utime(self._path(), ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            except OSError as err:
+                logger.debug("Could not restore the time of {}: {}".format(name, err))
+
+    def _where(self, compute_map, identifier, uuid, columns):
+        """
+        Returns the WHERE clause and parameters selecting the documents of
+        the compute map, None if a filtered field doesn't exist
+        """
+        clauses = []
+        params = []
+        for field, value in [(identifier, uuid)] + list(compute_map["filter"].items()):
+            field = strip_keyword(field)
+            if field not in columns:
+                return None, None
+            clauses.append("{} = ?".format(quote(field)))
+            params.append(value)
+        for exclude in compute_map.get("exclude", []):
+            excluded = []
+            for field, value in exclude.items():
+                field = strip_keyword(field)
+                if field not in columns:
+                    # Documents without the field never match the exclude
+                    excluded = None
+                    break
+                excluded.append("{} IS ?".format(quote(field)))
+                params.append(value)
+            if excluded:
+                clauses.append("NOT ({})".format(" AND ".join(excluded)))
+        return " AND ".join(clauses), params
+
+    def emit_compute_dict(self, uuid, compute_map, index, identifier):
+        """
+        Returns the normalized data of the compute map, aggregated by sqlite
+        with a GROUP BY over the bucket columns
+        """
+        columns = self._columns(index)
+        identifier = strip_keyword(identifier)
+        where, params = self._where(compute_map, identifier, uuid, columns)
+        if where is None:
+            return {}
+        buckets = [strip_keyword(bucket) for bucket in compute_map["buckets"]]
+        specs = metric_specs(compute_map["aggregations"])
+        index_columns = [identifier]
+        index_columns.extend(strip_keyword(field) for field in compute_map["filter"])
+        index_columns.extend(bucket for bucket in buckets if bucket in columns)
+        self._create_index(index, index_columns)
+        group_columns = [
+            quote(bucket) if bucket in columns else "NULL" for bucket in buckets
+        ]
+        selects = list(group_columns) + ["COUNT(*)"]
+        for name, agg_type, field, params_ in specs:
+            field = strip_keyword(field)
+            if agg_type in SQL_AGGREGATIONS:
+                column = quote(field) if field in columns else "NULL"
+                selects.append(SQL_AGGREGATIONS[agg_type].format(column))
+            elif agg_type != "percentiles":
+                raise ValueError("Unsupported aggregation {}".format(agg_type))
+            else:
+                selects.append("NULL")
+        query = "SELECT {} FROM {} WHERE {} GROUP BY {}".format(
+            ", ".join(selects), quote(index), where, ", ".join(group_columns)
+        )
+        logger.debug("Built the following query: {} {}".format(query, params))
+        rows = self._conn().execute(query, params).fetchall()
+        if not rows:
+            return {}
+        group_count = len(buckets)
+        percentiles = self._percentiles(
+            index, where, params, buckets, group_columns, specs, columns
+        )
+        # Doc count of every bucket prefix, to order buckets as terms buckets
+        doc_counts = {}
+        for row in rows:
+            for level in range(group_count):
+                if row[level] is None:
+                    break
+                prefix = row[: level + 1]
+                doc_counts[prefix] = doc_counts.get(prefix, 0) + row[group_count]
+        children = {}
+        for prefix in doc_counts:
+            children.setdefault(prefix[:-1], []).append(prefix)
+        leaves = {
+            row[:group_count]: row for row in rows if None not in row[:group_count]
+        }
+
+        def build_dict(prefix):
+            output_dict = {}
+            level = len(prefix)
+            if level < group_count:
+                output_dict[buckets[level]] = {}
+                ordered = sorted(
+                    children.get(prefix, []),
+                    key=lambda child: (
+                        -doc_counts[child],
+                        isinstance(child[-1], str),
+                        child[-1],
+                    ),
+                )
+                for child in ordered[:BUCKET_SIZE]:
+                    output_dict[buckets[level]][child[-1]] = build_dict(child)
+                return output_dict
+            row = leaves[prefix]
+            for position, (name, agg_type, field, params_) in enumerate(specs):
+                if agg_type == "percentiles":
+                    values = percentiles.get((name, prefix), [])
+                    for percent in params_.get("percents", DEFAULT_PERCENTS):
+                        output_dict["{}{}".format(float(percent), name)] = {
+                            uuid: _percentile(values, percent) if values else None
+                        }
+                    continue
+                value = row[group_count + 1 + position]
+                if value is not None and agg_type != "value_count":
+                    value = float(value)
+                output_dict[name] = {uuid: value}
+            return output_dict
+
+        return wrap_filters(build_dict(()), compute_map["filter"])
+
+    def _percentiles(
+        self, index, where, params, buckets, group_columns, specs, columns
+    ):
+        """
+        Returns the sorted values of every percentiles aggregation for every
+        bucket combination, keyed by (aggregation name, bucket values)
+        """
+        values = {}
+        for name, agg_type, field, params_ in specs:
+            field = strip_keyword(field)
+            if agg_type != "percentiles" or field not in columns:
+                continue
+            query = "SELECT {}, {} FROM {} WHERE {} AND {} IS NOT NULL ORDER BY {}".format(
+                ", ".join(group_columns),
+                quote(field),
+                quote(index),
+                where,
+                quote(field),
+                ", ".join(group_columns + [quote(field)]),
+            )
+            for row in self._conn().execute(query, params):
+                values.setdefault((name, row[: len(buckets)]), []).append(row[-1])
+        return values
+
+    def emit_compare_metadata_dict(
+        self, uuid=None, compare_map=None, index=None, input_dict=None
+    ):
+        columns = self._columns(index)
+        if "uuid" not in columns:
+            return input_dict
+        self._create_index(index, ["uuid"])
+        cursor = self._conn().execute(
+            "SELECT * FROM {} WHERE {} = ?".format(quote(index), quote("uuid")), [uuid]
+        )
+        for row in cursor:
+            document = dict(zip(columns, row))
+            compare_by = document.get(compare_map["element"])
+            if compare_by not in input_dict:
+                input_dict[compare_by] = {}
+            for compare in compare_map["compare"]:
+                value = document.get(compare)
+                if value:
+                    input_dict[compare_by][compare] = value
+        return input_dict
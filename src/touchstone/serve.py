@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+import argparse
+import collections
+import io
+import json
+import logging
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from touchstone import __version__
+from .compare import setup_logging
+from .databases.resilience import load_connection_config
+from .session import ComparisonSession
+from .utils.cache import (
+    MemoryCache,
+    DEFAULT_CACHE_TTL,
+    DEFAULT_MEMORY_CACHE_ENTRIES,
+)
+
+__author__ = "red-hat-perfscale"
+__copyright__ = "red-hat-perfscale"
+__license__ = "mit"
+
+logger = logging.getLogger("touchstone")
+
+# Content type of the response in every output format, table being the
+# default output of touchstone_compare
+CONTENT_TYPES = {
+    "table": "text/plain",
+    "json": "application/json",
+    "yaml": "application/yaml",
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+}
+# Sessions kept warm, least recently used first out
+DEFAULT_MAX_SESSIONS = 64
+
+
+def parse_args(args):
+    """Parse command line parameters
+
+    Args:
+      args ([str]): command line parameters as list of strings
+
+    Returns:
+      :obj:`argparse.Namespace`: command line parameters namespace
+    """
+    parser = argparse.ArgumentParser(
+        description="serve benchmark comparisons over http from warm clients"
+    )
+    parser.add_argument(
+        "--version",
+        action="version",
+        version="touchstone {ver}".format(ver=__version__),
+    )
+    parser.add_argument(
+        "--host",
+        dest="host",
+        help="address to listen on (default: 127.0.0.1)",
+        type=str,
+        default="127.0.0.1",
+    )
+    parser.add_argument(
+        "--port",
+        dest="port",
+        help="port to listen on (default: 8000)",
+        type=int,
+        default=8000,
+    )
+    parser.add_argument(
+        "--connection-config",
+        dest="connection_config",
+        help="Per connection url request policy file, see touchstone_compare",
+        type=argparse.FileType("r", encoding="utf-8"),
+    )
+    parser.add_argument(
+        "--pool-size",
+        dest="pool_size",
+        help="maximum connections kept open per connection url (default: 10)",
+        type=int,
+        default=10,
+    )
+    parser.add_argument(
+        "--timeout",
+        dest="timeout",
+        help="seconds to wait for a query before giving up (default: 10)",
+        type=int,
+        default=10,
+    )
+    parser.add_argument(
+        "--http-compress",
+        dest="http_compress",
+        help="compress the http requests and responses",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--lean-queries",
+        dest="lean_queries",
+        help="skip the hits of aggregation queries and filter their responses",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        dest="jobs",
+        help="queries run at the same time for each comparison (default: 1)",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--cache-entries",
+        dest="cache_entries",
+        help="results kept in memory, least recently used first out (default: {})".format(
+            DEFAULT_MEMORY_CACHE_ENTRIES
+        ),
+        type=int,
+        default=DEFAULT_MEMORY_CACHE_ENTRIES,
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        dest="cache_ttl",
+        help="seconds a cached result stays valid, 0 for ever (default: {})".format(
+            DEFAULT_CACHE_TTL
+        ),
+        type=int,
+        default=DEFAULT_CACHE_TTL,
+    )
+    parser.add_argument(
+        "--max-sessions",
+        dest="max_sessions",
+        help="sessions kept warm, least recently used first out (default: {})".format(
+            DEFAULT_MAX_SESSIONS
+        ),
+        type=int,
+        default=DEFAULT_MAX_SESSIONS,
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        dest="loglevel",
+        help="set loglevel to INFO",
+        action="store_const",
+        const=logging.INFO,
+    )
+    parser.add_argument(
+        "-vv",
+        "--very-verbose",
+        dest="loglevel",
+        help="set loglevel to DEBUG",
+        action="store_const",
+        const=logging.DEBUG,
+    )
+    return parser.parse_args(args)
+
+
+class ComparisonServer(ThreadingHTTPServer):
+    """
+    HTTP server answering comparison requests, each on a thread of its own.
+    Requests with the same benchmark, database, harness, identifier and
+    configuration share a ComparisonSession, and every session shares the
+    in-memory result cache, so overlapping comparisons only query what no
+    other one has fetched or is fetching. At most max_sessions sessions are
+    kept, the least recently used ones being dropped first.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self, address, cache, max_sessions=DEFAULT_MAX_SESSIONS, **session_options
+    ):
+        super().__init__(address, ComparisonHandler)
+        self.cache = cache
+        self.session_options = session_options
+        self._max_sessions = max_sessions
+        self._sessions = collections.OrderedDict()
+        self._sessions_lock = threading.Lock()
+
+    def session(self, request):
+        """
+        Returns the session for the benchmark of request, creating it on
+        first use
+        """
+        key = json.dumps(
+            [
+                request["benchmark"],
+                request.get("database", "elasticsearch"),
+                request.get("harness", "ripsaw"),
+                request.get("identifier", "uuid"),
+                request.get("config"),
+                request.get("metadata"),
+            ],
+            sort_keys=True,
+        )
+        with self._sessions_lock:
+            if key not in self._sessions:
+                config = None
+                if request.get("config") is not None:
+                    # Benchmarks load their configuration from a file
+                    config = io.StringIO(json.dumps(request["config"]))
+                self._sessions[key] = ComparisonSession(
+                    request["benchmark"],
+                    database=request.get("database", "elasticsearch"),
+                    harness=request.get("harness", "ripsaw"),
+                    config=config,
+                    identifier=request.get("identifier", "uuid"),
+                    metadata_map=request.get("metadata"),
+                    cache=self.cache,
+                    **self.session_options
+                )
+            self._sessions.move_to_end(key)
+            while self._max_sessions and len(self._sessions) > self._max_sessions:
+                # Requests still using a dropped session keep it until they end
+                self._sessions.popitem(last=False)
+            return self._sessions[key]
+
+    def status(self):
+        with self._sessions_lock:
+            sessions = len(self._sessions)
+        return {"sessions": sessions, "cached_results": len(self.cache)}
+
+
+class ComparisonHandler(BaseHTTPRequestHandler):
+    """
+    Answers POST /compare with the comparison of the json request body and
+    GET /status with the number of sessions and cached results.
+
+    The request body holds the benchmark, database, harness, uuids and
+    conn_url of the comparison, and optionally its identifier, config, the
+    content of a touchstone configuration file, and metadata, the metadata
+    map of a metadata configuration file. Without an output format, the
+    response is the json document of ComparisonSession.compare, otherwise
+    the output of touchstone_compare in that format.
+    """
+
+    def log_message(self, format, *args):
+        logger.info("{} {}".format(self.address_string(), format % args))
+
+    def _respond(self, code, body, content_type="application/json"):
+        body = body.encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self, code, message):
+        self._respond(code, json.dumps({"error": message}))
+
+    def do_GET(self):  # noqa: N802
+        if self.path != "/status":
+            self._error(404, "unknown path {}".format(self.path))
+            return
+        self._respond(200, json.dumps(self.server.status()))
+
+    def do_POST(self):  # noqa: N802
+        if self.path != "/compare":
+            self._error(404, "unknown path {}".format(self.path))
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length))
+            if not isinstance(request, dict):
+                raise ValueError("request body must be a json object")
+            for field in ["benchmark", "uuids", "conn_url"]:
+                if field not in request:
+                    raise ValueError("missing field {}".format(field))
+            output = request.get("output")
+            if output is not None and output not in CONTENT_TYPES:
+                raise ValueError("unknown output format {}".format(output))
+        except ValueError as err:
+            self._error(400, str(err))
+            return
+        try:
+            session = self.server.session(request)
+            if output is None:
+                body = json.dumps(
+                    session.compare(request["uuids"], request["conn_url"])
+                )
+            else:
+                output_file = io.StringIO()
+                session.render(
+                    request["uuids"],
+                    request["conn_url"],
+                    output=None if output == "table" else output,
+                    output_file=output_file,
+                )
+                body = output_file.getvalue()
+        except Exception as err:
+            logger.exception("Comparison failed")
+            self._error(500, "{}: {}".format(type(err).__name__, err))
+            return
+        self._respond(200, body, CONTENT_TYPES.get(output, "application/json"))
+
+
+def main(args):
+    """Main entry point allowing external calls
+
+    Args:
+      args ([str]): command line parameter list
+    """
+    args = parse_args(args)
+    setup_logging(args.loglevel)
+    policies = None
+    if args.connection_config:
+        policies = load_connection_config(args.connection_config)
+    cache = MemoryCache(max_entries=args.cache_entries, ttl=args.cache_ttl)
+    server = ComparisonServer(
+        (args.host, args.port),
+        cache,
+        policies=policies,
+        pool_size=args.pool_size,
+        timeout=args.timeout,
+        http_compress=args.http_compress,
+        lean_queries=args.lean_queries,
+        jobs=args.jobs,
+        max_sessions=args.max_sessions,
+    )
+    logger.warning(
+        "Serving comparisons on http://{}:{}".format(*server.server_address[:2])
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    logger.info("Script ends here")
+
+
+def render():
+    """Entry point for console_scripts
+    """
+    main(sys.argv[1:])
+
+
+if __name__ == "__main__":
+    render()
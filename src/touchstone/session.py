@@ -0,0 +1,892 @@
+import json
+import logging
+import sys
+import threading
+
+from . import benchmarks
+from . import databases
+from .databases.resilience import policy_for
+from .utils.baseline import add_candidate, baseline_columns, baseline_selector
+from .utils.lib import (
+    ResultStore,
+    async_limiter,
+    prefetch,
+    run_ordered,
+    run_ordered_async,
+)
+from .utils.timings import span
+
+
+logger = logging.getLogger("touchstone")
+
+# File backed databases hold documents of another database type, whose
+# compute maps they answer
+SOURCE_TYPES = {"snapshot": "elasticsearch", "sqlite": "elasticsearch"}
+OUTPUTS = [None, "json", "yaml", "csv", "ndjson"]
+# Seconds to wait for a query sent by another session before sending it too
+COALESCE_TIMEOUT = 60
+
+
+def update(dict1, dict2):
+    copy = dict1.copy()
+    for key in dict2:
+        if key in dict1:
+            copy[key].update(dict2[key])
+        else:
+            copy[key] = dict2[key]
+    return copy
+
+
+def emit_compute_records(index, compute_map, uuid, result):
+    """Yields a flat record for every value of a compute map result
+
+    Args:
+      index (str): index the compute map was computed on
+      compute_map (dict): compute map of the result
+      uuid (str): identifier value of the result
+      result (dict): normalized data of the compute map for uuid
+    """
+    filters = {}
+    node = result
+    # Results are nested under the k,v pairs of the filters first
+    for key, value in compute_map["filter"].items():
+        key = key.split(".keyword")[0]
+        node = node.get(key, {}).get(value)
+        if node is None:
+            return
+        filters[key] = value
+    buckets = [bucket.split(".keyword")[0] for bucket in compute_map["buckets"]]
+    stack = [(node, {})]
+    while stack:
+        node, bucket_values = stack.pop()
+        level = len(bucket_values)
+        if level < len(buckets):
+            children = list(node.get(buckets[level], {}).items())
+            # Reversed so buckets are popped in the order of the result
+            for key, child in reversed(children):
+                stack.append((child, dict(bucket_values, **{buckets[level]: key})))
+            continue
+        for metric, values in node.items():
+            # Baseline results do not hold every column for every metric
+            if uuid not in values:
+                continue
+            yield {
+                "index": index,
+                "filter": filters,
+                "buckets": bucket_values,
+                "metric": metric,
+                "uuid": uuid,
+                "value": values.get(uuid),
+            }
+
+
+def _in_order(results, batches, batch_results):
+    """Yields the results by position, results holding the ones already
+    known and the others coming from batch_results, the results of the
+    positions of every batch, as soon as all the previous ones are known
+    """
+    next_position = 0
+    for batch, results_of_batch in zip(batches, batch_results):
+        for position, result in zip(batch, results_of_batch):
+            results[position] = result
+        # Yield every result that is now available in order
+        while next_position in results:
+            yield results.pop(next_position)
+            next_position += 1
+    # Trailing results were all known already
+    while next_position in results:
+        yield results.pop(next_position)
+        next_position += 1
+
+
+class ComparisonSession:
+    """
+    Comparison of the results of a benchmark, to use from python instead of
+    running touchstone_compare. The session keeps its database instances,
+    their pooled clients and the result cache across calls, so comparing
+    many runs in a long-lived process only pays for the queries. The keyword
+    arguments are the options of touchstone_compare, policies being the
+    request policies of load_connection_config and cache a ResultCache.
+
+    compute and metadata yield the results of every query as they arrive,
+    compare returns them merged as the json output holds them, and render
+    writes them in any output format of touchstone_compare. Every method
+    takes the uuids to compare along with their connection urls, either one
+    per uuid or a single one shared by all of them.
+    """
+
+    def __init__(
+        self,
+        benchmark,
+        database="elasticsearch",
+        harness="ripsaw",
+        config=None,
+        identifier="uuid",
+        metadata_map=None,
+        cache=None,
+        policies=None,
+        pool_size=10,
+        timeout=10,
+        http_compress=False,
+        lean_queries=False,
+        composite_size=0,
+        jobs=1,
+        async_limit=0,
+        adaptive_limit=0,
+        adaptive_latency=None,
+        batch_size=0,
+        query_plan="uuid",
+        prefetch=0,
+    ):
+        logger.debug("Instantiating the benchmark instance")
+        self.benchmark = benchmarks.grab(
+            benchmark,
+            source_type=SOURCE_TYPES.get(database, database),
+            harness_type=harness,
+            config=config,
+        )
+        self._database = database
+        self._identifier = identifier
+        self._metadata_map = metadata_map
+        self._cache = cache
+        self._policies = policies
+        self._pool_size = pool_size
+        self._timeout = timeout
+        self._http_compress = http_compress
+        self._lean_queries = lean_queries
+        self._composite_size = composite_size
+        self._jobs = jobs
+        self._async_limit = async_limit
+        self._adaptive_limit = adaptive_limit
+        self._adaptive_latency = adaptive_latency
+        self._batch_size = batch_size
+        self._query_plan = query_plan
+        self._prefetch = prefetch
+        self._database_instances = {}
+        self._database_lock = threading.Lock()
+        self._async_limiter = None
+        if self._use_async():
+            # Shared by every run of calls, so the limit holds across all of them
+            self._async_limiter = async_limiter(async_limit)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def close(self):
+        """
+        Closes the asynchronous clients, which are shared by every session
+        of the process
+        """
+        if self._use_async():
+            from .databases import elasticsearch_async
+
+            elasticsearch_async.close_connections()
+
+    def database(self, conn_url):
+        """
+        Returns the database instance for conn_url, creating it on first use
+        """
+        with self._database_lock:
+            if conn_url not in self._database_instances:
+                self._database_instances[conn_url] = self._create_database(conn_url)
+            return self._database_instances[conn_url]
+
+    def _create_database(self, conn_url):
+        database_type = self._database
+        database_options = {}
+        if self._use_async():
+            database_type = "elasticsearch_async.ElasticsearchAsync"
+        if self._database == "elasticsearch":
+            database_options = {
+                "pool_size": self._pool_size,
+                "timeout": self._timeout,
+                "http_compress": self._http_compress,
+                "lean_queries": self._lean_queries,
+                "composite_size": self._composite_size,
+                "policy": policy_for(self._policies, conn_url),
+                "adaptive_limit": self._adaptive_limit,
+                "adaptive_latency": self._adaptive_latency,
+                "jobs": self._jobs,
+            }
+        return databases.grab(
+            database_type,
+            conn_url=conn_url,
+            cache=self._cache,
+            # Composite paging lists buckets in key order, every query plan
+            # returns the same results otherwise
+            cache_scope={"composite_size": self._composite_size},
+            **database_options
+        )
+
+    def metadata_map(self):
+        """
+        Returns the metadata indices to collect and their compare maps
+        """
+        if self._metadata_map is not None:
+            return self._metadata_map
+        return self.benchmark.emit_metadata_search_map()
+
+    def _use_async(self):
+        # Queries are sent by the asynchronous elasticsearch database
+        return self._database == "elasticsearch" and self._async_limit > 0
+
+    def _conn_urls(self, uuids, conn_urls):
+        if isinstance(conn_urls, str):
+            conn_urls = [conn_urls]
+        if len(conn_urls) < len(uuids):
+            conn_urls = [conn_urls[0]] * len(uuids)
+        return conn_urls
+
+    def _run_calls(self, calls):
+        """
+        Runs the database calls, (method, keyword arguments) pairs, and yields
+        their results in the same order. Calls run on a pool of jobs threads,
+        or as coroutines of the asynchronous elasticsearch database with an
+        async limit.
+        """
+        if not self._use_async():
+            return run_ordered(calls, jobs=self._jobs)
+        # Every database method has an awaitable twin named with an _async suffix
+        async_calls = (
+            (getattr(func.__self__, func.__name__ + "_async"), kwargs)
+            for func, kwargs in calls
+        )
+        return run_ordered_async(
+            async_calls, self._async_limiter, self._async_limit * 2
+        )
+
+    def _plan_compute_calls(self, compute_queries, positions):
+        """Groups the compute queries into the calls answering them
+
+        By default every query is a call of its own. With the identifier query
+        plan, the queries of every uuid sharing a connection url, index and
+        compute map are answered by a single call, and with the fused query
+        plan the queries of every uuid and compute map sharing a connection url
+        and index are. With a batch size, the
+        queries of each connection url are grouped in batches that are sent as
+        a single request each.
+
+        Args:
+          compute_queries ([(str, dict)]): connection string and emit_compute_dict
+            keyword arguments of every query
+          positions ([int]): positions in compute_queries of the queries to plan
+
+        Returns:
+          ([int or [int]], [(callable, dict)]): position of the query answered by
+            each call, or positions for calls returning a list of results, and
+            the calls
+        """
+        batches = []
+        calls = []
+        if self._query_plan == "uuid" and not self._batch_size:
+            for position in positions:
+                conn_url, query = compute_queries[position]
+                batches.append(position)
+                calls.append((self.database(conn_url).emit_compute_dict, query))
+            return batches, calls
+        groups = {}
+        for position in positions:
+            conn_url, query = compute_queries[position]
+            if self._query_plan == "identifier":
+                key = (conn_url, query["index"], id(query["compute_map"]))
+            elif self._query_plan == "fused":
+                key = (conn_url, query["index"])
+            else:
+                key = conn_url
+            groups.setdefault(key, []).append(position)
+        for group_positions in groups.values():
+            conn_url, first_query = compute_queries[group_positions[0]]
+            database_instance = self.database(conn_url)
+            if self._query_plan == "identifier":
+                batches.append(group_positions)
+                calls.append(
+                    (
+                        database_instance.emit_compute_dicts_by_identifier,
+                        {
+                            "uuids": [
+                                compute_queries[position][1]["uuid"]
+                                for position in group_positions
+                            ],
+                            "compute_map": first_query["compute_map"],
+                            "index": first_query["index"],
+                            "identifier": first_query["identifier"],
+                        },
+                    )
+                )
+                continue
+            if self._query_plan == "fused":
+                batches.append(group_positions)
+                calls.append(
+                    (
+                        database_instance.emit_compute_dicts_fused,
+                        {
+                            "queries": [
+                                compute_queries[position][1]
+                                for position in group_positions
+                            ]
+                        },
+                    )
+                )
+                continue
+            for start in range(0, len(group_positions), self._batch_size):
+                end = start + self._batch_size
+                batch = group_positions[start:end]
+                batches.append(batch)
+                calls.append(
+                    (
+                        database_instance.emit_compute_dicts,
+                        {
+                            "queries": [
+                                compute_queries[position][1] for position in batch
+                            ]
+                        },
+                    )
+                )
+        return batches, calls
+
+    def _run_compute_queries(self, compute_queries):
+        """
+        Runs the compute queries, (connection url, emit_compute_dict keyword
+        arguments) pairs, and yields their results in the same order. Results
+        found in the result cache are not queried again, and the fetched ones
+        are stored in it. Queries already sent by another session sharing the
+        cache are waited on instead of being sent again.
+        """
+        results = {}
+        positions = []
+        unresolved = set()
+        waiting = []
+        # Claims are taken once the results are iterated, and released on
+        # the way out, even when they are never fully iterated
+        try:
+            for position, (conn_url, query) in enumerate(compute_queries):
+                database_instance = self.database(conn_url)
+                with span("cache lookup"):
+                    result = database_instance.get_cached_compute_dict(**query)
+                    if result is None:
+                        event = database_instance.claim_compute_dict(**query)
+                if result is not None:
+                    results[position] = result
+                elif event is None:
+                    positions.append(position)
+                    unresolved.add(position)
+                else:
+                    waiting.append((position, event))
+            logger.info(
+                "{} compute results found in cache, querying {}, waiting for {}".format(
+                    len(results), len(positions), len(waiting)
+                )
+            )
+            batches, calls = self._plan_compute_calls(compute_queries, positions)
+            # Planned last, so the queries claimed here are sent before waiting
+            for position, event in waiting:
+                conn_url, query = compute_queries[position]
+                batches.append(position)
+                calls.append(
+                    (
+                        self._wait_compute_dict,
+                        {"event": event, "conn_url": conn_url, "query": query},
+                    )
+                )
+
+            def cached(batch_results):
+                for batch, results_of_batch in zip(batches, batch_results):
+                    # Calls answering a single query return its result alone
+                    if not isinstance(batch, list):
+                        batch, results_of_batch = [batch], [results_of_batch]
+                    for position, result in zip(batch, results_of_batch):
+                        conn_url, query = compute_queries[position]
+                        database_instance = self.database(conn_url)
+                        database_instance.cache_compute_dict(result, **query)
+                        if position in unresolved:
+                            # Wakes up the waiters of results that are not cached
+                            database_instance.release_compute_dict(**query)
+                            unresolved.discard(position)
+                    yield results_of_batch
+
+            position_lists = [
+                batch if isinstance(batch, list) else [batch] for batch in batches
+            ]
+            yield from _in_order(
+                results, position_lists, cached(self._run_calls(calls))
+            )
+        finally:
+            # Wake up the sessions waiting on results that were never fetched
+            for position in unresolved:
+                conn_url, query = compute_queries[position]
+                self.database(conn_url).release_compute_dict(**query)
+
+    def _wait_compute_dict(self, event, conn_url, query):
+        """
+        Returns the result of a compute query sent by another session once
+        cached, sending the query if it was not cached in time
+        """
+        event.wait(COALESCE_TIMEOUT)
+        database_instance = self.database(conn_url)
+        result = database_instance.get_cached_compute_dict(**query)
+        if result is None:
+            result = database_instance.emit_compute_dict(**query)
+        return result
+
+    async def _wait_compute_dict_async(self, event, conn_url, query):
+        import asyncio
+
+        await asyncio.get_running_loop().run_in_executor(
+            None, event.wait, COALESCE_TIMEOUT
+        )
+        database_instance = self.database(conn_url)
+        result = database_instance.get_cached_compute_dict(**query)
+        if result is None:
+            result = await database_instance.emit_compute_dict_async(**query)
+        return result
+
+    def _run_metadata_queries(self, metadata_queries):
+        """
+        Runs the metadata queries, (connection url, uuid, compare map and
+        index) pairs, and yields their results in the same order. Metadata
+        found in the result cache is not queried again. The queries of every
+        uuid sharing a connection url and index are answered by a single
+        call, and the fetched metadata is stored in the cache.
+        """
+        results = {}
+        groups = {}
+        for position, (conn_url, query) in enumerate(metadata_queries):
+            with span("cache lookup"):
+                result = self.database(conn_url).get_cached_metadata_dict(**query)
+            if result is None:
+                key = (conn_url, query["index"], id(query["compare_map"]))
+                groups.setdefault(key, []).append(position)
+            else:
+                results[position] = result
+        batches = []
+        calls = []
+        for group_positions in groups.values():
+            conn_url, first_query = metadata_queries[group_positions[0]]
+            batches.append(group_positions)
+            calls.append(
+                (
+                    self.database(conn_url).emit_compare_metadata_dicts,
+                    {
+                        "uuids": [
+                            metadata_queries[position][1]["uuid"]
+                            for position in group_positions
+                        ],
+                        "compare_map": first_query["compare_map"],
+                        "index": first_query["index"],
+                    },
+                )
+            )
+
+        def cached(batch_results):
+            for batch, results_of_batch in zip(batches, batch_results):
+                for position, result in zip(batch, results_of_batch):
+                    conn_url, query = metadata_queries[position]
+                    self.database(conn_url).cache_metadata_dict(result, **query)
+                yield results_of_batch
+
+        return _in_order(results, batches, cached(self._run_calls(calls)))
+
+    def metadata(self, uuids, conn_urls):
+        """
+        Returns an iterator of the (uuid, index, metadata) of every uuid and
+        metadata index, in this order, metadata mapping every element of the
+        index, such as a pod name, to its compared fields
+        """
+        conn_urls = self._conn_urls(uuids, conn_urls)
+        metadata_map = self.metadata_map()
+        # Queue the metadata queries of every uuid, results come back in this order
+        metadata_queries = []
+        for uuid_index, uuid in enumerate(uuids):
+            for index in metadata_map.keys():
+                metadata_queries.append(
+                    (
+                        conn_urls[uuid_index],
+                        {
+                            "uuid": uuid,
+                            "compare_map": metadata_map[index],
+                            "index": index,
+                        },
+                    )
+                )
+        results = prefetch(self._run_metadata_queries(metadata_queries), self._prefetch)
+        return (
+            (query["uuid"], query["index"], result)
+            for (conn_url, query), result in zip(metadata_queries, results)
+        )
+
+    def _compute_queries(self, uuids, conn_urls):
+        """
+        Returns the (connection url, emit_compute_dict keyword arguments) of
+        the query of every compute map of the benchmark and uuid
+        """
+        conn_urls = self._conn_urls(uuids, conn_urls)
+        # Queue the compute queries of every index, compute map and uuid
+        compute_queries = []
+        for index in self.benchmark.emit_indices():
+            for compute in self.benchmark.emit_compute_map()[index]:
+                for uuid_index, uuid in enumerate(uuids):
+                    compute_queries.append(
+                        (
+                            conn_urls[uuid_index],
+                            {
+                                "uuid": uuid,
+                                "compute_map": compute,
+                                "index": index,
+                                "identifier": self._identifier,
+                            },
+                        )
+                    )
+        return compute_queries
+
+    def compute(self, uuids, conn_urls):
+        """
+        Returns an iterator of the (index, compute map, uuid, result) of every
+        compute map of the benchmark and uuid, in this order, result being
+        the normalized data of the compute map for the uuid
+        """
+        compute_queries = self._compute_queries(uuids, conn_urls)
+        # With prefetch, results are fetched while the previous ones are used
+        results = prefetch(self._run_compute_queries(compute_queries), self._prefetch)
+        return (
+            (query["index"], query["compute_map"], query["uuid"], result)
+            for (conn_url, query), result in zip(compute_queries, results)
+        )
+
+    def baseline(self, uuids, conn_urls, selector):
+        """
+        Returns an iterator of the (index, compute map, result) of every
+        compute map of the benchmark, result holding the statistics of every
+        metric over the runs of the baseline, the value of every uuid and its
+        delta to the baseline mean. selector holds the baseline_selector
+        keyword arguments, the runs being queried from the connection url of
+        the first uuid. Baselines are cached by selector, so every candidate
+        compared to the same one reuses it while cached.
+
+        Raises ValueError right away for an invalid selector, or a selector
+        querying runs from a database that can not select them.
+        """
+        selector = baseline_selector(**selector)
+        conn_url = self._conn_urls(uuids, conn_urls)[0]
+        database_instance = self.database(conn_url)
+        if "uuids" not in selector and not database_instance.selects_baseline_runs():
+            raise ValueError(
+                "The {} database can not select runs, list the uuids of the"
+                " baseline instead".format(self._database)
+            )
+        return self._baseline_results(uuids, conn_urls, selector, database_instance)
+
+    def _baseline_results(self, uuids, conn_urls, selector, database_instance):
+        """
+        Yields the results of baseline for a validated selector
+        """
+        # Candidates are left out of the runs, listed or selected, so the
+        # cached baseline depends on them too
+        cache_selector = dict(selector, exclude=sorted(set(uuids)))
+        compute_maps = [
+            (index, compute)
+            for index in self.benchmark.emit_indices()
+            for compute in self.benchmark.emit_compute_map()[index]
+        ]
+        results = {}
+        runs = {}
+        positions = []
+        calls = []
+        for position, (index, compute) in enumerate(compute_maps):
+            with span("cache lookup"):
+                result = database_instance.get_cached_baseline_dict(
+                    cache_selector, compute, index, self._identifier
+                )
+            if result is not None:
+                results[position] = result
+                continue
+            if index not in runs:
+                if "uuids" in selector:
+                    runs[index] = [run for run in selector["uuids"] if run not in uuids]
+                else:
+                    runs[index] = database_instance.emit_baseline_runs(
+                        index,
+                        self._identifier,
+                        selector["time_field"],
+                        last=selector["last"],
+                        since=selector["since"],
+                        until=selector["until"],
+                        match=selector["match"],
+                        exclude=uuids,
+                    )
+                logger.info(
+                    "Baseline of {} over {} runs".format(index, len(runs[index]))
+                )
+            if not runs[index]:
+                results[position] = {}
+                continue
+            positions.append(position)
+            calls.append(
+                (
+                    database_instance.emit_baseline_dict,
+                    {
+                        "runs": runs[index],
+                        "compute_map": compute,
+                        "index": index,
+                        "identifier": self._identifier,
+                        "percents": selector["percents"],
+                    },
+                )
+            )
+
+        def cached(batch_results):
+            for position, result in zip(positions, batch_results):
+                index, compute = compute_maps[position]
+                database_instance.cache_baseline_dict(
+                    result, cache_selector, compute, index, self._identifier
+                )
+                yield [result]
+
+        baseline_results = _in_order(
+            results,
+            [[position] for position in positions],
+            cached(self._run_calls(calls)),
+        )
+        compute_results = self.compute(uuids, conn_urls)
+        for (index, compute), result in zip(compute_maps, baseline_results):
+            for uuid in uuids:
+                _, _, _, candidate_result = next(compute_results)
+                add_candidate(result, uuid, candidate_result)
+            yield index, compute, result
+
+    def compare(self, uuids, conn_urls):
+        """
+        Returns the metadata of every uuid and metadata index and the results
+        of every compute map, merged in nested dictionaries like the json
+        output of touchstone_compare, as a dictionary with metadata and
+        results keys
+        """
+        metadata_store = ResultStore()
+        for uuid, index, result in self.metadata(uuids, conn_urls):
+            metadata_store.merge({uuid: result})
+        main_store = ResultStore()
+        for index, compute_map, uuid, result in self.compute(uuids, conn_urls):
+            main_store.merge(result)
+        return {"metadata": metadata_store.to_dict(), "results": main_store.to_dict()}
+
+    def render(self, uuids, conn_urls, output=None, output_file=None, baseline=None):
+        """
+        Writes the metadata and the results of every uuid to output_file,
+        standard output by default, as tables or in the json, yaml, csv or
+        ndjson output format. Tables, csv and ndjson are written as results
+        arrive, json and yaml once every result is fetched. With a baseline
+        selector, the results of every uuid are written along with the
+        statistics of the baseline instead.
+        """
+        if output not in OUTPUTS:
+            raise ValueError("Unknown output format {}".format(output))
+        if output_file is None:
+            output_file = sys.stdout
+        metadata_store = ResultStore()
+        main_store = ResultStore()
+        compare_uuid_dict_metadata = {}
+        metadata_map = self.metadata_map()
+        metadata_results = self.metadata(uuids, conn_urls)
+        # With prefetch, compute results are fetched while the metadata and the
+        # previous compute maps are rendered
+        if baseline is None:
+            compute_results = self.compute(uuids, conn_urls)
+            # Every uuid has a result of its own
+            result_columns = [[uuid] for uuid in uuids]
+        else:
+            compute_results = self.baseline(uuids, conn_urls, baseline)
+            # A single result holds every uuid and the baseline statistics
+            result_columns = [
+                baseline_columns(uuids, baseline_selector(**baseline)["percents"])
+            ]
+        # Indices from metadata map
+        for uuid in uuids:
+            super_header = "\n{} UUID: {} {}".format(("=" * 67), uuid, ("=" * 67))
+            compare_uuid_dict_metadata[uuid] = {}
+            index_dict = {}
+            for index in metadata_map.keys():
+                with span("wait for metadata"):
+                    _, _, tmp_dict = next(metadata_results)
+                compare_uuid_dict_metadata[uuid] = tmp_dict
+                index_dict = update(tmp_dict, index_dict)
+            stockpile_metadata = {}
+            stockpile_metadata["where"] = []
+            for where in index_dict.keys():
+                # Skip if there is no associated metadata
+                if not index_dict[where].items():
+                    continue
+                stockpile_metadata["where"].append(where)
+                for k, v in index_dict[where].items():
+                    if k not in stockpile_metadata:
+                        stockpile_metadata[k] = []
+                    stockpile_metadata[k].append(v)
+            # Check that metadata exists to be printed
+            if not stockpile_metadata["where"]:
+                continue
+            with span("write metadata"):
+                if output in ["csv"]:
+                    # Print to output file if argument present
+                    uuid_store = ResultStore()
+                    uuid_store.merge(compare_uuid_dict_metadata)
+                    import csv
+
+                    writer = csv.writer(output_file, delimiter=",")
+                    writer.writerow(["uuid", "where", "field", "value"])
+                    writer.writerows(uuid_store.rows())
+                elif output in ["json", "yaml"]:
+                    metadata_store.merge(compare_uuid_dict_metadata)
+                elif output == "ndjson":
+                    for where in stockpile_metadata["where"]:
+                        for field, value in index_dict[where].items():
+                            record = {
+                                "uuid": uuid,
+                                "where": where,
+                                "field": field,
+                                "value": value,
+                            }
+                            output_file.write(json.dumps(record) + "\n")
+                else:
+                    from tabulate import tabulate
+
+                    print(super_header, file=output_file)
+                    print(
+                        tabulate(stockpile_metadata, headers="keys", tablefmt="pretty"),
+                        file=output_file,
+                    )
+
+        # Indices from entered harness (ex: ripsaw)
+        for index in self.benchmark.emit_indices():
+            for compute in self.benchmark.emit_compute_map()[index]:
+                # index_store is used for csv and standard output. Since the header may be
+                # different in each index we need to print csv or stdout for each index
+                index_store = ResultStore()
+                # Iterate through UUIDs
+                for columns in result_columns:
+                    with span("wait for compute results"):
+                        result = next(compute_results)[-1]
+                    if output == "ndjson":
+                        # Written right away, nothing is kept once written
+                        with span("write output"):
+                            for column in columns:
+                                for record in emit_compute_records(
+                                    index, compute, column, result
+                                ):
+                                    output_file.write(json.dumps(record) + "\n")
+                        continue
+                    with span("merge results"):
+                        if output in ["json", "yaml"]:
+                            # Whole documents, only written once every result is fetched
+                            main_store.merge(result)
+                            continue
+                        index_store.merge(result)
+                    compute_header = []
+                    for key in compute["filter"]:
+                        compute_header.append(key.split(".keyword")[0])
+                    for bucket in compute["buckets"]:
+                        compute_header.append(bucket.split(".keyword")[0])
+                    for extra_h in ["key", "uuid", "value"]:
+                        compute_header.append(extra_h)
+                if not index_store:
+                    continue
+                with span("write output"):
+                    if output == "csv":
+                        import csv
+
+                        writer = csv.writer(output_file, delimiter=",")
+                        writer.writerow(compute_header)
+                        writer.writerows(index_store.rows(compute_header))
+                    elif output not in ["json", "yaml"]:
+                        from tabulate import tabulate
+
+                        row_list = list(index_store.rows(compute_header))
+                        print(
+                            tabulate(
+                                row_list, headers=compute_header, tablefmt="pretty"
+                            ),
+                            file=output_file,
+                        )
+        with span("write output"):
+            if output == "json":
+                if metadata_store:
+                    output_file.write(json.dumps(metadata_store.to_dict(), indent=4))
+                output_file.write(json.dumps(main_store.to_dict(), indent=4))
+            elif output == "yaml":
+                import yaml
+
+                if metadata_store:
+                    output_file.write(
+                        yaml.dump(metadata_store.to_dict(), allow_unicode=True)
+                    )
+                output_file.write(yaml.dump(main_store.to_dict(), allow_unicode=True))
+
+
+def fetch_compute_results(comparisons):
+    """Fetches the compute results of many comparisons into the result cache
+    shared by their sessions, sending every distinct query once, so that
+    comparing them afterwards only reads the cache
+
+    The queries of every session are planned as usual and its calls run on
+    the pool of jobs threads or with the async limit of that session.
+
+    Empty results are only kept by an in-memory cache, so that comparisons
+    of a run missing from an index don't query it again, without storing
+    them on disk.
+
+    Args:
+      comparisons ([(ComparisonSession, [str], str or [str])]): session, uuids
+        and connection urls of every comparison
+
+    Returns:
+      (int, int): number of distinct compute queries and of queries sent
+    """
+    seen = set()
+    pending = {}
+    for session, uuids, conn_urls in comparisons:
+        for conn_url, query in session._compute_queries(uuids, conn_urls):
+            key = json.dumps(
+                [
+                    conn_url,
+                    query["index"],
+                    query["compute_map"],
+                    query["identifier"],
+                    query["uuid"],
+                ],
+                sort_keys=True,
+            )
+            if key in seen:
+                continue
+            seen.add(key)
+            with span("cache lookup"):
+                result = session.database(conn_url).get_cached_compute_dict(**query)
+            if result is None:
+                pending.setdefault(id(session), (session, []))[1].append(
+                    (conn_url, query)
+                )
+    sent = sum(len(compute_queries) for _, compute_queries in pending.values())
+    logger.info(
+        "{} distinct compute queries over {} comparisons, querying {}".format(
+            len(seen), len(comparisons), sent
+        )
+    )
+    for session, compute_queries in pending.values():
+        batches, calls = session._plan_compute_calls(
+            compute_queries, list(range(len(compute_queries)))
+        )
+        # Every session runs its calls on its own threads or event loop
+        for batch, results_of_batch in zip(batches, session._run_calls(calls)):
+            # Calls answering a single query return its result alone
+            if not isinstance(batch, list):
+                batch, results_of_batch = [batch], [results_of_batch]
+            for position, result in zip(batch, results_of_batch):
+                conn_url, query = compute_queries[position]
+                database_instance = session.database(conn_url)
+                if result:
+                    database_instance.cache_compute_dict(result, **query)
+                else:
+                    # Not cached, the run may be indexed later, but every
+                    # comparison of this run gets it without sending it again
+                    database_instance.remember_compute_dict(result, **query)
+    return len(seen), sent
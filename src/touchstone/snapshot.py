@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+import argparse
+import sys
+import logging
+import json
+
+from touchstone import __version__
+from . import benchmarks
+from . import databases
+from .compare import setup_logging
+from .utils.columnar import flatten_source, write_snapshot
+
+__author__ = "red-hat-perfscale"
+__copyright__ = "red-hat-perfscale"
+__license__ = "mit"
+
+logger = logging.getLogger("touchstone")
+
+
+def parse_args(args):
+    """Parse command line parameters
+
+    Args:
+      args ([str]): command line parameters as list of strings
+
+    Returns:
+      :obj:`argparse.Namespace`: command line parameters namespace
+    """
+    parser = argparse.ArgumentParser(
+        description="export benchmark results to a local snapshot file"
+    )
+    parser.add_argument(
+        "--version",
+        action="version",
+        version="touchstone {ver}".format(ver=__version__),
+    )
+    parser.add_argument(
+        dest="benchmark",
+        help="which type of benchmark to export",
+        type=str,
+        choices=["uperf", "ycsb", "pgbench", "vegeta", "mb", "kubeburner", "scaledata"],
+        metavar="benchmark",
+    )
+    parser.add_argument(
+        dest="database",
+        help="the type of database data is stored in",
+        type=str,
+        choices=["elasticsearch"],
+        metavar="database",
+    )
+    parser.add_argument(
+        dest="harness",
+        help="the test harness that was used to run the benchmark",
+        type=str,
+        choices=["ripsaw"],
+        metavar="harness",
+    )
+    parser.add_argument(
+        "--id",
+        "--identifier-key",
+        dest="identifier",
+        help="identifier key name(default: uuid)",
+        type=str,
+        metavar="identifier",
+        default="uuid",
+    )
+    parser.add_argument(
+        "-u",
+        "--uuid",
+        dest="uuid",
+        help="identifier values to export",
+        type=str,
+        nargs="+",
+        required=True,
+    )
+    parser.add_argument(
+        "-url",
+        "--connection-url",
+        dest="conn_url",
+        help="the database connection strings in the same order as the uuids",
+        type=str,
+        nargs="+",
+        required=True,
+    )
+    parser.add_argument(
+        "-o",
+        "--output-file",
+        dest="output_file",
+        help="snapshot file to write",
+        type=str,
+        required=True,
+    )
+    parser.add_argument(
+        "--format",
+        dest="format",
+        help="format of the snapshot file (default: snapshot)",
+        type=str,
+        choices=["snapshot", "sqlite"],
+        default="snapshot",
+    )
+    parser.add_argument(
+        "--metadata-config",
+        dest="metadata_config",
+        help="Metadata configuration file",
+        type=argparse.FileType("r", encoding="utf-8"),
+    )
+    parser.add_argument(
+        "--config",
+        dest="config",
+        help="Touchstone configuration file",
+        type=argparse.FileType("r", encoding="utf-8"),
+    )
+    parser.add_argument(
+        "--scroll-size",
+        dest="scroll_size",
+        help="number of documents fetched per scroll request (default: 1000)",
+        type=int,
+        default=1000,
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        dest="loglevel",
+        help="set loglevel to INFO",
+        action="store_const",
+        const=logging.INFO,
+    )
+    parser.add_argument(
+        "-vv",
+        "--very-verbose",
+        dest="loglevel",
+        help="set loglevel to DEBUG",
+        action="store_const",
+        const=logging.DEBUG,
+    )
+    return parser.parse_args(args)
+
+
+def main(args):
+    """Main entry point allowing external calls
+
+    Args:
+      args ([str]): command line parameter list
+    """
+    args = parse_args(args)
+    setup_logging(args.loglevel)
+    database_instances = {}
+    benchmark_instance = benchmarks.grab(
+        args.benchmark,
+        source_type=args.database,
+        harness_type=args.harness,
+        config=args.config,
+    )
+    if len(args.conn_url) < len(args.uuid):
+        args.conn_url = [args.conn_url[0]] * len(args.uuid)
+    if args.metadata_config:
+        metadata_search_map = json.load(args.metadata_config)["metadata"]
+    else:
+        metadata_search_map = benchmark_instance.emit_metadata_search_map()
+    # Compute indices are matched on the identifier, metadata ones on the uuid
+    index_fields = {}
+    for index in benchmark_instance.emit_indices():
+        index_fields[index] = args.identifier + ".keyword"
+    for index in metadata_search_map.keys():
+        index_fields.setdefault(index, "uuid.keyword")
+    indices = {}
+    for uuid_index, uuid in enumerate(args.uuid):
+        conn_url = args.conn_url[uuid_index]
+        if conn_url not in database_instances:
+            database_instances[conn_url] = databases.grab(
+                args.database, conn_url=conn_url
+            )
+        for index, field in index_fields.items():
+            documents = indices.setdefault(index, [])
+            exported = len(documents)
+            for source in database_instances[conn_url].emit_documents(
+                index, field, uuid, scroll_size=args.scroll_size
+            ):
+                documents.append(flatten_source(source))
+            logger.info(
+                "Exported {} documents of {} for {}".format(
+                    len(documents) - exported, index, uuid
+                )
+            )
+    if args.format == "sqlite":
+        from .databases.sqlite import write_tables
+
+        write_tables(args.output_file, indices)
+    else:
+        write_snapshot(args.output_file, indices)
+    logger.info("Script ends here")
+
+
+def render():
+    """Entry point for console_scripts
+    """
+    main(sys.argv[1:])
+
+
+if __name__ == "__main__":
+    render()
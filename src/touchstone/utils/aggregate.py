@@ -0,0 +1,302 @@
+import logging
+import numbers
+
+import numpy as np
+
+
+logger = logging.getLogger("touchstone")
+
+# Maximum number of values per bucket, as the terms buckets of the elasticsearch queries
+BUCKET_SIZE = 10000
+DEFAULT_PERCENTS = [1, 5, 25, 50, 75, 95, 99]
+
+
+def strip_keyword(field):
+    return field.split(".keyword")[0]
+
+
+def metric_specs(aggregations):
+    """
+    Returns the (name, type, field, params) of every aggregation of a
+    compute map, named the way the elasticsearch queries name them
+    """
+    specs = []
+    for key, agg_list in aggregations.items():
+        for aggs in agg_list:
+            if isinstance(aggs, str):
+                specs.append(("{}({})".format(aggs, key), aggs, key, {}))
+            elif isinstance(aggs, dict):
+                for dict_key, dict_value in aggs.items():
+                    specs.append(
+                        ("{}({})".format(dict_key, key), dict_key, key, dict_value)
+                    )
+            else:
+                logger.warn("Ignoring aggregation {}".format(aggs))
+    return specs
+
+
+def wrap_filters(output_dict, filters):
+    """
+    Returns output_dict nested under the k,v pairs of the compute map filters
+    """
+    filter_list = []
+    for key, value in filters.items():
+        filter_list.append(key)
+        filter_list.append(value)
+    for key in reversed(filter_list):
+        output_dict = {strip_keyword(key): output_dict}
+    return output_dict
+
+
+def to_array(values):
+    """
+    Returns a list of document values as a numpy array along with the mask
+    of the documents having a value. Integers, floats, booleans and strings
+    get a native dtype, anything else is kept as objects
+    """
+    kinds = set(map(type, values))
+    missing = type(None) in kinds
+    kinds.discard(type(None))
+    if kinds == {bool}:
+        dtype = bool
+    elif kinds == {str}:
+        dtype = str
+    elif kinds and all(
+        issubclass(kind, numbers.Real) and kind is not bool for kind in kinds
+    ):
+        dtype = (
+            np.int64 if all(issubclass(k, numbers.Integral) for k in kinds) else float
+        )
+    else:
+        array = np.empty(len(values), dtype=object)
+        array[:] = values
+        return array, np.fromiter((v is not None for v in values), bool, len(values))
+    if not missing:
+        return np.array(values, dtype=dtype), np.ones(len(values), dtype=bool)
+    present = np.fromiter((v is not None for v in values), bool, len(values))
+    filled = np.array(values, dtype=object)
+    filled[~present] = dtype()
+    return filled.astype(dtype), present
+
+
+class Table:
+    """
+    Columnar table of documents, every column converted on first use to a
+    numpy array of values and the mask of the documents having a value
+    """
+
+    def __init__(self, columns, count):
+        self.count = count
+        self._columns = columns
+        self._arrays = {}
+
+    def column(self, field):
+        """
+        Returns the (values, present) arrays of field, None if no document has it
+        """
+        if field not in self._arrays:
+            if field not in self._columns:
+                self._arrays[field] = None
+            else:
+                self._arrays[field] = to_array(self._columns[field])
+        return self._arrays[field]
+
+    def equals(self, field, value):
+        """
+        Returns the mask of the documents whose field equals value
+        """
+        column = self.column(field)
+        if column is None:
+            return np.zeros(self.count, dtype=bool)
+        values, present = column
+        kind = values.dtype.kind
+        if kind in "iuf" and isinstance(value, numbers.Real):
+            return present & (values == value)
+        if kind == "b" and isinstance(value, bool):
+            return present & (values == value)
+        if kind == "U" and isinstance(value, str):
+            return present & (values == value)
+        if kind == "O":
+            return present & np.fromiter(
+                (v == value for v in values), bool, len(values)
+            )
+        return np.zeros(self.count, dtype=bool)
+
+
+def _as_key(value):
+    # numpy scalars become the plain python value, as decoded from json
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def _factorize(values):
+    # Codes of every value in the sorted unique values
+    try:
+        return np.unique(values, return_inverse=True)
+    except TypeError:
+        # Unorderable objects, keep the order of first appearance
+        uniques = {}
+        codes = np.fromiter(
+            (uniques.setdefault(v, len(uniques)) for v in values), np.int64, len(values)
+        )
+        keys = np.empty(len(uniques), dtype=object)
+        keys[:] = list(uniques)
+        return keys, codes
+
+
+def _group_levels(table, rows, buckets):
+    """
+    Returns, for every bucket level, the group of every row still bucketed at
+    that level, the rows, and the parent group, key and doc count of every group
+    """
+    levels = []
+    group_ids = np.zeros(len(rows), dtype=np.int64)
+    for bucket in buckets:
+        column = table.column(bucket)
+        if column is None:
+            rows = rows[:0]
+            group_ids = group_ids[:0]
+            values = np.empty(0, dtype=object)
+        else:
+            values, present = column
+            # Documents without the bucket field fall out of the nested buckets
+            kept = present[rows]
+            rows = rows[kept]
+            group_ids = group_ids[kept]
+            values = values[rows]
+        keys, key_codes = _factorize(values)
+        # One group per distinct (parent group, key) pair
+        key_count = max(len(keys), 1)
+        pairs = group_ids * key_count + key_codes
+        unique_pairs, group_ids = np.unique(pairs, return_inverse=True)
+        group_ids = group_ids.reshape(-1)
+        parents = unique_pairs // key_count
+        group_key_codes = unique_pairs % key_count
+        doc_counts = np.bincount(group_ids, minlength=len(unique_pairs))
+        levels.append((parents, keys[group_key_codes], group_key_codes, doc_counts))
+    return levels, rows, group_ids
+
+
+def _metric_values(table, rows, group_ids, group_count, agg_type, field, params):
+    """
+    Returns the value of the metric for every group, a dictionary of values
+    per group for percentiles
+    """
+    column = table.column(strip_keyword(field))
+    if column is None:
+        values = np.empty(0, dtype=float)
+        value_groups = np.empty(0, dtype=np.int64)
+    else:
+        values, present = column
+        kept = present[rows]
+        values = values[rows[kept]].astype(float)
+        value_groups = group_ids[kept]
+    counts = np.bincount(value_groups, minlength=group_count)
+    if agg_type == "value_count":
+        return [int(count) for count in counts]
+    # Sort values by group, then by value within each group
+    order = np.lexsort((values, value_groups))
+    values = values[order]
+    value_groups = value_groups[order]
+    sums = np.bincount(value_groups, weights=values, minlength=group_count)
+    if agg_type == "sum":
+        return [float(value) for value in sums]
+    empty = counts == 0
+    # Position of the first and last value of every group, clipped for empty groups
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    last = max(len(values) - 1, 0)
+    values = values if len(values) else np.zeros(1)
+    if agg_type == "max":
+        result = values[np.clip(starts + counts - 1, 0, last)]
+    elif agg_type == "min":
+        result = values[np.clip(starts, 0, last)]
+    elif agg_type == "avg":
+        result = sums / np.maximum(counts, 1)
+    elif agg_type == "percentiles":
+        results = [{} for _ in range(group_count)]
+        for percent in params.get("percents", DEFAULT_PERCENTS):
+            # Linear interpolation between the closest ranks of every group
+            rank = np.maximum(counts - 1, 0) * percent / 100.0
+            low = np.floor(rank).astype(np.int64)
+            high = np.minimum(low + 1, np.maximum(counts - 1, 0))
+            low_values = values[np.clip(starts + low, 0, last)]
+            high_values = values[np.clip(starts + high, 0, last)]
+            percentile = low_values + (high_values - low_values) * (rank - low)
+            name = str(float(percent))
+            for group in range(group_count):
+                results[group][name] = (
+                    None if empty[group] else float(percentile[group])
+                )
+        return results
+    else:
+        raise ValueError("Unsupported aggregation {}".format(agg_type))
+    return [
+        None if empty[group] else float(result[group]) for group in range(group_count)
+    ]
+
+
+def compute_dict(table, compute_map, identifier, uuid):
+    """
+    Returns the normalized data of a compute map evaluated over a Table,
+    in the same nested structure as the elasticsearch database emits it
+    """
+    mask = table.equals(strip_keyword(identifier), uuid)
+    for key, value in compute_map["filter"].items():
+        mask &= table.equals(strip_keyword(key), value)
+    for exclude in compute_map.get("exclude", []):
+        excluded = np.ones(table.count, dtype=bool)
+        for key, value in exclude.items():
+            excluded &= table.equals(strip_keyword(key), value)
+        mask &= ~excluded
+    rows = np.flatnonzero(mask)
+    if not len(rows):
+        return {}
+    buckets = [strip_keyword(bucket) for bucket in compute_map["buckets"]]
+    levels, rows, group_ids = _group_levels(table, rows, buckets)
+    group_count = len(levels[-1][3])
+    # Metric values of every leaf group, in the order of the compute map
+    metrics = []
+    for name, agg_type, field, params in metric_specs(compute_map["aggregations"]):
+        metrics.append(
+            (
+                name,
+                _metric_values(
+                    table, rows, group_ids, group_count, agg_type, field, params
+                ),
+            )
+        )
+    # Nest the groups level by level, each level holding the bucket dictionary of its groups
+    output_dict = {}
+    parent_dicts = [output_dict]
+    for level, (parents, keys, key_codes, doc_counts) in enumerate(levels):
+        level_dicts = [None] * len(keys)
+        for parent_dict in parent_dicts:
+            if parent_dict is not None:
+                parent_dict[buckets[level]] = {}
+        # Same order as terms buckets: doc count descending, then key ascending
+        ordered = np.lexsort((key_codes, -doc_counts, parents))
+        last_parent = -1
+        bucket_count = 0
+        for group in ordered:
+            parent = parents[group]
+            if parent != last_parent:
+                last_parent = parent
+                bucket_count = 0
+            bucket_count += 1
+            # Groups over the bucket size, or under a dropped parent, are dropped
+            if bucket_count > BUCKET_SIZE or parent_dicts[parent] is None:
+                continue
+            bucket_dict = {}
+            parent_dicts[parent][buckets[level]][_as_key(keys[group])] = bucket_dict
+            level_dicts[group] = bucket_dict
+        parent_dicts = level_dicts
+    for group, leaf_dict in enumerate(parent_dicts):
+        if leaf_dict is None:
+            continue
+        for name, values in metrics:
+            value = values[group]
+            if isinstance(value, dict):
+                for value_name, percentile in value.items():
+                    leaf_dict["{}{}".format(value_name, name)] = {uuid: percentile}
+            else:
+                leaf_dict[name] = {uuid: value}
+    return wrap_filters(output_dict, compute_map["filter"])
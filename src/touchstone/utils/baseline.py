@@ -0,0 +1,124 @@
+import math
+
+
+DEFAULT_BASELINE_PERCENTILES = [50, 90]
+DEFAULT_BASELINE_TIME_FIELD = "timestamp"
+
+
+def baseline_selector(
+    uuids=None,
+    last=None,
+    since=None,
+    until=None,
+    match=None,
+    time_field=DEFAULT_BASELINE_TIME_FIELD,
+    percents=None,
+):
+    """
+    Returns the selector of the runs of a baseline, either listed in uuids
+    or queried as the last runs with a time_field between since and until and
+    the field values of match, along with the percents of the percentiles to
+    compute over them
+    """
+    percents = list(percents or DEFAULT_BASELINE_PERCENTILES)
+    if uuids:
+        if last or since or until or match:
+            raise ValueError("The runs of a baseline are either listed or queried")
+        return {"uuids": list(uuids), "percents": percents}
+    if not (last or since or until or match):
+        raise ValueError("A baseline needs its runs listed or queried")
+    return {
+        "last": last,
+        "since": since,
+        "until": until,
+        "match": dict(match or {}),
+        "time_field": time_field,
+        "percents": percents,
+    }
+
+
+def percentile_name(percent):
+    return "baseline p{:g}".format(percent)
+
+
+def baseline_columns(uuids, percents):
+    """
+    Returns the names under which a baseline result holds the statistics of
+    every metric, the value of every candidate uuid and its delta
+    """
+    columns = [
+        "baseline runs",
+        "baseline mean",
+        "baseline stddev",
+        "baseline min",
+        "baseline max",
+    ]
+    columns.extend(percentile_name(percent) for percent in percents)
+    for uuid in uuids:
+        columns.extend([uuid, delta_name(uuid)])
+    return columns
+
+
+def delta_name(uuid):
+    return "{} delta %".format(uuid)
+
+
+def baseline_values(count, mean, stddev, minimum, maximum, percentiles):
+    """
+    Returns the statistics of a metric over the runs of a baseline, keyed
+    by their column names, percentiles mapping every percent to its value
+    """
+    values = {
+        "baseline runs": count,
+        "baseline mean": mean,
+        "baseline stddev": stddev,
+        "baseline min": minimum,
+        "baseline max": maximum,
+    }
+    for percent, value in percentiles.items():
+        values[percentile_name(percent)] = value
+    return values
+
+
+def baseline_stats(values, percents):
+    """
+    Returns the statistics of the values of a metric, one per run, computed
+    the same way as the extended_stats_bucket and percentiles_bucket
+    aggregations of elasticsearch: population standard deviation and
+    percentiles picking the nearest value, without interpolation
+    """
+    values = sorted(values)
+    count = len(values)
+    mean = sum(values) / count
+    stddev = math.sqrt(sum((value - mean) ** 2 for value in values) / count)
+    percentiles = {}
+    for percent in percents:
+        percentiles[percent] = values[
+            int(math.floor(percent / 100.0 * (count - 1) + 0.5))
+        ]
+    return baseline_values(count, mean, stddev, values[0], values[-1], percentiles)
+
+
+def add_candidate(baseline, uuid, result):
+    """
+    Adds the values of the candidate uuid from its compute map result to the
+    baseline result of the same compute map, along with their delta to the
+    baseline mean in percent
+    """
+    stack = [(result, baseline)]
+    while stack:
+        node, baseline_node = stack.pop()
+        for key, child in node.items():
+            if not isinstance(child, dict):
+                continue
+            baseline_child = baseline_node.setdefault(key, {})
+            if uuid not in child or isinstance(child[uuid], dict):
+                stack.append((child, baseline_child))
+                continue
+            # Values of a metric, keyed by uuid
+            value = child[uuid]
+            baseline_child[uuid] = value
+            mean = baseline_child.get("baseline mean")
+            if isinstance(value, (int, float)) and mean:
+                baseline_child[delta_name(uuid)] = round((value - mean) / mean * 100, 2)
+    return baseline
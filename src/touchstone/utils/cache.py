@@ -0,0 +1,299 @@
+import collections
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+
+logger = logging.getLogger("touchstone")
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")),
+    "touchstone",
+)
+DEFAULT_CACHE_SIZE = 256 * 1024 * 1024
+DEFAULT_CACHE_TTL = 24 * 60 * 60
+DEFAULT_MEMORY_CACHE_ENTRIES = 10000
+
+
+# Version of the stored values, part of every on-disk cache key so entries
+# written in another format are never read back
+CACHE_FORMAT = 2
+# Key tagging an encoded dictionary
+PAIRS = "__pairs__"
+
+
+def _encode(value):
+    # Dictionaries are stored as tagged lists of pairs so non string keys,
+    # such as numeric bucket values, keep their type through json
+    if isinstance(value, dict):
+        return {PAIRS: [[k, _encode(v)] for k, v in value.items()]}
+    if isinstance(value, (list, tuple)):
+        return [_encode(v) for v in value]
+    return value
+
+
+def _decode(value):
+    if isinstance(value, dict):
+        return {k: _decode(v) for k, v in value[PAIRS]}
+    if isinstance(value, list):
+        return [_decode(v) for v in value]
+    return value
+
+
+class ResultCache:
+    """
+    On-disk cache of query results, one json file per key under cache_dir.
+    Entries older than ttl seconds are ignored, and the least recently used
+    ones are evicted once the cache grows over max_size bytes. With refresh,
+    lookups always miss so every result gets fetched and stored again.
+    A cache directory that can not be created or written to disables the
+    cache with a warning, queries then running as without a cache.
+    """
+
+    def __init__(
+        self,
+        cache_dir=DEFAULT_CACHE_DIR,
+        max_size=DEFAULT_CACHE_SIZE,
+        ttl=DEFAULT_CACHE_TTL,
+        refresh=False,
+    ):
+        self._cache_dir = cache_dir
+        self._max_size = max_size
+        self._ttl = ttl
+        self._refresh = refresh
+        self._size = None
+        # Puts come from every thread running queries
+        self._size_lock = threading.Lock()
+        self._disabled = False
+        try:
+            os.makedirs(self._cache_dir, exist_ok=True)
+        except OSError as err:
+            self._disable(err)
+
+    def _disable(self, err):
+        if not self._disabled:
+            logger.warning("Result cache {} disabled: {}".format(self._cache_dir, err))
+        self._disabled = True
+
+    def _path(self, key):
+        normalized = json.dumps([CACHE_FORMAT, key], sort_keys=True, default=str)
+        digest = hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+        return os.path.join(self._cache_dir, digest + ".json")
+
+    def get(self, key):
+        """
+        Returns the value stored for key, None if missing or expired
+        """
+        if self._refresh or self._disabled:
+            return None
+        path = self._path(key)
+        try:
+            stat = os.stat(path)
+            now = time.time()
+            if self._ttl and now - stat.st_mtime > self._ttl:
+                logger.debug("Cache entry {} expired".format(path))
+                return None
+            with open(path, "r", encoding="utf-8") as cache_file:
+                value = _decode(json.load(cache_file))
+            # The access time orders entries for eviction
+            os.utime(path, (now, stat.st_mtime))
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        logger.debug("Cache hit {}".format(path))
+        return value
+
+    def put(self, key, value):
+        """
+        Stores value for key and evicts entries if the cache grew too big
+        """
+        if self._disabled:
+            return
+        try:
+            self._put(key, value)
+        except OSError as err:
+            self._disable(err)
+
+    def _put(self, key, value):
+        path = self._path(key)
+        fd, tmp_path = tempfile.mkstemp(dir=self._cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as cache_file:
+                json.dump(_encode(value), cache_file)
+            with self._size_lock:
+                try:
+                    # An overwritten entry no longer counts
+                    old_size = os.path.getsize(path)
+                except OSError:
+                    old_size = 0
+                os.replace(tmp_path, path)
+                if self._size is None:
+                    self._size = sum(size for _, _, size in self._entries())
+                else:
+                    self._size += os.path.getsize(path) - old_size
+                if self._max_size and self._size > self._max_size:
+                    self._evict()
+        finally:
+            # A full or read-only disk leaves no partial entry behind
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def remember(self, key, value):
+        """
+        Does nothing, only the in-memory cache keeps values for a run
+        """
+
+    def claim(self, key):
+        """
+        Returns None, lookups of the on-disk cache never wait on each other
+        """
+        return None
+
+    def release(self, key):
+        pass
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self._cache_dir):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self._cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_atime, path, stat.st_size))
+        return entries
+
+    def _evict(self):
+        # Called with the size lock held
+        entries = sorted(self._entries())
+        self._size = sum(size for _, _, size in entries)
+        for _, path, size in entries:
+            if self._size <= self._max_size:
+                break
+            logger.debug("Evicting cache entry {}".format(path))
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._size -= size
+
+
+class MemoryCache:
+    """
+    Thread safe in-memory cache of query results, holding at most
+    max_entries of them and evicting the least recently used ones first.
+    Entries older than ttl seconds are ignored. Values are stored as json,
+    so callers are free to modify the ones they get. With a backing cache,
+    such as a ResultCache, missing values are looked up in it and stored
+    values written through to it.
+
+    Concurrent lookups of the same missing key are coalesced: the first
+    one claims the key and the others get an event to wait on until its
+    value is stored or the key released, so a single query fetches it.
+    """
+
+    def __init__(
+        self,
+        max_entries=DEFAULT_MEMORY_CACHE_ENTRIES,
+        ttl=DEFAULT_CACHE_TTL,
+        backing=None,
+    ):
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._backing = backing
+        self._entries = collections.OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def _key(self, key):
+        return json.dumps(key, sort_keys=True, default=str)
+
+    def get(self, key):
+        """
+        Returns the value stored for key, None if missing or expired
+        """
+        memory_key = self._key(key)
+        with self._lock:
+            entry = self._entries.get(memory_key)
+            if entry is not None:
+                stored, encoded = entry
+                if self._ttl and time.time() - stored > self._ttl:
+                    del self._entries[memory_key]
+                    entry = None
+                else:
+                    self._entries.move_to_end(memory_key)
+        if entry is not None:
+            logger.debug("Memory cache hit {}".format(memory_key))
+            return _decode(json.loads(encoded))
+        if self._backing is None:
+            return None
+        value = self._backing.get(key)
+        if value is not None:
+            self._store(memory_key, value)
+        return value
+
+    def put(self, key, value):
+        """
+        Stores value for key, evicting the least recently used entries if
+        the cache is full, and wakes up the lookups waiting on key
+        """
+        if self._backing is not None:
+            self._backing.put(key, value)
+        self._store(self._key(key), value)
+
+    def remember(self, key, value):
+        """
+        Stores value for key like put, without writing it through to the
+        backing cache
+        """
+        self._store(self._key(key), value)
+
+    def _store(self, memory_key, value):
+        encoded = json.dumps(_encode(value))
+        with self._lock:
+            self._entries[memory_key] = (time.time(), encoded)
+            self._entries.move_to_end(memory_key)
+            while self._max_entries and len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+            event = self._in_flight.pop(memory_key, None)
+        if event is not None:
+            event.set()
+
+    def claim(self, key):
+        """
+        Claims the missing key for the caller, who then has to put its value
+        or release it, returning None. If the key is already claimed, returns
+        the event set once its value is stored or the key released instead,
+        already set if the value got stored since the lookup.
+        """
+        key = self._key(key)
+        with self._lock:
+            if key in self._entries:
+                event = threading.Event()
+                event.set()
+                return event
+            event = self._in_flight.get(key)
+            if event is not None:
+                return event
+            self._in_flight[key] = threading.Event()
+        return None
+
+    def release(self, key):
+        """
+        Releases a claimed key whose value is not going to be stored, waking
+        up the lookups waiting on it
+        """
+        key = self._key(key)
+        with self._lock:
+            event = self._in_flight.pop(key, None)
+        if event is not None:
+            event.set()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
@@ -0,0 +1,69 @@
+import gzip
+import json
+import logging
+
+
+logger = logging.getLogger("touchstone")
+
+SNAPSHOT_VERSION = 1
+
+
+def flatten_source(source, prefix="", output=None):
+    """
+    Returns the document source as a flat dictionary keyed by the dotted
+    path of every field, i.e. {"data": {"READ": 1}} becomes {"data.READ": 1}
+    """
+    if output is None:
+        output = {}
+    for key, value in source.items():
+        if isinstance(value, dict):
+            flatten_source(value, prefix + key + ".", output)
+        else:
+            output[prefix + key] = value
+    return output
+
+
+def to_columns(documents):
+    """
+    Returns the flat documents as columns, a dictionary of field name to the
+    list of values of every document, None where a document lacks the field
+    """
+    columns = {}
+    for position, document in enumerate(documents):
+        for field, value in document.items():
+            if field not in columns:
+                columns[field] = [None] * len(documents)
+            columns[field][position] = value
+    return columns
+
+
+def write_snapshot(path, indices):
+    """
+    Writes the documents of every index, given as {index: [flat documents]},
+    to a gzip compressed columnar json file
+    """
+    snapshot = {"version": SNAPSHOT_VERSION, "indices": {}}
+    for index, documents in indices.items():
+        snapshot["indices"][index] = {
+            "count": len(documents),
+            "columns": to_columns(documents),
+        }
+    with gzip.open(path, "wt", encoding="utf-8") as snapshot_file:
+        json.dump(snapshot, snapshot_file, separators=(",", ":"))
+    logger.info("Wrote snapshot {}".format(path))
+
+
+def read_snapshot(path):
+    """
+    Returns the indices of a snapshot file as {index: {"count": int,
+    "columns": {field: [values]}}}
+    """
+    with gzip.open(path, "rt", encoding="utf-8") as snapshot_file:
+        snapshot = json.load(snapshot_file)
+    if snapshot.get("version") != SNAPSHOT_VERSION:
+        raise ValueError(
+            "Unsupported snapshot version {} in {}".format(
+                snapshot.get("version"), path
+            )
+        )
+    return snapshot["indices"]
@@ -1,26 +1,263 @@
-import copy
+import collections
+import itertools
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 
-def mergedicts(dict1, dict2, parent_dict={}, parent_key=""):
-    if isinstance(dict1, dict):
-        for k in dict1:
-            if k in dict2:
-                mergedicts(dict1[k], dict2[k], dict2, k)
+class _Node:
+    """
+    Trie node of a ResultStore, either a leaf holding a value or a branch
+    holding its children in insertion order
+    """
+
+    __slots__ = ("children", "value")
+
+    def __init__(self):
+        self.children = {}
+        self.value = None
+
+
+class ResultStore:
+    """
+    Ordered store of nested results, kept as a trie keyed by path. Merging a
+    nested dictionary and walking the stored values both visit every node
+    once, and keys keep the order in which they were first merged.
+    """
+
+    __slots__ = ("_root",)
+
+    def __init__(self):
+        self._root = _Node()
+
+    def __bool__(self):
+        return bool(self._root.children)
+
+    def merge(self, data):
+        """
+        Merges the nested dictionary data, its values replacing the ones
+        stored under the same path
+        """
+        stack = [(data, self._root)]
+        while stack:
+            data, node = stack.pop()
+            children = node.children
+            for key, value in data.items():
+                child = children.get(key)
+                if child is None:
+                    child = children[key] = _Node()
+                if isinstance(value, dict):
+                    if child.children is None:
+                        child.children = {}
+                    stack.append((value, child))
+                else:
+                    child.children = None
+                    child.value = value
+
+    def rows(self, headers=()):
+        """
+        Yields a row for every stored value, made of the keys of its path
+        that are not in headers followed by the value
+        """
+        headers = set(headers)
+        stack = [(iter(self._root.children.items()), ())]
+        while stack:
+            children, row = stack[-1]
+            for key, child in children:
+                child_row = row if key in headers else row + (key,)
+                if child.children is None:
+                    yield list(child_row) + [child.value]
+                else:
+                    stack.append((iter(child.children.items()), child_row))
+                    break
             else:
-                dict2[k] = {}
-                mergedicts(dict1[k], dict2[k], dict2, k)
-    # dict1 is a value, so we add it
-    else:
-        parent_dict[parent_key] = dict1
-
-
-def flatten_and_discard(data, headers, row_list=[], row=[]):
-    if isinstance(data, dict):
-        for k in data:
-            new_row = copy.deepcopy(row)
-            if k not in headers:
-                new_row.append(k)
-            flatten_and_discard(data[k], headers, row_list, new_row)
-    else:
-        row.append(data)
-        row_list.append(row)
+                stack.pop()
+
+    def to_dict(self):
+        """
+        Returns the stored values as a nested dictionary
+        """
+        output_dict = {}
+        stack = [(self._root, output_dict)]
+        while stack:
+            node, output = stack.pop()
+            for key, child in node.children.items():
+                if child.children is None:
+                    output[key] = child.value
+                else:
+                    output[key] = {}
+                    stack.append((child, output[key]))
+        return output_dict
+
+
+def run_ordered(calls, jobs=1):
+    """
+    Runs every (function, kwargs) pair from calls and yields the results
+    in the same order as calls. With more than one job, calls run on a
+    thread pool of that size while results are consumed, at most twice as
+    many calls as jobs being submitted ahead of the consumer.
+    """
+    if jobs <= 1:
+        for func, kwargs in calls:
+            yield func(**kwargs)
+        return
+    calls = iter(calls)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = collections.deque()
+        for func, kwargs in itertools.islice(calls, jobs * 2):
+            futures.append(executor.submit(func, **kwargs))
+        while futures:
+            result = futures.popleft().result()
+            for func, kwargs in itertools.islice(calls, 1):
+                futures.append(executor.submit(func, **kwargs))
+            yield result
+
+
+class _Prefetched:
+    """
+    Iterator over the items produced by the thread of prefetch. Closing it,
+    or dropping it even before its first item, stops the thread.
+    """
+
+    def __init__(self, items, stopped):
+        self._items = items
+        self._stopped = stopped
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._stopped.is_set():
+            raise StopIteration
+        produced, item = self._items.get()
+        if not produced:
+            self.close()
+            if item is not None:
+                raise item
+            raise StopIteration
+        return item
+
+    def close(self):
+        self._stopped.set()
+
+    def __del__(self):
+        self.close()
+
+
+def prefetch(iterable, size):
+    """
+    Returns an iterator over the items of iterable, which a background
+    thread starts producing right away and keeps up to size items ahead of
+    the consumer. Errors raised by iterable are raised to the consumer.
+    Once the iterator is closed or dropped, the thread closes iterable.
+    With a size of 0, iterable is consumed as usual.
+    """
+    if size <= 0:
+        return iter(iterable)
+    items = queue.Queue(maxsize=size)
+    stopped = threading.Event()
+
+    def put(item):
+        # Give up once the consumer went away, instead of blocking forever
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((True, item)):
+                    return
+        except Exception as err:
+            put((False, err))
+            return
+        finally:
+            # Generators release what they hold, such as cache claims
+            close = getattr(iterable, "close", None)
+            if close is not None:
+                close()
+        put((False, None))
+
+    # The thread only holds the queue and the event, so dropping the
+    # iterator stops it
+    threading.Thread(target=produce, daemon=True).start()
+    return _Prefetched(items, stopped)
+
+
+# asyncio is imported by the functions using it, it is slow to import
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def background_loop():
+    """
+    Returns the event loop running on a background daemon thread, started
+    on first use, which runs the coroutines of every asynchronous database
+    """
+    import asyncio
+
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, daemon=True).start()
+        return _loop
+
+
+def run_coroutine(coroutine):
+    """
+    Runs coroutine on the background event loop and returns its result
+    """
+    import asyncio
+
+    return asyncio.run_coroutine_threadsafe(coroutine, background_loop()).result()
+
+
+async def _bounded(semaphore, func, kwargs):
+    async with semaphore:
+        return await func(**kwargs)
+
+
+async def _semaphore(limit):
+    import asyncio
+
+    return asyncio.Semaphore(limit)
+
+
+def async_limiter(limit):
+    """
+    Returns a semaphore of the background event loop letting at most limit
+    coroutines run at the same time, to share between run_ordered_async calls
+    """
+    # Created on the background event loop, which it is bound to
+    return run_coroutine(_semaphore(limit))
+
+
+def run_ordered_async(calls, limiter, ahead):
+    """
+    Runs every (coroutine function, kwargs) pair from calls on the background
+    event loop, as many at the same time as the limiter semaphore allows, and
+    yields the results in the same order as calls. At most ahead calls are
+    scheduled ahead of the consumer.
+    """
+    import asyncio
+
+    loop = background_loop()
+    calls = iter(calls)
+    futures = collections.deque()
+
+    def schedule(count):
+        for func, kwargs in itertools.islice(calls, count):
+            futures.append(
+                asyncio.run_coroutine_threadsafe(_bounded(limiter, func, kwargs), loop)
+            )
+
+    schedule(ahead)
+    while futures:
+        result = futures.popleft().result()
+        schedule(1)
+        yield result
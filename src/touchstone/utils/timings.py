@@ -0,0 +1,155 @@
+import contextlib
+import json
+import threading
+import time
+
+
+# Recorder of the spans of the run, None unless timings are enabled
+_timings = None
+
+
+def compute_label(compute_map):
+    """
+    Returns a short description of a compute map, its filters and buckets
+    """
+    filters = [
+        "{}={}".format(key.split(".keyword")[0], value)
+        for key, value in compute_map["filter"].items()
+    ]
+    buckets = [bucket.split(".keyword")[0] for bucket in compute_map["buckets"]]
+    return "{} by {}".format(",".join(filters) or "*", ",".join(buckets))
+
+
+def count_buckets(aggregations):
+    """
+    Returns the number of buckets in the aggregations of a raw response,
+    at every nesting level
+    """
+    count = 0
+    stack = [aggregations]
+    while stack:
+        level = stack.pop()
+        for value in level.values():
+            if not isinstance(value, dict):
+                continue
+            buckets = value.get("buckets")
+            if isinstance(buckets, dict):
+                # Named buckets of a filters aggregation
+                buckets = list(buckets.values())
+            if isinstance(buckets, list):
+                count += len(buckets)
+                stack.extend(buckets)
+            elif "buckets" not in value:
+                # Single bucket aggregations nest their sub aggregations
+                stack.append(value)
+    return count
+
+
+class Timings:
+    """
+    Thread safe recorder of timed spans. Every span is a dictionary with the
+    stage it times, its labels, its wall time in seconds and any figure
+    added to it while it runs.
+    """
+
+    def __init__(self):
+        self._spans = []
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, stage, **labels):
+        """
+        Context manager timing its block as a span of stage, yielding the
+        span so figures can be added to it
+        """
+        record = dict(labels, stage=stage)
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["wall"] = time.perf_counter() - start
+            with self._lock:
+                self._spans.append(record)
+
+    def spans(self):
+        with self._lock:
+            return list(self._spans)
+
+    def write_json_lines(self, output_file):
+        """
+        Writes every span as a line of json to output_file
+        """
+        for record in self.spans():
+            output_file.write(json.dumps(record, default=str) + "\n")
+
+    def summary(self):
+        """
+        Returns the totals of the spans of every stage and index, in order
+        of first appearance, as a list of rows with times rounded to 0.1ms
+        """
+        totals = {}
+        for record in self.spans():
+            indices = sorted({query["index"] for query in record.get("queries", [])})
+            key = (record["stage"], ",".join(indices))
+            if key not in totals:
+                totals[key] = {
+                    "stage": key[0],
+                    "index": key[1],
+                    "spans": 0,
+                    "wall (s)": 0.0,
+                    "build (s)": 0.0,
+                    "took (s)": 0.0,
+                    "requests": 0,
+                    "bytes": 0,
+                    "buckets": 0,
+                }
+            row = totals[key]
+            row["spans"] += 1
+            row["wall (s)"] += record["wall"]
+            row["build (s)"] += record.get("build", 0.0)
+            row["took (s)"] += record.get("took", 0) / 1000.0
+            row["requests"] += record.get("requests", 0)
+            row["bytes"] += record.get("bytes", 0)
+            row["buckets"] += record.get("buckets", 0)
+        for row in totals.values():
+            for column in ["wall (s)", "build (s)", "took (s)"]:
+                row[column] = round(row[column], 4)
+        return list(totals.values())
+
+
+class _NoSpan:
+    # Shared context manager of the spans of a run without timings
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+def enable_timings():
+    """
+    Starts recording spans, returning the recorder
+    """
+    global _timings
+    _timings = Timings()
+    return _timings
+
+
+def get_timings():
+    """
+    Returns the recorder of the spans, None if timings are not enabled
+    """
+    return _timings
+
+
+def span(stage, **labels):
+    """
+    Context manager timing its block as a span of stage when timings are
+    enabled, yielding the span or None
+    """
+    if _timings is None:
+        return _NO_SPAN
+    return _timings.span(stage, **labels)
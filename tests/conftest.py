@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+    Fixtures and helpers shared by the touchstone tests
+"""
+import pytest
+
+# Compute map of the tests, one bucket level and a single metric
+COMPUTE_MAP = {
+    "filter": {"test_type.keyword": "stream"},
+    "buckets": ["protocol.keyword"],
+    "aggregations": {"throughput": ["max"]},
+}
+
+
+def run_steps(steps, replies):
+    """Runs query steps, answering their requests with replies in order
+
+    Returns:
+      (object, [object]): result of the steps and the requests they yielded
+    """
+    requests = []
+    replies = iter(replies)
+    try:
+        request = next(steps)
+        while True:
+            requests.append(request)
+            reply = next(replies)
+            if isinstance(reply, Exception):
+                request = steps.throw(reply)
+            else:
+                request = steps.send(reply)
+    except StopIteration as stop:
+        return stop.value, requests
+
+
+@pytest.fixture
+def compute_map():
+    return {
+        "filter": dict(COMPUTE_MAP["filter"]),
+        "buckets": list(COMPUTE_MAP["buckets"]),
+        "aggregations": dict(COMPUTE_MAP["aggregations"]),
+    }
+
+
+@pytest.fixture
+def result_cache(tmp_path):
+    """On-disk result cache in a temporary directory"""
+    from touchstone.utils.cache import ResultCache
+
+    return ResultCache(cache_dir=str(tmp_path / "cache"))
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from touchstone.utils import aggregate  # noqa: E402
+from touchstone.utils.aggregate import Table, compute_dict, to_array  # noqa: E402
+from touchstone.utils.columnar import to_columns  # noqa: E402
+
+DOCUMENTS = [
+    {"uuid": "u1", "protocol": "tcp", "size": 64, "throughput": 10},
+    {"uuid": "u1", "protocol": "tcp", "size": 64, "throughput": 20},
+    {"uuid": "u1", "protocol": "tcp", "size": 1024, "throughput": 40},
+    {"uuid": "u1", "protocol": "udp", "size": 64, "throughput": 5},
+    {"uuid": "u1", "protocol": "udp", "throughput": 7},
+    {"uuid": "u2", "protocol": "tcp", "size": 64, "throughput": 100},
+]
+
+COMPUTE_MAP = {
+    "filter": {},
+    "buckets": ["protocol.keyword", "size"],
+    "aggregations": {
+        "throughput": [
+            "max",
+            "min",
+            "avg",
+            "sum",
+            "value_count",
+            {"percentiles": {"percents": [50]}},
+        ]
+    },
+}
+
+
+def table(documents=DOCUMENTS):
+    return Table(to_columns(documents), len(documents))
+
+
+def test_to_array_dtypes():
+    assert to_array([1, 2])[0].dtype == np.int64
+    assert to_array([1, 2.5])[0].dtype == float
+    assert to_array(["a", "b"])[0].dtype.kind == "U"
+    values, present = to_array([1, None, 3])
+    assert values.tolist() == [1, 0, 3]
+    assert present.tolist() == [True, False, True]
+    assert to_array([1, "a"])[0].dtype == object
+
+
+def test_compute_dict_metrics():
+    result = compute_dict(table(), COMPUTE_MAP, "uuid.keyword", "u1")
+    tcp = result["protocol"]["tcp"]["size"]
+    assert list(result["protocol"]) == ["tcp", "udp"]
+    # Buckets ordered by doc count, then key
+    assert list(tcp) == [64, 1024]
+    assert tcp[64] == {
+        "max(throughput)": {"u1": 20.0},
+        "min(throughput)": {"u1": 10.0},
+        "avg(throughput)": {"u1": 15.0},
+        "sum(throughput)": {"u1": 30.0},
+        "value_count(throughput)": {"u1": 2},
+        "50.0percentiles(throughput)": {"u1": 15.0},
+    }
+    # Documents without the bucket field fall out of the nested buckets
+    assert list(result["protocol"]["udp"]["size"]) == [64]
+
+
+def test_compute_dict_filters_and_excludes():
+    compute_map = dict(COMPUTE_MAP, filter={"protocol.keyword": "tcp"})
+    compute_map["exclude"] = [{"size": 1024}]
+    result = compute_dict(table(), compute_map, "uuid", "u1")
+    assert list(result["protocol"]["tcp"]["protocol"]["tcp"]["size"]) == [64]
+
+
+def test_compute_dict_without_documents():
+    assert compute_dict(table(), COMPUTE_MAP, "uuid", "u3") == {}
+
+
+def test_compute_dict_capped_levels(monkeypatch):
+    monkeypatch.setattr(aggregate, "BUCKET_SIZE", 1)
+    result = compute_dict(table(), COMPUTE_MAP, "uuid", "u1")
+    # Only the largest bucket of every level is kept, the dropped udp one
+    # takes its nested buckets with it
+    assert list(result["protocol"]) == ["tcp"]
+    assert list(result["protocol"]["tcp"]["size"]) == [64]
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+import io
+import json
+import math
+
+import pytest
+
+from touchstone.databases.sqlite import Sqlite, write_tables
+from touchstone.session import ComparisonSession
+from touchstone.utils.cache import MemoryCache
+from touchstone.utils.baseline import add_candidate, baseline_selector, baseline_stats
+from touchstone.utils.columnar import flatten_source
+
+from conftest import run_steps
+
+SOURCES = [
+    {"uuid": "u1", "test_type": "stream", "protocol": "tcp", "throughput": 10},
+    {"uuid": "u1", "test_type": "stream", "protocol": "tcp", "throughput": 12},
+    {"uuid": "u2", "test_type": "stream", "protocol": "tcp", "throughput": 30},
+    {"uuid": "u3", "test_type": "stream", "protocol": "tcp", "throughput": 18},
+    {"uuid": "u3", "test_type": "stream", "protocol": "udp", "throughput": 5},
+]
+
+
+def assert_close(result, expected):
+    assert result.keys() == expected.keys()
+    for key, value in expected.items():
+        if isinstance(value, dict):
+            assert_close(result[key], value)
+        else:
+            assert result[key] == pytest.approx(value)
+
+
+def test_baseline_stats():
+    stats = baseline_stats([40, 10, 30, 20], [50, 90])
+    assert stats == {
+        "baseline runs": 4,
+        "baseline mean": 25.0,
+        "baseline stddev": pytest.approx(math.sqrt(125)),
+        "baseline min": 10,
+        "baseline max": 40,
+        # Nearest rank, as percentiles_bucket
+        "baseline p50": 30,
+        "baseline p90": 40,
+    }
+
+
+def test_add_candidate():
+    baseline = {"protocol": {"tcp": {"max(throughput)": {"baseline mean": 20.0}}}}
+    result = {
+        "protocol": {
+            "tcp": {"max(throughput)": {"c1": 25}},
+            "udp": {"max(throughput)": {"c1": 5}},
+        }
+    }
+    add_candidate(baseline, "c1", result)
+    assert baseline["protocol"]["tcp"]["max(throughput)"] == {
+        "baseline mean": 20.0,
+        "c1": 25,
+        "c1 delta %": 25.0,
+    }
+    # No baseline to compare to, only the value
+    assert baseline["protocol"]["udp"]["max(throughput)"] == {"c1": 5}
+
+
+@pytest.mark.parametrize(
+    "selector", [{}, {"uuids": ["u1"], "last": 5}, {"uuids": [], "percents": [50]}]
+)
+def test_invalid_selector(selector):
+    with pytest.raises(ValueError):
+        baseline_selector(**selector)
+
+
+def test_selector_defaults():
+    assert baseline_selector(uuids=["u1"]) == {"uuids": ["u1"], "percents": [50, 90]}
+    assert baseline_selector(last=5)["time_field"] == "timestamp"
+
+
+@pytest.fixture
+def path(tmp_path):
+    path = str(tmp_path / "results.db")
+    write_tables(path, {"results": [flatten_source(source) for source in SOURCES]})
+    return path
+
+
+def test_runs_selected_from_database_without_selection(path):
+    session = ComparisonSession("uperf", database="sqlite")
+    # Raised by the call, before any result is iterated or written
+    with pytest.raises(ValueError, match="list the uuids"):
+        session.baseline(["u1"], path, {"last": 5})
+
+
+def test_server_side_baseline_matches_local_one(path, compute_map):
+    elasticsearch = pytest.importorskip("touchstone.databases.elasticsearch")
+    runs = ["u1", "u2", "u3"]
+    percents = [50, 90]
+    expected = Sqlite(path).emit_baseline_dict(
+        runs, compute_map, "results", "uuid", percents
+    )
+    # Reply of the cluster to the baseline query over the same documents
+    tcp_stats = {
+        "count": 3,
+        "avg": 20.0,
+        "std_deviation": math.sqrt(56),
+        "min": 12.0,
+        "max": 30.0,
+    }
+    reply = {
+        "hits": {"total": {"value": 5}},
+        "aggregations": {
+            "protocol": {
+                "buckets": [
+                    {
+                        "key": "tcp",
+                        "doc_count": 4,
+                        "_s0": tcp_stats,
+                        "_s0_percentiles": {"values": {"50.0": 18.0, "90.0": 30.0}},
+                    },
+                    {
+                        "key": "udp",
+                        "doc_count": 1,
+                        "_s0": {
+                            "count": 1,
+                            "avg": 5.0,
+                            "std_deviation": 0.0,
+                            "min": 5.0,
+                            "max": 5.0,
+                        },
+                        "_s0_percentiles": {"values": {"50.0": 5.0, "90.0": 5.0}},
+                    },
+                ]
+            }
+        },
+    }
+    database = elasticsearch.Elasticsearch(conn_url="http://localhost:9200")
+    result, requests = run_steps(
+        database._baseline_dict_steps(runs, compute_map, "results", "uuid", percents),
+        [reply],
+    )
+    assert len(requests) == 1
+    assert_close(result, expected)
+
+
+def test_baseline_leaves_out_stats(compute_map):
+    elasticsearch = pytest.importorskip("touchstone.databases.elasticsearch")
+    compute_map["aggregations"] = {
+        "throughput": ["stats", {"percentile_ranks": {"values": [10]}}]
+    }
+    database = elasticsearch.Elasticsearch(conn_url="http://localhost:9200")
+    request = next(
+        database._baseline_dict_steps(["u1"], compute_map, "results", "uuid", [50])
+    )
+    aggs = request.search.to_dict()["aggs"]["protocol"]["aggs"]
+    assert list(aggs["_runs"]["aggs"]) == ["_m1"]
+    assert aggs["_s0"]["extended_stats_bucket"]["buckets_path"] == "_runs>_m1[10.0]"
+
+
+CONFIG = json.dumps(
+    {
+        "elasticsearch": {
+            "metadata": {},
+            "ripsaw": {
+                "results": [
+                    {
+                        "filter": {"test_type.keyword": "stream"},
+                        "buckets": ["protocol.keyword"],
+                        "aggregations": {"throughput": ["max"]},
+                    }
+                ]
+            },
+        }
+    }
+)
+
+
+def tcp_baseline(session, candidate, path, selector):
+    results = list(session.baseline([candidate], path, selector))
+    return results[0][2]["test_type"]["stream"]["protocol"]["tcp"]["max(throughput)"]
+
+
+def test_selected_runs_exclude_candidates(path, monkeypatch):
+    # Latest run first, the candidate u3 being the newest one
+    latest_first = ["u3", "u2", "u1"]
+
+    def emit_baseline_runs(self, index, identifier, time_field, last=None, **kwargs):
+        exclude = kwargs.get("exclude") or []
+        return [run for run in latest_first if run not in exclude][:last]
+
+    monkeypatch.setattr(Sqlite, "emit_baseline_runs", emit_baseline_runs)
+    session = ComparisonSession("uperf", database="sqlite", config=io.StringIO(CONFIG))
+    baseline = tcp_baseline(session, "u3", path, {"last": 2})
+    assert baseline["baseline runs"] == 2
+    assert baseline["baseline min"] == 12.0
+    assert baseline["baseline max"] == 30.0
+    assert baseline["u3"] == 18.0
+
+
+def test_listed_runs_exclude_candidates_per_candidate(path):
+    session = ComparisonSession(
+        "uperf", database="sqlite", config=io.StringIO(CONFIG), cache=MemoryCache()
+    )
+    selector = {"uuids": ["u1", "u2", "u3"]}
+    assert tcp_baseline(session, "u3", path, selector)["baseline mean"] == 21.0
+    # Cached per candidate, the baseline of u1 is not the one of u3
+    assert tcp_baseline(session, "u1", path, selector)["baseline mean"] == 24.0
+
+
+def test_run_selection_query_excludes_candidates():
+    elasticsearch = pytest.importorskip("touchstone.databases.elasticsearch")
+    database = elasticsearch.Elasticsearch(conn_url="http://localhost:9200")
+    steps = database._baseline_runs_steps(
+        "results", "uuid", "timestamp", 2, None, None, None, ["u3"]
+    )
+    request = next(steps)
+    query = request.search.to_dict()["query"]
+    assert {"bool": {"must_not": [{"terms": {"uuid.keyword": ["u3"]}}]}} in query[
+        "bool"
+    ]["filter"]
+    reply = {"aggregations": {"_runs": {"buckets": [{"key": "u2"}, {"key": "u1"}]}}}
+    runs, _ = run_steps(
+        database._baseline_runs_steps(
+            "results", "uuid", "timestamp", 2, None, None, None, ["u3"]
+        ),
+        [reply],
+    )
+    assert runs == ["u2", "u1"]
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+import os
+import sqlite3
+
+import pytest
+
+from touchstone.databases.sqlite import Sqlite
+from touchstone.utils.cache import MemoryCache, ResultCache
+
+# Values of every shape the cache holds: metadata lists, numeric bucket keys
+# and nested dictionaries
+VALUES = [
+    {"flags": ["ab", "cd"], "cpus": [1, 2, 3]},
+    {"protocol": {1: {"max(throughput)": {"u1": 1.5}}, 2.5: {}, "tcp": {}}},
+    {"pods": [{"name": "a", "ports": [80]}, {"name": "b", "ports": []}]},
+    {"empty": {}, "none": None, "nested": [[1, 2], ["a"]]},
+]
+
+
+@pytest.mark.parametrize("value", VALUES)
+def test_result_cache_round_trip(result_cache, value):
+    result_cache.put(["key"], value)
+    assert result_cache.get(["key"]) == value
+
+
+@pytest.mark.parametrize("value", VALUES)
+def test_memory_cache_round_trip(value):
+    cache = MemoryCache()
+    cache.put(["key"], value)
+    assert cache.get(["key"]) == value
+
+
+def test_memory_cache_reads_backing(result_cache):
+    result_cache.put(["key"], VALUES[0])
+    assert MemoryCache(backing=result_cache).get(["key"]) == VALUES[0]
+
+
+def test_result_cache_ignores_corrupt_entry(result_cache):
+    result_cache.put(["key"], VALUES[0])
+    with open(result_cache._path(["key"]), "w") as cache_file:
+        cache_file.write('{"not": "pairs"}')
+    assert result_cache.get(["key"]) is None
+
+
+def test_result_cache_size_on_overwrite(result_cache):
+    result_cache.put(["key"], {"value": "x" * 100})
+    result_cache.put(["other"], {"value": 1})
+    for _ in range(5):
+        result_cache.put(["key"], {"value": "x" * 100})
+    entries = result_cache._entries()
+    assert len(entries) == 2
+    assert result_cache._size == sum(size for _, _, size in entries)
+
+
+def test_result_cache_unusable_directory(tmp_path):
+    blocker = tmp_path / "file"
+    blocker.write_text("")
+    cache = ResultCache(cache_dir=str(blocker / "cache"))
+    # Runs as without a cache
+    cache.put(["key"], VALUES[0])
+    assert cache.get(["key"]) is None
+
+
+def test_result_cache_failed_put(result_cache, monkeypatch):
+    def replace(src, dst):
+        raise OSError(28, "No space left on device")
+
+    monkeypatch.setattr(os, "replace", replace)
+    result_cache.put(["key"], VALUES[0])
+    monkeypatch.undo()
+    assert os.listdir(result_cache._cache_dir) == []
+    # Disabled after the failure
+    result_cache.put(["key"], VALUES[0])
+    assert result_cache.get(["key"]) is None
+
+
+def test_compute_cache_key_scope(result_cache, compute_map):
+    query = {
+        "uuid": "u1",
+        "compute_map": compute_map,
+        "index": "results",
+        "identifier": "uuid",
+    }
+    plain = Sqlite(":memory:", cache=result_cache)
+    composite = Sqlite(
+        ":memory:", cache=result_cache, cache_scope={"composite_size": 100}
+    )
+    plain.cache_compute_dict({"cached": {}}, **query)
+    assert plain.get_cached_compute_dict(**query) == {"cached": {}}
+    assert composite.get_cached_compute_dict(**query) is None
+
+
+def test_file_written_again_misses(result_cache, compute_map, tmp_path):
+    path = str(tmp_path / "results.db")
+    sqlite3.connect(path).close()
+    query = {
+        "uuid": "u1",
+        "compute_map": compute_map,
+        "index": "results",
+        "identifier": "uuid",
+    }
+    database = Sqlite(path, cache=result_cache)
+    database.cache_compute_dict({"cached": {}}, **query)
+    assert database.get_cached_compute_dict(**query) == {"cached": {}}
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert database.get_cached_compute_dict(**query) is None
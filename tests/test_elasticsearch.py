@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from conftest import run_steps
+
+elasticsearch = pytest.importorskip("touchstone.databases.elasticsearch")
+
+
+def database(**kwargs):
+    return elasticsearch.Elasticsearch(conn_url="http://localhost:9200", **kwargs)
+
+
+def composite_page(keys, after=True):
+    buckets = [
+        {"key": {"protocol": key}, "doc_count": 1, "max(throughput)": {"value": 1.0}}
+        for key in keys
+    ]
+    composite = {"buckets": buckets}
+    if after and keys:
+        composite["after_key"] = {"protocol": keys[-1]}
+    return {"hits": {"total": {"value": 1}}, "aggregations": {"_composite": composite}}
+
+
+def test_composite_stops_on_short_page(compute_map):
+    steps = database(composite_size=2)._compute_dict_steps(
+        "u1", compute_map, "ripsaw-uperf-results", "uuid"
+    )
+    result, requests = run_steps(
+        steps, [composite_page(["tcp", "udp"]), composite_page(["unix"])]
+    )
+    # The short second page ends the paging without an empty third request
+    assert len(requests) == 2
+    assert list(result["test_type"]["stream"]["protocol"]) == ["tcp", "udp", "unix"]
+
+
+def test_composite_pages_until_empty_page(compute_map):
+    steps = database(composite_size=2)._compute_dict_steps(
+        "u1", compute_map, "ripsaw-uperf-results", "uuid"
+    )
+    result, requests = run_steps(
+        steps, [composite_page(["tcp", "udp"]), composite_page([])]
+    )
+    assert len(requests) == 2
+    assert list(result["test_type"]["stream"]["protocol"]) == ["tcp", "udp"]
+
+
+def test_search_requests_carry_index_and_params(compute_map):
+    request, aggs_list = database(lean_queries=True)._build_compute_search(
+        "u1", compute_map, "ripsaw-uperf-results", "uuid"
+    )
+    assert request.index == "ripsaw-uperf-results"
+    assert request.params == {"filter_path": elasticsearch.LEAN_FILTER_PATH}
+    assert request.search.to_dict()["size"] == 0
+    assert aggs_list == ["max(throughput)"]
+    request, _ = database()._build_compute_search(
+        "u1", compute_map, "ripsaw-uperf-results", "uuid"
+    )
+    assert request.params == {}
+
+
+def test_scroll_request_is_not_hedged():
+    es = database()
+    _, requests = run_steps(
+        es._scroll_hits_steps(elasticsearch.Search(), "metadata", lambda hits: None),
+        [{"_scroll_id": "s1", "hits": {"hits": []}}, {}],
+    )
+    assert requests[0].index == "metadata"
+    assert requests[0].params == {"scroll": elasticsearch.PAGING_KEEP_ALIVE}
+    assert not es._hedgeable(requests[0], requests[0].search.to_dict())
+    assert requests[1].method == "clear_scroll"
+
+
+def hits_page(count, **extra):
+    hits = [{"_source": {}, "sort": [i]} for i in range(count)]
+    return dict(extra, hits={"hits": hits})
+
+
+def test_point_in_time_closed_on_error():
+    requests = []
+    steps = database()._all_hits_steps(
+        elasticsearch.Search(), "metadata", lambda hits: None
+    )
+    requests.append(next(steps))
+    requests.append(steps.send({"id": "p1"}))
+    requests.append(
+        steps.throw(elasticsearch.elasticsearch.TransportError(500, "failed"))
+    )
+    assert requests[-1].method == "close_point_in_time"
+    assert requests[-1].params == {"body": {"id": "p1"}}
+    with pytest.raises(elasticsearch.elasticsearch.TransportError):
+        steps.send({})
+
+
+def test_scroll_cleared_on_error():
+    steps = database()._scroll_hits_steps(
+        elasticsearch.Search(), "metadata", lambda hits: None
+    )
+    next(steps)
+    steps.send(hits_page(1, _scroll_id="s1"))
+    request = steps.throw(elasticsearch.elasticsearch.TransportError(500, "failed"))
+    assert request.method == "clear_scroll"
+    assert request.params == {"scroll_id": "s1"}
+    # A failed clear doesn't hide the error of the scroll
+    with pytest.raises(elasticsearch.elasticsearch.TransportError) as err:
+        steps.throw(elasticsearch.elasticsearch.TransportError(404, "missing"))
+    assert err.value.status_code == 500
+
+
+def test_point_in_time_closed_before_scrolling():
+    steps = database()._all_hits_steps(
+        elasticsearch.Search(), "metadata", lambda hits: None
+    )
+    _, requests = run_steps(
+        steps,
+        [
+            {"id": "p1"},
+            elasticsearch.elasticsearch.TransportError(400, "no _shard_doc"),
+            {},
+            hits_page(0, _scroll_id="s1"),
+            {},
+        ],
+    )
+    assert [getattr(request, "method", "search") for request in requests] == [
+        "open_point_in_time",
+        "search",
+        "close_point_in_time",
+        "search",
+        "clear_scroll",
+    ]
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+import os
+import subprocess
+import sys
+
+import touchstone
+
+# Dependencies only the query and output paths import
+HEAVY_MODULES = ["elasticsearch", "elasticsearch_dsl", "yaml", "tabulate", "numpy"]
+
+
+def _loaded_modules(code):
+    """Returns the heavy modules loaded by code run in a fresh interpreter"""
+    env = dict(os.environ)
+    # The package under test, wherever it was imported from
+    src = os.path.dirname(os.path.dirname(touchstone.__file__))
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [src, env.get("PYTHONPATH")]))
+    report = "import sys\nprint('loaded:', *(m for m in {!r} if m in sys.modules))"
+    output = subprocess.run(
+        [sys.executable, "-c", "\n".join([code, report.format(HEAVY_MODULES)])],
+        env=env,
+        check=True,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    ).stdout
+    # The last line lists them, after anything code printed
+    return output.splitlines()[-1].split()[1:]
+
+
+def test_import_compare_is_lean():
+    assert _loaded_modules("import touchstone.compare") == []
+
+
+def test_help_is_lean():
+    code = (
+        "import touchstone.compare\n"
+        "try:\n"
+        "    touchstone.compare.parse_args(['--help'])\n"
+        "except SystemExit:\n"
+        "    pass"
+    )
+    assert _loaded_modules(code) == []
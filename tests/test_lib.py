@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+import json
+
+from touchstone.utils.lib import ResultStore
+
+UPERF_RESULT = {
+    "test_type": {
+        "stream": {
+            "protocol": {
+                "tcp": {"message_size": {64: {"avg(norm_byte)": {"u1": 1.5}}}},
+                "udp": {"message_size": {64: {"avg(norm_byte)": {"u1": 0.5}}}},
+            }
+        }
+    }
+}
+
+
+def test_empty_store():
+    store = ResultStore()
+    assert not store
+    assert store.to_dict() == {}
+    assert list(store.rows()) == []
+
+
+def test_merge_keeps_first_merged_order():
+    store = ResultStore()
+    store.merge({"b": {"x": 1}, "a": {"y": 2}})
+    store.merge({"a": {"z": 3}, "c": 4, "b": {"w": 5}})
+    assert store
+    # Compared as json, so the key order has to match too
+    assert json.dumps(store.to_dict()) == json.dumps(
+        {"b": {"x": 1, "w": 5}, "a": {"y": 2, "z": 3}, "c": 4}
+    )
+
+
+def test_merge_replaces_values():
+    store = ResultStore()
+    store.merge({"a": {"b": 1}, "c": 2})
+    store.merge({"a": {"b": 3}})
+    # A value replaces a dictionary and the other way around
+    store.merge({"a": 4, "c": {"d": 5}})
+    assert store.to_dict() == {"a": 4, "c": {"d": 5}}
+
+
+def test_merge_does_not_alias_inputs():
+    result = {"a": {"b": 1}}
+    store = ResultStore()
+    store.merge(result)
+    output = store.to_dict()
+    output["a"]["b"] = 2
+    assert result == {"a": {"b": 1}}
+    assert store.to_dict() == {"a": {"b": 1}}
+
+
+def test_merged_uuids_share_metrics():
+    store = ResultStore()
+    store.merge(UPERF_RESULT)
+    store.merge(
+        {
+            "test_type": {
+                "stream": {
+                    "protocol": {
+                        "tcp": {"message_size": {64: {"avg(norm_byte)": {"u2": 1.5}}}}
+                    }
+                }
+            }
+        }
+    )
+    protocols = store.to_dict()["test_type"]["stream"]["protocol"]
+    assert protocols["tcp"]["message_size"][64]["avg(norm_byte)"] == {
+        "u1": 1.5,
+        "u2": 1.5,
+    }
+    assert list(protocols["udp"]["message_size"][64]["avg(norm_byte)"]) == ["u1"]
+
+
+def test_rows_skip_headers():
+    store = ResultStore()
+    store.merge(UPERF_RESULT)
+    headers = ["test_type", "protocol", "message_size", "key", "uuid", "value"]
+    assert list(store.rows(headers)) == [
+        ["stream", "tcp", 64, "avg(norm_byte)", "u1", 1.5],
+        ["stream", "udp", 64, "avg(norm_byte)", "u1", 0.5],
+    ]
+    assert list(store.rows())[0] == [
+        "test_type",
+        "stream",
+        "protocol",
+        "tcp",
+        "message_size",
+        64,
+        "avg(norm_byte)",
+        "u1",
+        1.5,
+    ]
+
+
+def test_deep_results_do_not_recurse():
+    depth = 5000
+    data = value = {}
+    for level in range(depth):
+        value[level] = {}
+        value = value[level]
+    value["leaf"] = 1
+    store = ResultStore()
+    store.merge(data)
+    rows = list(store.rows())
+    assert len(rows) == 1
+    assert len(rows[0]) == depth + 2
+    output = store.to_dict()
+    for level in range(depth):
+        output = output[level]
+    assert output == {"leaf": 1}
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from touchstone.databases.limiter import AdaptiveLimiter
+
+
+def replies(limiter, latencies, rejected=False):
+    for latency in latencies:
+        limiter.acquire()
+        limiter.release(latency, rejected=rejected)
+
+
+def test_limit_grows_and_halves_on_rejection():
+    limiter = AdaptiveLimiter(8, latency_threshold=1)
+    replies(limiter, [0.1] * 4)
+    assert limiter.report()["limit"] == 5
+    replies(limiter, [0.1], rejected=True)
+    report = limiter.report()
+    assert report["limit"] == 2
+    assert report["rejections"] == 1
+    # Past slow start the limit grows by one per limit replies
+    replies(limiter, [0.1] * 2)
+    assert limiter.report()["limit"] == 3
+
+
+def test_limit_stays_under_ceiling():
+    limiter = AdaptiveLimiter(4, latency_threshold=1)
+    replies(limiter, [0.1] * 20)
+    assert limiter.report()["limit"] == 4
+
+
+def test_slow_reply_halves_limit():
+    limiter = AdaptiveLimiter(16)
+    replies(limiter, [0.1] * 8)
+    assert limiter.report()["limit"] == 9
+    replies(limiter, [1.0])
+    report = limiter.report()
+    assert report["limit"] == 4
+    assert report["slow"] == 1
+
+
+def test_mixed_latencies_do_not_collapse_limit():
+    limiter = AdaptiveLimiter(16)
+    # Cheap and expensive queries interleaved, none of them congested
+    replies(limiter, [0.02, 0.1] * 100)
+    report = limiter.report()
+    assert report["slow"] < 10
+    assert report["limit"] == 16
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+import pytest
+
+elasticsearch = pytest.importorskip("touchstone.databases.elasticsearch")
+
+from touchstone.databases import resilience  # noqa: E402
+
+TransportError = elasticsearch.elasticsearch.TransportError
+
+
+def test_retries_retryable_errors():
+    attempts = []
+
+    def send():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise TransportError(503, "unavailable")
+        return "reply"
+
+    policy = resilience.RequestPolicy(retries=2, backoff=0)
+    assert resilience.call_with_policy(policy, [send]) == "reply"
+    assert len(attempts) == 3
+
+
+def test_does_not_retry_other_errors():
+    attempts = []
+
+    def send():
+        attempts.append(1)
+        raise TransportError(400, "bad request")
+
+    policy = resilience.RequestPolicy(retries=2, backoff=0)
+    with pytest.raises(TransportError):
+        resilience.call_with_policy(policy, [send])
+    assert len(attempts) == 1
+
+
+def test_hedge_wins_over_slow_primary():
+    release = threading.Event()
+
+    def primary():
+        release.wait(5)
+        return "primary"
+
+    policy = resilience.RequestPolicy(hedge_after=0.01, hedge_urls=["http://hedge"])
+    try:
+        assert (
+            resilience.call_with_policy(policy, [primary, lambda: "hedge"]) == "hedge"
+        )
+    finally:
+        release.set()
+
+
+def test_queued_primaries_are_not_hedged():
+    hedges = []
+
+    def primary():
+        time.sleep(0.1)
+        return "primary"
+
+    def hedge():
+        hedges.append(1)
+        return "hedge"
+
+    policy = resilience.RequestPolicy(hedge_after=0.3, hedge_urls=["http://hedge"])
+    # Most primaries wait for a thread longer than hedge_after
+    count = 4 * resilience._executor()._max_workers
+    replies = []
+    threads = [
+        threading.Thread(
+            target=lambda: replies.append(
+                resilience.call_with_policy(policy, [primary, hedge])
+            )
+        )
+        for _ in range(count)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert replies == ["primary"] * count
+    assert not hedges
+
+
+def test_msearch_item_errors_are_retried(monkeypatch):
+    policy = resilience.RequestPolicy(retries=1, backoff=0)
+    database = elasticsearch.Elasticsearch(
+        conn_url="http://localhost:9200", policy=policy
+    )
+    replies = [
+        {"responses": [{"status": 429, "error": {"type": "es_rejected_execution"}}]},
+        {"responses": [{"status": 200, "hits": {"hits": []}}]},
+    ]
+    calls = []
+
+    def msearch(body, **params):
+        calls.append(body)
+        return replies[len(calls) - 1]
+
+    monkeypatch.setattr(database._conn_object, "msearch", msearch)
+    search = elasticsearch.SearchRequest(elasticsearch.Search(), "ripsaw-uperf-results")
+    assert database._msearch([search]) == [{"status": 200, "hits": {"hits": []}}]
+    assert len(calls) == 2
+
+
+def test_connections_are_keyed_by_retries():
+    conn_url = "http://localhost:9200"
+    assert elasticsearch.get_connection(
+        conn_url, max_retries=0
+    ) is not elasticsearch.get_connection(conn_url, max_retries=3)
+    assert elasticsearch.get_connection(
+        conn_url, max_retries=0
+    ) is elasticsearch.get_connection(conn_url, max_retries=0)
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+from touchstone import serve
+from touchstone.databases.sqlite import Sqlite, write_tables
+from touchstone.session import ComparisonSession
+from touchstone.utils.cache import MemoryCache
+from touchstone.utils.columnar import flatten_source
+
+from conftest import COMPUTE_MAP
+
+SOURCES = [
+    {"uuid": "u1", "test_type": "stream", "protocol": "tcp", "throughput": 10},
+    {"uuid": "u1", "test_type": "stream", "protocol": "udp", "throughput": 20},
+    {"uuid": "u2", "test_type": "stream", "protocol": "tcp", "throughput": 30},
+]
+
+
+@pytest.fixture
+def server():
+    server = serve.ComparisonServer(("127.0.0.1", 0), MemoryCache(), max_sessions=2)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def post(server, body):
+    request = urllib.request.Request(
+        "http://127.0.0.1:{}/compare".format(server.server_address[1]),
+        body.encode("utf-8"),
+        {"Content-Type": "application/json"},
+    )
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as err:
+        return err.code, json.loads(err.read())
+
+
+@pytest.mark.parametrize("body", ["[1, 2]", '"uperf"', "null", "{"])
+def test_request_body_not_an_object(server, body):
+    code, response = post(server, body)
+    assert code == 400
+    assert "error" in response
+
+
+def test_sessions_least_recently_used_first_out(server):
+    first = server.session({"benchmark": "uperf"})
+    server.session({"benchmark": "uperf", "identifier": "cluster_name"})
+    # Using the first session again keeps it over the second one
+    assert server.session({"benchmark": "uperf"}) is first
+    server.session({"benchmark": "uperf", "identifier": "run_id"})
+    assert server.status()["sessions"] == 2
+    assert server.session({"benchmark": "uperf"}) is first
+
+
+def test_concurrent_sessions_send_each_query_once(tmp_path, monkeypatch):
+    path = str(tmp_path / "results.db")
+    write_tables(path, {"results": [flatten_source(source) for source in SOURCES]})
+    calls = []
+    emit_compute_dict = Sqlite.emit_compute_dict
+
+    def slow_emit_compute_dict(self, **query):
+        calls.append(query["uuid"])
+        # Long enough for every session to look the query up meanwhile
+        time.sleep(0.2)
+        return emit_compute_dict(self, **query)
+
+    monkeypatch.setattr(Sqlite, "emit_compute_dict", slow_emit_compute_dict)
+    cache = MemoryCache()
+    queries = [
+        (
+            path,
+            {
+                "uuid": uuid,
+                "compute_map": COMPUTE_MAP,
+                "index": "results",
+                "identifier": "uuid",
+            },
+        )
+        for uuid in ["u1", "u2"]
+    ]
+    results = []
+
+    def compare():
+        session = ComparisonSession("uperf", database="sqlite", cache=cache, jobs=2)
+        results.append(list(session._run_compute_queries(queries)))
+
+    threads = [threading.Thread(target=compare) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(calls) == ["u1", "u2"]
+    assert len(results) == 4
+    assert all(result == results[0] for result in results)
+    assert results[0][0]["test_type"]["stream"]["protocol"]["udp"] == {
+        "max(throughput)": {"u1": 20.0}
+    }
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+import io
+import json
+import time
+
+import pytest
+
+from touchstone.databases.sqlite import Sqlite, write_tables
+from touchstone.session import ComparisonSession, fetch_compute_results
+from touchstone.utils.cache import MemoryCache
+from touchstone.utils.columnar import flatten_source, write_snapshot
+
+SOURCES = [
+    {"uuid": "u1", "test_type": "stream", "protocol": "tcp", "throughput": 10},
+]
+CONFIG = json.dumps(
+    {
+        "elasticsearch": {
+            "metadata": {},
+            "ripsaw": {
+                "results": [
+                    {
+                        "filter": {"test_type.keyword": "stream"},
+                        "buckets": ["protocol.keyword"],
+                        "aggregations": {"throughput": ["max"]},
+                    }
+                ]
+            },
+        }
+    }
+)
+
+
+def test_jobs_sharing_an_empty_query_send_it_once(tmp_path, monkeypatch, result_cache):
+    path = str(tmp_path / "results.db")
+    write_tables(path, {"results": [flatten_source(source) for source in SOURCES]})
+    calls = []
+    emit_compute_dict = Sqlite.emit_compute_dict
+
+    def counted_emit_compute_dict(self, **query):
+        calls.append(query["uuid"])
+        return emit_compute_dict(self, **query)
+
+    monkeypatch.setattr(Sqlite, "emit_compute_dict", counted_emit_compute_dict)
+    cache = MemoryCache(max_entries=0, ttl=0, backing=result_cache)
+    sessions = [
+        ComparisonSession(
+            "uperf", database="sqlite", config=io.StringIO(CONFIG), cache=cache
+        )
+        for _ in range(2)
+    ]
+    # Two jobs sharing the query of u2, which has no result
+    comparisons = [(sessions[0], ["u1", "u2"], path), (sessions[1], ["u2"], path)]
+    assert fetch_compute_results(comparisons) == (2, 2)
+    for session, uuids, conn_urls in comparisons:
+        session.render(uuids, conn_urls, "json", io.StringIO())
+    assert sorted(calls) == ["u1", "u2"]
+    # Only the result worth keeping is stored on disk
+    assert len(result_cache._entries()) == 1
+
+
+def test_manifest_sessions_run_their_own_calls(tmp_path, monkeypatch):
+    documents = [flatten_source(source) for source in SOURCES]
+    sqlite_path = str(tmp_path / "results.db")
+    write_tables(sqlite_path, {"results": documents})
+    snapshot_path = str(tmp_path / "results.snapshot")
+    write_snapshot(snapshot_path, {"results": documents})
+    ran = []
+    run_calls = ComparisonSession._run_calls
+
+    def recorded_run_calls(self, calls):
+        ran.extend((self, type(func.__self__)) for func, _ in calls)
+        return run_calls(self, calls)
+
+    monkeypatch.setattr(ComparisonSession, "_run_calls", recorded_run_calls)
+    cache = MemoryCache()
+    sessions = [
+        ComparisonSession(
+            "uperf", database=database, config=io.StringIO(CONFIG), cache=cache
+        )
+        for database in ["sqlite", "snapshot"]
+    ]
+    comparisons = [
+        (sessions[0], ["u1"], sqlite_path),
+        (sessions[1], ["u1"], snapshot_path),
+    ]
+    assert fetch_compute_results(comparisons) == (2, 2)
+    assert sorted(
+        (sessions.index(session), database.__name__) for session, database in ran
+    ) == [(0, "Sqlite"), (1, "Snapshot")]
+    outputs = []
+    for session, uuids, conn_urls in comparisons:
+        outputs.append(io.StringIO())
+        session.render(uuids, conn_urls, "json", outputs[-1])
+    assert len(ran) == 2
+    assert outputs[0].getvalue() == outputs[1].getvalue()
+
+
+@pytest.mark.parametrize("prefetch", [0, 2])
+def test_failed_comparison_releases_its_claims(tmp_path, monkeypatch, prefetch):
+    path = str(tmp_path / "results.db")
+    write_tables(path, {"results": [flatten_source(source) for source in SOURCES]})
+    failures = [RuntimeError("metadata search failed")]
+    emit_compare_metadata_dict = Sqlite.emit_compare_metadata_dict
+
+    def failing_emit_compare_metadata_dict(self, **kwargs):
+        if failures:
+            raise failures.pop()
+        return emit_compare_metadata_dict(self, **kwargs)
+
+    monkeypatch.setattr(
+        Sqlite, "emit_compare_metadata_dict", failing_emit_compare_metadata_dict
+    )
+    cache = MemoryCache()
+    session = ComparisonSession(
+        "uperf",
+        database="sqlite",
+        config=io.StringIO(CONFIG),
+        metadata_map={"results": {"element": "protocol", "compare": ["throughput"]}},
+        cache=cache,
+        prefetch=prefetch,
+    )
+    with pytest.raises(RuntimeError):
+        session.render(["u1"], path, "json", io.StringIO())
+    # The next comparison of the same uuid doesn't wait on the failed one
+    start = time.monotonic()
+    output_file = io.StringIO()
+    session.render(["u1"], path, "json", output_file)
+    assert time.monotonic() - start < 5
+    assert "max(throughput)" in output_file.getvalue()
+    assert not cache._in_flight
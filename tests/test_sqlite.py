@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+import json
+
+import pytest
+
+from touchstone.databases.sqlite import Sqlite, write_tables
+from touchstone.utils.columnar import flatten_source, to_columns
+
+SOURCES = [
+    {"uuid": "u1", "protocol": "tcp", "size": 64, "throughput": 10, "tags": ["a"]},
+    {"uuid": "u1", "protocol": "tcp", "size": 64, "throughput": 20},
+    {"uuid": "u1", "protocol": "tcp", "size": 1024, "throughput": 40},
+    {"uuid": "u1", "protocol": "udp", "size": 64, "throughput": 5},
+    {"uuid": "u1", "protocol": "udp", "throughput": 7},
+    {"uuid": "u2", "protocol": "tcp", "size": 64, "throughput": 100},
+    {
+        "uuid": "u1",
+        "pod": {"name": "client", "labels": ["x", "y"]},
+        "nodes": [{"name": "n1"}],
+    },
+]
+
+COMPUTE_MAP = {
+    "filter": {},
+    "buckets": ["protocol.keyword", "size"],
+    "aggregations": {
+        "throughput": [
+            "max",
+            "min",
+            "avg",
+            "sum",
+            "value_count",
+            {"percentiles": {"percents": [25, 50]}},
+        ]
+    },
+}
+
+
+@pytest.fixture
+def database(tmp_path):
+    path = str(tmp_path / "results.db")
+    write_tables(path, {"results": [flatten_source(source) for source in SOURCES]})
+    return Sqlite(path)
+
+
+def test_write_tables_lists_as_json(database):
+    rows = database._conn().execute(
+        'SELECT "tags", "pod.labels", "nodes" FROM "results" WHERE "pod.name" IS NULL'
+        ' AND "tags" IS NOT NULL'
+    )
+    assert rows.fetchall() == [('["a"]', None, None)]
+    rows = database._conn().execute(
+        'SELECT "pod.labels", "nodes" FROM "results" WHERE "pod.name" = ?', ["client"]
+    )
+    labels, nodes = rows.fetchone()
+    assert json.loads(labels) == ["x", "y"]
+    assert json.loads(nodes) == [{"name": "n1"}]
+
+
+def test_group_by_matches_numpy_engine(database):
+    aggregate = pytest.importorskip("touchstone.utils.aggregate")
+    documents = [flatten_source(source) for source in SOURCES]
+    table = aggregate.Table(to_columns(documents), len(documents))
+    for uuid in ["u1", "u2"]:
+        result = database.emit_compute_dict(uuid, COMPUTE_MAP, "results", "uuid")
+        expected = aggregate.compute_dict(table, COMPUTE_MAP, "uuid", uuid)
+        # Compared as json, so the bucket order has to match too
+        assert json.dumps(result) == json.dumps(expected)
+
+
+def test_group_by_values(database):
+    result = database.emit_compute_dict("u1", COMPUTE_MAP, "results", "uuid.keyword")
+    assert list(result["protocol"]) == ["tcp", "udp"]
+    assert list(result["protocol"]["tcp"]["size"]) == [64, 1024]
+    assert result["protocol"]["tcp"]["size"][64] == {
+        "max(throughput)": {"u1": 20.0},
+        "min(throughput)": {"u1": 10.0},
+        "avg(throughput)": {"u1": 15.0},
+        "sum(throughput)": {"u1": 30.0},
+        "value_count(throughput)": {"u1": 2},
+        "25.0percentiles(throughput)": {"u1": 12.5},
+        "50.0percentiles(throughput)": {"u1": 15.0},
+    }
+
+
+def test_filters_and_excludes(database):
+    compute_map = dict(COMPUTE_MAP, filter={"protocol.keyword": "tcp"})
+    compute_map["exclude"] = [{"size": 1024}]
+    result = database.emit_compute_dict("u1", compute_map, "results", "uuid")
+    assert list(result["protocol"]["tcp"]["protocol"]["tcp"]["size"]) == [64]
+
+
+def test_missing_data(database):
+    assert database.emit_compute_dict("u3", COMPUTE_MAP, "results", "uuid") == {}
+    assert database.emit_compute_dict("u1", COMPUTE_MAP, "missing", "uuid") == {}
+    compute_map = dict(COMPUTE_MAP, filter={"missing": "x"})
+    assert database.emit_compute_dict("u1", compute_map, "results", "uuid") == {}
+
+
+def test_metadata(database):
+    compare_map = {"element": "pod.name", "compare": ["pod.labels"]}
+    metadata = database.emit_compare_metadata_dict("u1", compare_map, "results", {})
+    assert json.loads(metadata["client"]["pod.labels"]) == ["x", "y"]
+
+
+def test_index_keeps_cache_source(database):
+    source = database._cache_source()
+    database._create_index("results", ["uuid", "protocol"])
+    assert database._conn().execute("PRAGMA index_list(results)").fetchall()
+    assert database._cache_source() == source